@@ -1,10 +1,71 @@
+from knowme.instrumentation import Instrumentation, StageTimer, stage_tag
+from knowme.session_store import SessionStore, default_session_store
 from knowme.tools import SiteAnswerTool, CVAnswerTool
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
+import asyncio
+import logging
 import os
-from langchain.agents import AgentExecutor, create_tool_calling_agent
-from typing import Optional
+import queue
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from typing import Any, AsyncIterator, Iterator, Optional
+from uuid import UUID
+
+# The tag of the llm runs made by the agent itself.
+# The tokens of the other llm runs, such as the ones made
+# inside the tools, are not streamed to the user
+AGENT_LLM_TAG = "knowme-agent"
+
+# Marks the end of the stream in the queue
+_STREAM_END = object()
+
+# The number of messages of the chat history that the fan out
+# mode passes to the llm when it combines the answers
+FAN_OUT_HISTORY_MESSAGES = 10
+
+logger = logging.getLogger(__name__)
+
+
+class AgentStreamHandler(BaseCallbackHandler):
+    def __init__(self, events: queue.Queue):
+        """Puts the tokens of the agent and the tool calls
+        into a queue as they are produced
+
+        Parameters
+        ----------
+        events : queue.Queue
+            The queue that is consumed by `KnowMeAgent.chat_stream`
+        """
+        self.events = events
+        self.agent_runs: set[UUID] = set()
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id: UUID, tags=None, **kwargs: Any
+    ):
+        if tags and AGENT_LLM_TAG in tags:
+            self.agent_runs.add(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if token and run_id in self.agent_runs:
+            self.events.put({"answer": token})
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        self.agent_runs.discard(run_id)
+
+    def on_tool_start(self, serialized, input_str: str, **kwargs: Any):
+        tool = serialized.get("name") if serialized else kwargs.get("name")
+        self.events.put({"tool": tool, "status": f"Looking up the {tool}"})
+
+    def on_tool_end(self, output: Any, **kwargs: Any):
+        self.events.put({"status": "Writing the answer"})
 
 
 class KnowMeAgent:
@@ -14,6 +75,12 @@ class KnowMeAgent:
         cv_chain,
         openai_model: Optional[str] = "gpt-4",
         verbose: bool = True,
+        fan_out: bool = False,
+        source_timeout: float = 30.0,
+        max_concurrent_requests: int = 8,
+        llm: Optional[BaseChatModel] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        session_store: Optional[SessionStore] = None,
     ):
         """This is a knowme agent that is given  a tool to answer from the site
         or a tool to answer from the CV. The agent decides to use the tools to
@@ -31,26 +98,64 @@ class KnowMeAgent:
         verbose : bool, optional
             bool, by default True
             When set to true, the actions taken by the agent are explained
+        fan_out : bool, optional
+            bool, by default False
+            When set to true, the agent does not chose the tools. Both the
+            chains are asked concurrently and their answers are combined
+            in a single call to the llm
+        source_timeout : float, optional
+            float, by default 30.0
+            The seconds to wait for each chain in the fan out mode. A chain
+            that does not answer in time is left out of the final answer
+        max_concurrent_requests : int, optional
+            int, by default 8
+            The number of requests that the fan out mode serves at the same
+            time without waiting for a worker. The chains that did not answer
+            in time keep their worker until they are done
+        llm : Optional[BaseChatModel], optional
+            BaseChatModel, by default None
+            The chat model that choses the tools. It has to support tool
+            calling. A ChatOpenAI model of `openai_model` is used if this is None
+        instrumentation : Optional[Instrumentation], optional
+            Instrumentation, by default None
+            If provided, the wall time and the tokens of the turns of the
+            agent ("agent"), of the tool calls ("tool") and of asking the
+            sources in the fan out mode ("sources") are recorded per request
+        session_store : Optional[SessionStore], optional
+            SessionStore, by default None
+            Stores the answers of the fan out mode, which the next questions
+            of the session can refer to. The store of the website chain
+            is used if this is None
         """
         self.openai_model = openai_model
-        self.site_answer_tool = SiteAnswerTool()
-        self.cv_answer_tool = CVAnswerTool()
-
-        # This has to be done
-        # Instantiating the tool class with custom variables is not yet
-        # supported in langchain and setting instance variables
-        # is not supported as well. Just using class variables here
-
-        SiteAnswerTool.chain = website_chain
-        CVAnswerTool.chain = cv_chain
+        self.website_chain = website_chain
+        self.cv_chain = cv_chain
+        self.fan_out = fan_out
+        self.source_timeout = source_timeout
+        self.instrumentation = instrumentation
+        if session_store is None:
+            session_store = getattr(website_chain, "session_store", None)
+        self.session_store = (
+            session_store if session_store is not None else default_session_store
+        )
+        self.site_answer_tool = SiteAnswerTool(
+            chain=website_chain, tags=[stage_tag("tool")]
+        )
+        self.cv_answer_tool = CVAnswerTool(chain=cv_chain, tags=[stage_tag("tool")])
         self.tools = [self.site_answer_tool, self.cv_answer_tool]
         self.verbose = verbose
-        self.llm = ChatOpenAI(
-            model=self.openai_model,
-            temperature=0,
-            verbose=self.verbose,
-            api_key=os.environ["OPENAI_API_KEY"],
-        )
+        if llm is None:
+            llm = ChatOpenAI(
+                model=self.openai_model,
+                temperature=0,
+                verbose=self.verbose,
+                streaming=True,
+                api_key=os.environ["OPENAI_API_KEY"],
+            )
+        # The runs of the agent are told apart by the tags. They are
+        # set on the run config so the given model is left untouched
+        agent_tags = [AGENT_LLM_TAG, stage_tag("agent")]
+        self.llm = llm.with_config(tags=agent_tags)
         self.prompt = ChatPromptTemplate.from_messages(
             [
                 (
@@ -65,11 +170,42 @@ class KnowMeAgent:
                 ("placeholder", "{agent_scratchpad}"),
             ]
         )
-        self.agent = create_tool_calling_agent(self.llm, self.tools, self.prompt)
+        # The tools are bound to the model itself, as `bind_tools` drops
+        # the config of a bound model. The agent carries the tags instead
+        self.agent = create_tool_calling_agent(
+            llm, self.tools, self.prompt
+        ).with_config(tags=agent_tags)
         self.agent_executor = AgentExecutor(
             agent=self.agent, tools=self.tools, verbose=self.verbose
         )
 
+        # The fan out mode combines the answers of the two chains
+        self.synthesis_prompt = ChatPromptTemplate.from_messages(
+            [
+                (
+                    "system",
+                    "You will answer questions from the user about a candidate. "
+                    "The question was answered from their Notion Website and from "
+                    "their CV. Combine the two answers below into a single concise "
+                    "answer. Ignore an answer that does not know or is missing. "
+                    "If neither answer knows, say that you don't know."
+                    "\n\nWebsite answer: {site_answer}"
+                    "\n\nCV answer: {cv_answer}",
+                ),
+                MessagesPlaceholder("chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+        self.synthesis_chain = self.synthesis_prompt | self.llm
+        self.sources = {"site": self.website_chain, "cv": self.cv_chain}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_requests * len(self.sources),
+            thread_name_prefix="knowme-fan-out",
+        )
+        # The chains that did not answer in time and are still running
+        self._stragglers: set[Future] = set()
+        self._stragglers_lock = threading.Lock()
+
     def chat(self, user_input: str, session_id: str):
         """The agent executor reoutes the query to the appropriate
         tool and answers the different questions. The signature matches
@@ -84,11 +220,173 @@ class KnowMeAgent:
             This helps in maintaining the history and remembering
             the context
         """
+        timer = self._timer(session_id)
+        if self.fan_out:
+            start = time.perf_counter()
+            answers = self._fan_out_answers(user_input, session_id)
+            self._record_sources(timer, start)
+            answer = self.synthesis_chain.invoke(
+                self._synthesis_input(user_input, session_id, answers),
+                config=self._run_config(timer),
+            ).content
+            self._add_to_history(session_id, user_input, answer)
+            return answer
+
         output = self.agent_executor.invoke(
-            {"input": f"{user_input}. Use session_id={session_id} for agent calls "}
+            self._agent_input(user_input, session_id), config=self._run_config(timer)
         )
         return output["output"]
 
+    def _timer(self, session_id: str) -> Optional[StageTimer]:
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.timer("agent", session_id)
+
+    @staticmethod
+    def _run_config(timer: Optional[StageTimer], *callbacks) -> RunnableConfig:
+        # The timer records the request when the run ends
+        if timer is not None:
+            callbacks = (*callbacks, timer)
+        return {"callbacks": list(callbacks)}
+
+    @staticmethod
+    def _record_sources(timer: Optional[StageTimer], start: float):
+        # The chains are asked outside the run of the agent
+        if timer is not None:
+            timer.add_stage("sources", (time.perf_counter() - start) * 1000)
+
+    @staticmethod
+    def _agent_input(user_input: str, session_id: str) -> dict[str, str]:
+        return {"input": f"{user_input}. Use session_id={session_id} for agent calls "}
+
+    def _history(self, session_id: str):
+        # The agents over other stores keep their histories
+        # apart by the scope of the site chain
+        scope = getattr(self.website_chain, "history_scope", None)
+        if scope is None:
+            return self.session_store.get_history(f"agent:{session_id}")
+        return self.session_store.get_history(f"agent:{scope}:{session_id}")
+
+    def _add_to_history(self, session_id: str, user_input: str, answer: str):
+        history = self._history(session_id)
+        history.add_user_message(user_input)
+        history.add_ai_message(answer)
+
+    def _synthesis_input(
+        self, user_input: str, session_id: str, answers: dict[str, str]
+    ) -> dict[str, Any]:
+        chat_history: list[BaseMessage] = self._history(session_id).messages
+        return {
+            "input": user_input,
+            "chat_history": chat_history[-FAN_OUT_HISTORY_MESSAGES:],
+            "site_answer": answers["site"],
+            "cv_answer": answers["cv"],
+        }
+
+    def _track_straggler(self, source: str, future: Future):
+        # A chain that is running cannot be stopped. It is kept track
+        # of until it is done, so that a slow source that holds the
+        # workers shows up in the logs
+        if future.cancel():
+            return
+        with self._stragglers_lock:
+            self._stragglers.add(future)
+            num_stragglers = len(self._stragglers)
+
+        def done(future: Future):
+            with self._stragglers_lock:
+                self._stragglers.discard(future)
+
+        future.add_done_callback(done)
+        logger.warning(
+            "the %s chain did not answer in %s seconds. "
+            "%d chains are still running after their timeout",
+            source,
+            self.source_timeout,
+            num_stragglers,
+        )
+
+    def stragglers(self) -> int:
+        """The number of chains that are still running after their timeout"""
+        with self._stragglers_lock:
+            return len(self._stragglers)
+
+    def close(self):
+        """Shuts down the workers of the fan out. The chains that are
+        already submitted finish in the background"""
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _answer_text(output: Any) -> str:
+        if isinstance(output, dict):
+            return output["answer"]
+        return str(output)
+
+    def _fan_out_answers(self, user_input: str, session_id: str) -> dict[str, str]:
+        """Asks all the chains concurrently
+
+        Parameters
+        ----------
+        user_input : str
+            The query that is typed by the user
+        session_id : str
+            The session id passed to the chains
+
+        Returns
+        -------
+        dict[str, str]
+            The answer of every source. The answer is a note
+            when the source failed or did not answer in time
+        """
+        futures = {
+            source: self._executor.submit(chain.chat, user_input, session_id)
+            for source, chain in self.sources.items()
+        }
+
+        # The chains run concurrently. So every chain is given
+        # the same deadline rather than the timeout one after the other
+        deadline = time.monotonic() + self.source_timeout
+        answers = {}
+        for source, future in futures.items():
+            try:
+                output = future.result(timeout=max(0, deadline - time.monotonic()))
+                answers[source] = self._answer_text(output)
+            except FutureTimeoutError:
+                self._track_straggler(source, future)
+                answers[source] = "The source did not answer in time."
+            except Exception:
+                logger.exception("the %s chain failed", source)
+                answers[source] = "The source could not be reached."
+        return answers
+
+    async def _afan_out_answers(
+        self, user_input: str, session_id: str
+    ) -> dict[str, str]:
+        """The async version of `_fan_out_answers`"""
+
+        async def answer(source: str, chain) -> str:
+            try:
+                output = await asyncio.wait_for(
+                    chain.achat(user_input, session_id), timeout=self.source_timeout
+                )
+                return self._answer_text(output)
+            except asyncio.TimeoutError:
+                # The chain is cancelled with the task that waits for it
+                logger.warning(
+                    "the %s chain did not answer in %s seconds",
+                    source,
+                    self.source_timeout,
+                )
+                return "The source did not answer in time."
+            except Exception:
+                logger.exception("the %s chain failed", source)
+                return "The source could not be reached."
+
+        outputs = await asyncio.gather(
+            *[answer(source, chain) for source, chain in self.sources.items()]
+        )
+        return dict(zip(self.sources.keys(), outputs))
+
     def chat_stream(self, user_input: str, session_id: str):
         """The chat is streamed back to the client
 
@@ -111,21 +409,138 @@ class KnowMeAgent:
         Yields
         ------
         dict[str, str]
-            A dictionary containing the answer
-            Note that time.sleep(0.05) is added for UX purposes
-            only since the generator for the agent chat is only
-            a wrapper after the output has been generated. Currently
-            langchain does not support a native generator for an agent.
+            A dictionary containing a token of the answer under "answer"
+            as the final llm call of the agent produces it. When the agent
+            calls a tool, a dictionary with the name of the tool under
+            "tool" and a message under "status" is yielded
         """
-        # TODO: There is no current standard way to do the streaming
-        # of the output for the agent_executor. Instead we make this a
-        # generator that can be useful for the st.write_stream()
-        # or similar methods for showing in the UI
-        answer = self.chat(user_input, session_id)
+        timer = self._timer(session_id)
+        if self.fan_out:
+            return iter(self._fan_out_stream(user_input, session_id, timer))
+
+        events = queue.Queue()
+        handler = AgentStreamHandler(events)
 
-        def generator():
-            for word in answer.split():
-                yield {"answer": f"{word} "}
-                time.sleep(0.05)
+        # The agent executor runs in the background and the
+        # tokens are yielded from the queue as they arrive
+        def run():
+            try:
+                self.agent_executor.invoke(
+                    self._agent_input(user_input, session_id),
+                    config=self._run_config(timer, handler),
+                )
+                events.put(_STREAM_END)
+            except Exception as exception:
+                events.put(exception)
+
+        threading.Thread(target=run, daemon=True).start()
+
+        def generator() -> Iterator[dict[str, str]]:
+            while True:
+                event = events.get()
+                if event is _STREAM_END:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
 
         return iter(generator())
+
+    def _fan_out_stream(
+        self, user_input: str, session_id: str, timer: Optional[StageTimer] = None
+    ) -> Iterator[dict[str, str]]:
+        yield {"status": "Looking up the website and the CV"}
+        start = time.perf_counter()
+        answers = self._fan_out_answers(user_input, session_id)
+        self._record_sources(timer, start)
+        yield {"status": "Writing the answer"}
+        answer = ""
+        for chunk in self.synthesis_chain.stream(
+            self._synthesis_input(user_input, session_id, answers),
+            config=self._run_config(timer),
+        ):
+            if chunk.content:
+                answer += chunk.content
+                yield {"answer": chunk.content}
+        self._add_to_history(session_id, user_input, answer)
+
+    async def achat(self, user_input: str, session_id: str):
+        """The async version of `chat`. The tools call the
+        async methods of the chains
+
+        Parameters
+        ----------
+        user_input : str
+            The query that is typed by the user
+        session_id : str
+            The session id to be passed to the tools
+        """
+        timer = self._timer(session_id)
+        if self.fan_out:
+            start = time.perf_counter()
+            answers = await self._afan_out_answers(user_input, session_id)
+            self._record_sources(timer, start)
+            output = await self.synthesis_chain.ainvoke(
+                self._synthesis_input(user_input, session_id, answers),
+                config=self._run_config(timer),
+            )
+            self._add_to_history(session_id, user_input, output.content)
+            return output.content
+
+        output = await self.agent_executor.ainvoke(
+            self._agent_input(user_input, session_id), config=self._run_config(timer)
+        )
+        return output["output"]
+
+    async def achat_stream(
+        self, user_input: str, session_id: str
+    ) -> AsyncIterator[dict[str, str]]:
+        """The async version of `chat_stream`
+
+        Parameters
+        ----------
+        user_input : str
+            The query that is typed by the user
+        session_id : str
+            The session id to be passed to the tools
+
+        Yields
+        ------
+        dict[str, str]
+            The same chunks as `chat_stream`
+        """
+        timer = self._timer(session_id)
+        if self.fan_out:
+            yield {"status": "Looking up the website and the CV"}
+            start = time.perf_counter()
+            answers = await self._afan_out_answers(user_input, session_id)
+            self._record_sources(timer, start)
+            yield {"status": "Writing the answer"}
+            answer = ""
+            async for chunk in self.synthesis_chain.astream(
+                self._synthesis_input(user_input, session_id, answers),
+                config=self._run_config(timer),
+            ):
+                if chunk.content:
+                    answer += chunk.content
+                    yield {"answer": chunk.content}
+            self._add_to_history(session_id, user_input, answer)
+            return
+
+        async for event in self.agent_executor.astream_events(
+            self._agent_input(user_input, session_id),
+            config=self._run_config(timer),
+            version="v2",
+        ):
+            kind = event["event"]
+            if kind == "on_chat_model_stream" and AGENT_LLM_TAG in event.get(
+                "tags", []
+            ):
+                token = event["data"]["chunk"].content
+                if token:
+                    yield {"answer": token}
+            elif kind == "on_tool_start":
+                tool = event["name"]
+                yield {"tool": tool, "status": f"Looking up the {tool}"}
+            elif kind == "on_tool_end":
+                yield {"status": "Writing the answer"}
@@ -0,0 +1,202 @@
+"""
+A cache of answers in front of the knowme chain.
+Visitors of a profile ask the same few questions again and again.
+The exact tier matches the normalized question. The semantic tier
+matches questions whose embeddings are similar.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_query(query: str) -> str:
+    """Lower cases the query and removes the punctuation
+    and the extra whitespace around the words
+
+    Parameters
+    ----------
+    query : str
+        The query typed by the user
+
+    Returns
+    -------
+    str
+        The normalized query
+    """
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        embedding_function: Optional[Embeddings] = None,
+        similarity_threshold: float = 0.95,
+        max_entries: int = 512,
+        ttl_seconds: Optional[float] = 24 * 60 * 60,
+    ):
+        """Caches the answers of a chain
+
+        Parameters
+        ----------
+        embedding_function : Optional[Embeddings], optional
+            Embeds the queries for the semantic tier, by default None
+            Only the exact tier is used if this is None
+        similarity_threshold : float, optional
+            The minimum cosine similarity between two queries for them
+            to share an answer, by default 0.95
+        max_entries : int, optional
+            The least recently used answers are evicted beyond this,
+            by default 512
+        ttl_seconds : Optional[float], optional
+            The answers expire after these many seconds, by default a day
+            The answers do not expire if this is None
+        """
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        # (scope, normalized query) -> (answer, unit vector, created at)
+        self._entries: OrderedDict[tuple, tuple[str, Any, float]] = OrderedDict()
+        # The vectors of the recent queries. These are reused
+        # when the answer of a missed query is put in the cache
+        self._query_vectors: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return (
+            self.ttl_seconds is not None
+            and time.monotonic() - created_at > self.ttl_seconds
+        )
+
+    def _query_vector(self, normalized_query: str):
+        with self._lock:
+            if normalized_query in self._query_vectors:
+                return self._query_vectors[normalized_query]
+
+        vector = np.asarray(
+            self.embedding_function.embed_query(normalized_query), dtype=np.float32
+        )
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        with self._lock:
+            self._query_vectors[normalized_query] = vector
+            while len(self._query_vectors) > 64:
+                self._query_vectors.popitem(last=False)
+        return vector
+
+    def get(self, query: str, scope: Hashable = None) -> Optional[str]:
+        """Returns the cached answer to the query
+
+        Parameters
+        ----------
+        query : str
+            The query typed by the user
+        scope : Hashable, optional
+            The answers are only shared within the same scope,
+            such as the version of a store, by default None
+
+        Returns
+        -------
+        Optional[str]
+            The answer if the query or a similar query has been answered
+        """
+        normalized_query = normalize_query(query)
+        key = (scope, normalized_query)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[2]):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry[0]
+
+        if self.embedding_function is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        vector = self._query_vector(normalized_query)
+        with self._lock:
+            candidates = [
+                (entry_key, entry)
+                for entry_key, entry in self._entries.items()
+                if entry_key[0] == scope and not self._is_expired(entry[2])
+            ]
+            if candidates:
+                similarities = np.stack([entry[1] for _, entry in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    best_key, best_entry = candidates[best]
+                    self._entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return best_entry[0]
+            self.misses += 1
+        return None
+
+    def put(self, query: str, answer: str, scope: Hashable = None):
+        """Caches the answer to the query
+
+        Parameters
+        ----------
+        query : str
+            The query typed by the user
+        answer : str
+            The answer of the chain
+        scope : Hashable, optional
+            The scope of the answer, by default None
+        """
+        normalized_query = normalize_query(query)
+        vector = None
+        if self.embedding_function is not None:
+            vector = self._query_vector(normalized_query)
+
+        with self._lock:
+            self._entries[(scope, normalized_query)] = (
+                answer,
+                vector,
+                time.monotonic(),
+            )
+            self._entries.move_to_end((scope, normalized_query))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        """The hits and misses of the cache
+
+        Returns
+        -------
+        dict[str, Any]
+            The hits of each tier, the misses, the hit rate
+            and the number of cached answers
+        """
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
@@ -1,8 +1,14 @@
 import streamlit as st
-from knowme.agent import KnowMeAgent
 from dotenv import load_dotenv
-from knowme.load_chains import load_site_answer_chain, load_cv_answer_chain
-import zipfile
+from knowme.load_chains import get_agent, get_site_answer_chain, get_cv_answer_chain
+from knowme.load_chains import create_embedding_function, default_splitter
+from knowme.load_chains import DEFAULT_CV_EXTRACTION
+from knowme.ingest import zip_fingerprint
+from knowme.instrumentation import default_instrumentation
+from knowme.manifest import embedding_name
+from knowme.store_paths import StoreResolver
+import hashlib
+import uuid
 from pathlib import Path
 import os
 
@@ -20,6 +26,33 @@ cv_chain = None
 
 DATA_DIR = os.environ["DATA_DIR"]
 STORES_DIR = os.environ["STORES_DIR"]
+# The embeddings are cached across stores so that a rebuilt store
+# does not embed the chunks that have not changed
+EMBEDDING_CACHE_DIR = f"{STORES_DIR}/embedding_cache"
+# The parsed and split files are cached so that an upload
+# of the same file is not parsed again
+ARTIFACT_CACHE_DIR = f"{STORES_DIR}/artifact_cache"
+
+
+# The resolver and the embedding client are created once per process
+# and not on every rerun of the script
+@st.cache_resource
+def get_store_resolver(stores_dir: str) -> StoreResolver:
+    return StoreResolver(stores_dir)
+
+
+@st.cache_resource
+def get_embedding_model() -> str:
+    return embedding_name(create_embedding_function())
+
+
+# The stores are named after the hash of their content, embedding model
+# and splitter. The same upload is embedded once whatever its name
+store_resolver = get_store_resolver(STORES_DIR)
+EMBEDDING_MODEL = get_embedding_model()
+# The timings of every request can also be appended to a json lines file
+if os.environ.get("KNOWME_METRICS_LOG"):
+    default_instrumentation.log_path = os.environ["KNOWME_METRICS_LOG"]
 #######################################################################################
 # Information about the app
 #######################################################################################
@@ -58,17 +91,19 @@ with notion_column:
 
     if notion_folder:
         if notion_folder.type == "application/zip":
-            with zipfile.ZipFile(notion_folder, "r") as z:
-                # Using the root folder as the folder to
-                z.extractall(DATA_DIR)
-
-            notion_folderpath = Path(f"{DATA_DIR}/{notion_folder.name}").with_suffix("")
-
-            # create the vector path if it not provided
-            notion_vectorstore = Path(f"{STORES_DIR}/{notion_folder.name}_vectorstore")
-            notion_vectorstore = str(notion_vectorstore)
+            # The markdown files are read straight from the uploaded zip
+            # Nothing is extracted and an unchanged upload is not ingested again
+            notion_folderpath = notion_folder
+
+            notion_vectorstore = store_resolver.resolve(
+                name=notion_folder.name,
+                kind="notion",
+                content_hash=zip_fingerprint(notion_folder),
+                embedding=EMBEDDING_MODEL,
+                splitter=default_splitter(),
+            )
 
-            st.success("Extracted the zip folder. Ready to answer your questions")
+            st.success("Uploaded the zip folder. Ready to answer your questions")
 
         else:
             st.error("Please upload a .zip folder. Read the tip above if needed")
@@ -81,20 +116,29 @@ with cv_column:
         filename = cv_file.name
         filename = Path(filename)
 
+        # Two different CVs with the same name are kept apart
+        # by the hash of their content
+        cv_content = cv_file.getvalue()
+        cv_hash = hashlib.sha256(cv_content).hexdigest()
+        cv_filename = f"{DATA_DIR}/cv_{cv_hash[:24]}.pdf"
+
         if filename.suffix == ".pdf":
-            with open(f"{DATA_DIR}/{filename}", "wb") as fp:
-                fp.write(cv_file.getvalue())
+            with open(cv_filename, "wb") as fp:
+                fp.write(cv_content)
             st.success(
                 f"Successfully uploaded {filename}. Ready to answer your questions"
             )
         else:
             st.error("Please upload a .pdf file. ")
 
-        cv_filename = f"{DATA_DIR}/{filename}"
-
-        # create the cv vectorstore
-        cv_vectorstore = Path(f"{STORES_DIR}/{cv_file.name}_vectorstore")
-        cv_vectorstore = str(cv_vectorstore)
+        cv_vectorstore = store_resolver.resolve(
+            name=cv_file.name,
+            kind="cv",
+            content_hash=cv_hash,
+            embedding=EMBEDDING_MODEL,
+            splitter=default_splitter(),
+            mode=DEFAULT_CV_EXTRACTION,
+        )
 
 st.divider()
 
@@ -119,6 +163,7 @@ chat_option = st.selectbox(
 is_load_site_chain = False
 is_load_cv_chain = False
 is_load_agent = False
+fan_out = False
 
 if chat_option == "agent":
     st.warning("Agent is a Experimental Feature. Latency is high", icon="⚠️")
@@ -128,6 +173,9 @@ if chat_option == "agent":
     if cv_filename is None or cv_vectorstore is None:
         st.error("Please upload your CV", icon="📑")
 
+    # Asking both the sources together is faster than letting
+    # the agent call them one after the other
+    fan_out = st.toggle("Ask the website and the CV together", value=True)
     is_load_agent = True
 
 elif chat_option == "website":
@@ -143,35 +191,60 @@ elif chat_option == "cv":
         is_load_cv_chain = True
 
 
+# The chains are kept in a process wide registry.
+# They are built only the first time and reused on every rerun
 if is_load_site_chain:
     with st.spinner("Loading the Site Chat Agent 🤖"):
-        chat = load_site_answer_chain(
+        chat = get_site_answer_chain(
             notion_folderpath=notion_folderpath,
             embedding_store_directory=notion_vectorstore,
+            embedding_cache_dir=EMBEDDING_CACHE_DIR,
+            artifact_cache_dir=ARTIFACT_CACHE_DIR,
+            instrumentation=default_instrumentation,
         )
 
 elif is_load_cv_chain:
     with st.spinner("Loading the CV Chat Agent 🤖"):
-        chat = load_cv_answer_chain(
-            cv_filepath=cv_filename, embedding_store_directory=cv_vectorstore
+        chat = get_cv_answer_chain(
+            cv_filepath=cv_filename,
+            embedding_store_directory=cv_vectorstore,
+            embedding_cache_dir=EMBEDDING_CACHE_DIR,
+            artifact_cache_dir=ARTIFACT_CACHE_DIR,
+            instrumentation=default_instrumentation,
         )
 
 elif is_load_agent:
     if notion_folderpath is not None:
-        site_chain = load_site_answer_chain(
+        site_chain = get_site_answer_chain(
             notion_folderpath=notion_folderpath,
             embedding_store_directory=notion_vectorstore,
+            embedding_cache_dir=EMBEDDING_CACHE_DIR,
+            artifact_cache_dir=ARTIFACT_CACHE_DIR,
+            instrumentation=default_instrumentation,
         )
 
     if cv_filename is not None:
-        cv_chain = load_cv_answer_chain(
-            cv_filepath=cv_filename, embedding_store_directory=cv_vectorstore
+        cv_chain = get_cv_answer_chain(
+            cv_filepath=cv_filename,
+            embedding_store_directory=cv_vectorstore,
+            embedding_cache_dir=EMBEDDING_CACHE_DIR,
+            artifact_cache_dir=ARTIFACT_CACHE_DIR,
+            instrumentation=default_instrumentation,
         )
 
     if site_chain is not None and cv_chain is not None:
         print("Loading the agent")
-        chat = KnowMeAgent(website_chain=site_chain, cv_chain=cv_chain)
+        chat = get_agent(
+            website_chain=site_chain,
+            cv_chain=cv_chain,
+            fan_out=fan_out,
+            instrumentation=default_instrumentation,
+        )
+
 
+# The chains are shared by every visitor of the app. Every browser
+# session has its own conversation, and its own timings, by this id
+session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
 
 # This displays the chat history after refreshing
 # The history is stored in session_state object
@@ -195,10 +268,13 @@ if prompt := st.chat_input("What do you want to know about me?"):
 
 # This steps through the chain stream
 # and yields those chunks that have an answer with them
+# The agent also reports the tools that it calls
 def chunk_generator(stream):
     for chunk in stream:
         if chunk is None:
             break
+        if chunk.get("status"):
+            st.toast(chunk["status"])
         if chunk.get("answer"):
             yield chunk["answer"]
 
@@ -207,10 +283,36 @@ if prompt:
     with st.chat_message("assistant"):
         # the answer here is a stream
         with st.spinner("Our Agent is working hard to find an answer"):
-            answer = chat.chat_stream(prompt, session_id="abc")
+            answer = chat.chat_stream(prompt, session_id=session_id)
             with st.expander("Assistant Says: ", expanded=True):
                 # The last message is the output of the write_stream function
                 final_answer = st.write_stream(chunk_generator(answer))
                 st.session_state.messages.append(
                     {"role": "assistant", "content": final_answer}
                 )
+
+
+# The time, the tokens and the chunks of every stage of the answers
+with st.sidebar:
+    if st.toggle("Show the timings of the answers"):
+        last_requests = default_instrumentation.requests(session_id=session_id, limit=1)
+        if last_requests:
+            last_request = last_requests[0]
+            st.markdown(
+                f"**Last answer** from the {last_request['source']}: "
+                f"{last_request['total_ms']:.0f} ms"
+                + (" (cached)" if last_request["cached"] else "")
+            )
+            st.dataframe(
+                [
+                    {"stage": stage, **values}
+                    for stage, values in last_request["stages"].items()
+                ],
+                hide_index=True,
+            )
+
+        for session in default_instrumentation.sessions(session_id=session_id):
+            st.markdown(
+                f"**Session** with the {session['source']}: {session['requests']} "
+                f"answers in {session['total_ms'] / 1000:.1f} s"
+            )
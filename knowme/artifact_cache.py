@@ -0,0 +1,186 @@
+"""
+An on-disk cache of the chunks produced by the ingestors.
+Parsing a pdf and splitting a file give the same chunks for the same
+content and splitter. The chunks are keyed by the hash of the content
+and the splitter configuration, so a file that is uploaded again or a
+chain that is loaded again is not parsed again.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+
+from langchain.text_splitter import TextSplitter
+from langchain_core.documents import Document
+
+from knowme.manifest import splitter_config
+
+# Changing the format of the chunks changes every key
+ARTIFACT_VERSION = 1
+
+
+def artifact_key(
+    kind: str, content_hash: str, splitter: TextSplitter, **params: Any
+) -> str:
+    """The key of the chunks of a file
+
+    Parameters
+    ----------
+    kind : str
+        The kind of file, such as "markdown" or "cv"
+    content_hash : str
+        The sha256 of the content of the file
+    splitter : TextSplitter
+        The splitter that splits the file
+    params
+        Any other parameters that change the chunks
+
+    Returns
+    -------
+    str
+        The hex digest of the key
+    """
+    description = {
+        "version": ARTIFACT_VERSION,
+        "kind": kind,
+        "content": content_hash,
+        "splitter": splitter_config(splitter),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir: str, max_size_bytes: int = 256 * 1024 * 1024):
+        """Caches the chunks of the files as gzipped json.
+        Only the files in the cache directory hold the state, so the
+        cache can be sent to the workers of a process pool. The least
+        recently used entries are evicted beyond `max_size_bytes`
+
+        Parameters
+        ----------
+        cache_dir : str
+            The directory where the chunks are stored
+        max_size_bytes : int, optional
+            The maximum size of the cache on disk, by default 256MB
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # The size of the cache is only measured again once
+        # the written entries might have filled it up
+        self._size_bytes = self._measure()[0]
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json.gz"
+
+    def get(
+        self, key: str, path_key: Optional[str] = None, path: Optional[str] = None
+    ) -> Optional[list[Document]]:
+        """Returns the cached chunks
+
+        Parameters
+        ----------
+        key : str
+            The key from `artifact_key`
+        path_key : Optional[str], optional
+            The metadata field that holds the path of the file, by default None
+        path : Optional[str], optional
+            The path of the file. The same content can be at another path
+            than when it was cached, so the path is set again on every chunk
+
+        Returns
+        -------
+        Optional[list[Document]]
+            The chunks. None if they are not in the cache
+        """
+        cache_path = self._path(key)
+        try:
+            with gzip.open(cache_path, "rt") as fp:
+                records = json.load(fp)
+        except (OSError, EOFError, json.JSONDecodeError):
+            return None
+
+        # The modification time records the last access for the eviction
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+
+        documents = []
+        for page_content, metadata in records:
+            if path_key is not None:
+                metadata = {path_key: path, **metadata}
+            documents.append(Document(page_content=page_content, metadata=metadata))
+        return documents
+
+    def put(self, key: str, documents: list[Document], path_key: Optional[str] = None):
+        """Caches the chunks of a file
+
+        Parameters
+        ----------
+        key : str
+            The key from `artifact_key`
+        documents : list[Document]
+            The chunks
+        path_key : Optional[str], optional
+            The metadata field that holds the path of the file, by default None
+            It is not stored with the chunks
+        """
+        records = [
+            [
+                document.page_content,
+                {
+                    field: value
+                    for field, value in document.metadata.items()
+                    if field != path_key
+                },
+            ]
+            for document in documents
+        ]
+
+        cache_path = self._path(key)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Workers in other processes can write the same entry
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+        with gzip.open(tmp_path, "wt", compresslevel=6) as fp:
+            json.dump(records, fp, separators=(",", ":"))
+        os.replace(tmp_path, cache_path)
+
+        self._size_bytes += cache_path.stat().st_size
+        if self._size_bytes > self.max_size_bytes:
+            self._evict()
+
+    def _measure(self) -> tuple[int, list[tuple[float, int, Path]]]:
+        entries = []
+        size = 0
+        for cache_path in self.cache_dir.glob("*/*.json.gz"):
+            try:
+                stat = cache_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cache_path))
+            size += stat.st_size
+        return size, entries
+
+    def _evict(self):
+        size, entries = self._measure()
+        self._size_bytes = size
+        if size <= self.max_size_bytes:
+            return
+
+        # The oldest entries are removed until the cache is at 90% of its size
+        entries.sort()
+        for _, entry_size, cache_path in entries:
+            if size <= 0.9 * self.max_size_bytes:
+                break
+            try:
+                cache_path.unlink()
+                size -= entry_size
+            except OSError:
+                pass
+        self._size_bytes = size
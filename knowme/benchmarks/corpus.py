@@ -0,0 +1,225 @@
+"""
+Generates synthetic Notion exports and CVs of any size for the benchmarks.
+The text is drawn from a small vocabulary with a seeded random generator,
+so the same parameters always give the same corpus.
+"""
+
+import random
+import zipfile
+from pathlib import Path
+from typing import Union
+
+WORDS = (
+    "research engineer project model data retrieval language search system "
+    "paper team product design build deploy evaluate improve learn train "
+    "python service pipeline index query answer user experience graph neural "
+    "network benchmark latency memory cluster cloud open source library "
+    "student university course thesis talk blog writing reading travel music"
+).split()
+
+TOPICS = (
+    "Education Experience Projects Publications Skills Teaching Talks "
+    "Awards Volunteering Interests Reading Writing"
+).split()
+
+ORGANIZATIONS = (
+    "Acme Globex Initech Umbrella Hooli Stark Wayne Tyrell Cyberdyne Soylent"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(8, 18))
+    # Some sentences name an organization, like the pages of a profile
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), rng.choice(ORGANIZATIONS))
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng: random.Random) -> str:
+    return " ".join(_sentence(rng) for _ in range(rng.randint(3, 7)))
+
+
+def generate_notion_export(
+    directory: Union[str, Path],
+    num_pages: int = 50,
+    paragraphs_per_page: int = 10,
+    seed: int = 0,
+    as_zip: bool = False,
+) -> Path:
+    """Writes a synthetic Notion export of markdown pages
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        The directory of the export. The zip file is written
+        next to it with the .zip suffix if `as_zip` is True
+    num_pages : int, optional
+        The number of markdown pages, by default 50
+    paragraphs_per_page : int, optional
+        The number of paragraphs in every page, by default 10
+    seed : int, optional
+        Seeds the text of the pages, by default 0
+    as_zip : bool, optional
+        Write the export as a zip file, as Notion does, by default False
+
+    Returns
+    -------
+    Path
+        The folder of the export or the path of the zip file
+    """
+    rng = random.Random(seed)
+    directory = Path(directory)
+
+    pages = {}
+    for index in range(num_pages):
+        topic = TOPICS[index % len(TOPICS)]
+        # Notion nests the sub pages in a folder named after the parent
+        relative_path = f"Home/{topic}/{topic} {index}.md"
+        sections = [f"# {topic} {index}"]
+        for paragraph in range(paragraphs_per_page):
+            if paragraph % 3 == 0:
+                sections.append(f"## {rng.choice(WORDS).capitalize()} {paragraph}")
+            sections.append(_paragraph(rng))
+        pages[relative_path] = "\n\n".join(sections) + "\n"
+
+    if as_zip:
+        zip_path = directory.with_suffix(".zip")
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for relative_path, text in pages.items():
+                archive.writestr(relative_path, text)
+        return zip_path
+
+    for relative_path, text in pages.items():
+        path = directory / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return directory
+
+
+def _escape_pdf_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: Union[str, Path], pages: list[list[str]]):
+    """Writes a pdf with a text layer. Every page is a list of lines
+    in Helvetica. This is enough for the text extraction of pypdf
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        The path of the pdf
+    pages : list[list[str]]
+        The lines of every page
+    """
+    num_pages = len(pages)
+    font_number = 3 + 2 * num_pages
+    kids = " ".join(f"{3 + 2 * index} 0 R" for index in range(num_pages))
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {num_pages} >>",
+    ]
+    for index, lines in enumerate(pages):
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 {font_number} 0 R >> >> "
+            f"/Contents {4 + 2 * index} 0 R >>"
+        )
+        text = " ".join(f"({_escape_pdf_text(line)}) '" for line in lines)
+        operations = f"BT /F1 10 Tf 50 760 Td 12 TL {text} ET"
+        objects.append(
+            f"<< /Length {len(operations.encode('latin-1'))} >>\n"
+            f"stream\n{operations}\nendstream"
+        )
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    content = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+
+    xref_offset = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    content += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    content += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode()
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fp:
+        fp.write(content)
+
+
+def generate_cv(
+    path: Union[str, Path],
+    num_pages: int = 2,
+    lines_per_page: int = 55,
+    seed: int = 0,
+) -> Path:
+    """Writes a synthetic CV as a pdf with a text layer
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        The path of the pdf
+    num_pages : int, optional
+        The number of pages, by default 2
+    lines_per_page : int, optional
+        The number of lines in every page, by default 55
+    seed : int, optional
+        Seeds the text of the CV, by default 0
+
+    Returns
+    -------
+    Path
+        The path of the pdf
+    """
+    rng = random.Random(seed)
+    pages = []
+    for page in range(num_pages):
+        lines = []
+        while len(lines) < lines_per_page:
+            lines.append(TOPICS[(page * 7 + len(lines)) % len(TOPICS)].upper())
+            for _ in range(rng.randint(3, 6)):
+                words = rng.choices(WORDS, k=rng.randint(6, 12))
+                words.insert(0, rng.choice(ORGANIZATIONS))
+                lines.append(" ".join(words))
+        pages.append(lines[:lines_per_page])
+
+    write_pdf(path, pages)
+    return Path(path)
+
+
+def generate_questions(num_questions: int = 20, seed: int = 0) -> list[str]:
+    """Questions about the synthetic profile
+
+    Parameters
+    ----------
+    num_questions : int, optional
+        The number of questions, by default 20
+    seed : int, optional
+        Seeds the questions, by default 0
+
+    Returns
+    -------
+    list[str]
+        The questions
+    """
+    rng = random.Random(seed)
+    templates = (
+        "What did they do at {organization}?",
+        "Tell me about their {word} {other} work.",
+        "Which {topic} mention {word}?",
+        "Have they worked on {word} and {other}?",
+    )
+    return [
+        rng.choice(templates).format(
+            organization=rng.choice(ORGANIZATIONS),
+            word=rng.choice(WORDS),
+            other=rng.choice(WORDS),
+            topic=rng.choice(TOPICS).lower(),
+        )
+        for _ in range(num_questions)
+    ]
@@ -0,0 +1,216 @@
+"""
+Offline stand-ins for the OpenAI models that the benchmarks plug into
+the loaders. The embeddings are seeded by a hash of the text and the chat
+model answers with a fixed text after a configurable latency, so the
+benchmarks measure the code of the repo and not the network.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+    ToolMessage,
+)
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+def _random_vector(text: str, size: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(size)
+
+
+class RandomEmbeddings(Embeddings):
+    def __init__(self, size: int = 1536, noise: float = 0.5):
+        """Embeds a text to a random vector that is seeded by the text.
+        The texts that start with the same word are close to each other,
+        like the chunks of a corpus about a few topics
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of dimensions, by default 1536 like the OpenAI embeddings
+        noise : float, optional
+            How far the texts are from the center of their topic, by default 0.5
+        """
+        self.size = size
+        self.noise = noise
+
+    def _embed(self, text: str) -> list[float]:
+        topic = text.split(" ", 1)[0]
+        vector = _random_vector(topic, self.size) + self.noise * _random_vector(
+            text, self.size
+        )
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """A chat model that answers every question with the same text.
+    It waits for `latency` seconds before the first token and for
+    `token_latency` seconds before every other token, like a remote model.
+    Once tools are bound, it calls the first tool for the question and
+    answers with the text once the tool has returned"""
+
+    response: str = "They have worked on information retrieval and chat assistants."
+    latency: float = 0.0
+    token_latency: float = 0.0
+    tool_names: list[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "knowme-fake-chat-model"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> "FakeChatModel":
+        tool_names = [
+            convert_to_openai_tool(tool)["function"]["name"] for tool in tools
+        ]
+        return FakeChatModel(
+            response=self.response,
+            latency=self.latency,
+            token_latency=self.token_latency,
+            tool_names=tool_names,
+            tags=self.tags,
+        )
+
+    def _tokens(self) -> list[str]:
+        return re.findall(r"\S+\s*", self.response)
+
+    def _tool_call(self, messages: list[BaseMessage]) -> Optional[dict[str, Any]]:
+        # A tool is called once per question
+        if not self.tool_names or any(
+            isinstance(message, ToolMessage) for message in messages
+        ):
+            return None
+
+        question = next(
+            (
+                message.content
+                for message in reversed(messages)
+                if isinstance(message, HumanMessage)
+            ),
+            "",
+        )
+        # The agent asks for the session id in the question
+        session = re.search(r"session_id=(\S+)", question)
+        return {
+            "name": self.tool_names[0],
+            "args": {
+                "query": question,
+                "session_id": session.group(1) if session else "benchmark",
+            },
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+        }
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tool_call = self._tool_call(messages)
+        if tool_call is not None:
+            time.sleep(self.latency)
+            message = AIMessage(content="", tool_calls=[tool_call])
+        else:
+            tokens = self._tokens()
+            time.sleep(self.latency + self.token_latency * max(len(tokens) - 1, 0))
+            message = AIMessage(content=self.response)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tool_call = self._tool_call(messages)
+        if tool_call is not None:
+            await asyncio.sleep(self.latency)
+            message = AIMessage(content="", tool_calls=[tool_call])
+        else:
+            tokens = self._tokens()
+            await asyncio.sleep(
+                self.latency + self.token_latency * max(len(tokens) - 1, 0)
+            )
+            message = AIMessage(content=self.response)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    @staticmethod
+    def _tool_call_chunk(tool_call: dict[str, Any]) -> ChatGenerationChunk:
+        return ChatGenerationChunk(
+            message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[
+                    {
+                        "name": tool_call["name"],
+                        "args": json.dumps(tool_call["args"]),
+                        "id": tool_call["id"],
+                        "index": 0,
+                    }
+                ],
+            )
+        )
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        tool_call = self._tool_call(messages)
+        if tool_call is not None:
+            yield self._tool_call_chunk(tool_call)
+            return
+
+        for index, token in enumerate(self._tokens()):
+            if index > 0:
+                time.sleep(self.token_latency)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        tool_call = self._tool_call(messages)
+        if tool_call is not None:
+            yield self._tool_call_chunk(tool_call)
+            return
+
+        for index, token in enumerate(self._tokens()):
+            if index > 0:
+                await asyncio.sleep(self.token_latency)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
@@ -0,0 +1,464 @@
+"""
+An offline benchmark of the whole pipeline. A synthetic Notion export
+and CV are generated, the OpenAI models are replaced by the fakes and
+every stage is timed: ingestion, building and opening the stores,
+retrieval and the chains and the agent end to end. The results are
+written as json so that the runs before and after a change can be compared.
+
+    knowme bench --num-pages 200 --output bench.json
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from knowme.benchmarks.corpus import (
+    generate_cv,
+    generate_notion_export,
+    generate_questions,
+)
+from knowme.benchmarks.fakes import FakeChatModel, RandomEmbeddings
+from knowme.benchmarks.vector_stores import time_open
+from knowme.bm25 import HybridRetriever
+from knowme.ingest import CVIngestor, NotionIngestor
+from knowme.load_chains import (
+    EMBEDDERS,
+    default_splitter,
+    get_agent,
+    load_cv_answer_chain,
+    load_site_answer_chain,
+)
+from knowme.registry import ChainRegistry
+from knowme.session_store import InMemorySessionStore
+
+# Changing the layout of the results changes this
+RESULTS_VERSION = 1
+
+
+def summarize(latencies_ms: list[float]) -> dict[str, float]:
+    """The mean and percentiles of the latencies
+
+    Parameters
+    ----------
+    latencies_ms : list[float]
+        The latencies in milliseconds
+
+    Returns
+    -------
+    dict[str, float]
+        The mean, p50, p95 and max of the latencies
+    """
+    latencies_ms = sorted(latencies_ms)
+    return {
+        "mean_ms": statistics.mean(latencies_ms),
+        "p50_ms": statistics.median(latencies_ms),
+        "p95_ms": latencies_ms[int(0.95 * (len(latencies_ms) - 1))],
+        "max_ms": latencies_ms[-1],
+    }
+
+
+def _time_ms(function: Callable[[], Any]) -> tuple[float, Any]:
+    start = time.perf_counter()
+    output = function()
+    return (time.perf_counter() - start) * 1000, output
+
+
+def _time_stream_ms(stream) -> tuple[float, float]:
+    # The time to the first chunk with an answer and to the end of the stream
+    start = time.perf_counter()
+    first_token_ms = None
+    for chunk in stream:
+        if first_token_ms is None and chunk.get("answer"):
+            first_token_ms = (time.perf_counter() - start) * 1000
+    total_ms = (time.perf_counter() - start) * 1000
+    return first_token_ms if first_token_ms is not None else total_ms, total_ms
+
+
+def benchmark_ingest(
+    notion_path: Path, cv_path: Path, num_workers: int
+) -> dict[str, Any]:
+    """Times the ingestion of the export and the CV
+
+    Parameters
+    ----------
+    notion_path : Path
+        The folder or the zip file of the export
+    cv_path : Path
+        The path of the CV
+    num_workers : int
+        The number of workers of the parallel ingestion
+
+    Returns
+    -------
+    dict[str, Any]
+        The throughput of every way of ingesting
+    """
+    results = {}
+    reader = NotionIngestor(notion_path, default_splitter())
+    notion_bytes = sum(
+        len(reader.read_file(relative_path))
+        for relative_path in reader.markdown_files()
+    )
+    for name, workers, executor_type in (
+        ("notion_sequential", None, "thread"),
+        ("notion_threads", num_workers, "thread"),
+        ("notion_processes", num_workers, "process"),
+    ):
+        ingestor = NotionIngestor(
+            notion_path,
+            default_splitter(),
+            num_workers=workers,
+            executor_type=executor_type,
+        )
+        elapsed_ms, documents = _time_ms(ingestor.ingest)
+        results[name] = {
+            "seconds": elapsed_ms / 1000,
+            "files": len(ingestor.markdown_files()),
+            "chunks": len(documents),
+            "files_per_second": len(ingestor.markdown_files()) / (elapsed_ms / 1000),
+            "chunks_per_second": len(documents) / (elapsed_ms / 1000),
+            "mb_per_second": notion_bytes / 1e6 / (elapsed_ms / 1000),
+        }
+
+    ingestor = CVIngestor(cv_path, default_splitter(), mode="fast")
+    elapsed_ms, documents = _time_ms(ingestor.ingest)
+    results["cv_fast"] = {
+        "seconds": elapsed_ms / 1000,
+        "chunks": len(documents),
+        "chunks_per_second": len(documents) / (elapsed_ms / 1000),
+    }
+    return results
+
+
+def benchmark_stores(
+    documents: list[Document],
+    embedding_function: Embeddings,
+    queries: list[str],
+    stores_dir: Path,
+    vector_stores: list[str],
+    k: int = 6,
+) -> dict[str, Any]:
+    """Times building, opening and searching every kind of store
+
+    Parameters
+    ----------
+    documents : list[Document]
+        The chunks of the store
+    embedding_function : Embeddings
+        The embedding function
+    queries : list[str]
+        The queries of the retrieval
+    stores_dir : Path
+        The directory where the stores are built
+    vector_stores : list[str]
+        The kinds of vector stores
+    k : int, optional
+        The number of chunks retrieved per query, by default 6
+
+    Returns
+    -------
+    dict[str, Any]
+        The timings of every kind of store
+    """
+    results = {}
+    for vector_store in vector_stores:
+        embedder = EMBEDDERS[vector_store](
+            embedding_function=embedding_function,
+            embedding_store_directory=str(stores_dir / f"store_{vector_store}"),
+            keyword_index=True,
+        )
+        build_ms, store = _time_ms(
+            lambda: embedder.store_embeddings(documents, source={"type": "benchmark"})
+        )
+
+        vector_latencies = []
+        for query in queries:
+            elapsed_ms, _ = _time_ms(lambda: store.similarity_search(query, k=k))
+            vector_latencies.append(elapsed_ms)
+
+        hybrid = HybridRetriever(
+            vector_store=store, keyword_index=embedder.keyword_index, k=k
+        )
+        hybrid_latencies = []
+        for query in queries:
+            elapsed_ms, _ = _time_ms(lambda: hybrid.invoke(query))
+            hybrid_latencies.append(elapsed_ms)
+
+        results[vector_store] = {
+            "build_seconds": build_ms / 1000,
+            "chunks": len(documents),
+            "open_and_first_query_ms": time_open(embedder),
+            "vector_search": summarize(vector_latencies),
+            "hybrid_search": summarize(hybrid_latencies),
+        }
+    return results
+
+
+def benchmark_chains(
+    notion_path: Path,
+    cv_path: Path,
+    embedding_function: Embeddings,
+    questions: list[str],
+    stores_dir: Path,
+    vector_store: str,
+    llm_latency: float,
+    token_latency: float,
+) -> dict[str, Any]:
+    """Times loading the chains and answering questions end to end
+
+    Parameters
+    ----------
+    notion_path : Path
+        The folder or the zip file of the export
+    cv_path : Path
+        The path of the CV
+    embedding_function : Embeddings
+        The embedding function
+    questions : list[str]
+        The questions. Every question starts a session and is followed
+        by a follow up question in the same session
+    stores_dir : Path
+        The directory where the stores are built
+    vector_store : str
+        The kind of vector store
+    llm_latency : float
+        The seconds that the fake chat model waits before the first token
+    token_latency : float
+        The seconds that the fake chat model waits between the tokens
+
+    Returns
+    -------
+    dict[str, Any]
+        The timings of the chains and the agent
+    """
+    llm = FakeChatModel(latency=llm_latency, token_latency=token_latency)
+
+    def load(loader: Callable, **kwargs) -> Any:
+        return loader(
+            embedding_function=embedding_function,
+            vector_store=vector_store,
+            llm=llm,
+            rewrite_llm=llm,
+            cache_answers=False,
+            session_store=InMemorySessionStore(),
+            **kwargs,
+        )
+
+    site_kwargs = {
+        "notion_folderpath": notion_path,
+        "embedding_store_directory": str(stores_dir / f"site_{vector_store}"),
+    }
+    cv_kwargs = {
+        "cv_filepath": str(cv_path),
+        "embedding_store_directory": str(stores_dir / f"cv_{vector_store}"),
+    }
+
+    results = {}
+    # The first load builds the store and the second one opens it
+    results["site_load_cold_ms"], _ = _time_ms(
+        lambda: load(load_site_answer_chain, **site_kwargs)
+    )
+    results["site_load_warm_ms"], site_chain = _time_ms(
+        lambda: load(load_site_answer_chain, **site_kwargs)
+    )
+    results["cv_load_cold_ms"], _ = _time_ms(
+        lambda: load(load_cv_answer_chain, **cv_kwargs)
+    )
+    results["cv_load_warm_ms"], cv_chain = _time_ms(
+        lambda: load(load_cv_answer_chain, **cv_kwargs)
+    )
+
+    for name, chain in (("site", site_chain), ("cv", cv_chain)):
+        first_latencies = []
+        follow_up_latencies = []
+        first_token_latencies = []
+        for index, question in enumerate(questions):
+            session_id = f"bench-{name}-{index}"
+            elapsed_ms, _ = _time_ms(lambda: chain.chat(question, session_id))
+            first_latencies.append(elapsed_ms)
+            # The follow up question is rewritten with the chat history
+            elapsed_ms, _ = _time_ms(
+                lambda: chain.chat("Tell me more about that.", session_id)
+            )
+            follow_up_latencies.append(elapsed_ms)
+            first_token_ms, _ = _time_stream_ms(
+                chain.chat_stream(question, f"{session_id}-stream")
+            )
+            first_token_latencies.append(first_token_ms)
+
+        results[f"{name}_chat"] = summarize(first_latencies)
+        results[f"{name}_follow_up"] = summarize(follow_up_latencies)
+        results[f"{name}_stream_first_token"] = summarize(first_token_latencies)
+
+    for name, fan_out in (("agent_tools", False), ("agent_fan_out", True)):
+        agent = get_agent(
+            website_chain=site_chain,
+            cv_chain=cv_chain,
+            fan_out=fan_out,
+            registry=ChainRegistry(),
+            llm=llm,
+        )
+        agent.verbose = False
+        agent.agent_executor.verbose = False
+        latencies = []
+        for index, question in enumerate(questions):
+            elapsed_ms, _ = _time_ms(
+                lambda: agent.chat(question, f"bench-{name}-{index}")
+            )
+            latencies.append(elapsed_ms)
+        results[name] = summarize(latencies)
+
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    work_dir: str,
+    num_pages: int = 50,
+    paragraphs_per_page: int = 10,
+    cv_pages: int = 2,
+    num_questions: int = 20,
+    dimensions: int = 1536,
+    vector_stores: Optional[list[str]] = None,
+    num_workers: int = 4,
+    llm_latency: float = 0.0,
+    token_latency: float = 0.0,
+    notion_zip: bool = False,
+    seed: int = 0,
+) -> dict[str, Any]:
+    """Runs the whole benchmark offline
+
+    Parameters
+    ----------
+    work_dir : str
+        The directory where the corpus and the stores are written
+    num_pages : int, optional
+        The number of pages of the Notion export, by default 50
+    paragraphs_per_page : int, optional
+        The number of paragraphs in every page, by default 10
+    cv_pages : int, optional
+        The number of pages of the CV, by default 2
+    num_questions : int, optional
+        The number of questions, by default 20
+    dimensions : int, optional
+        The size of the embeddings, by default 1536
+    vector_stores : Optional[list[str]], optional
+        The kinds of vector stores, by default all of them
+        The chains are loaded with the first one
+    num_workers : int, optional
+        The number of workers of the parallel ingestion, by default 4
+    llm_latency : float, optional
+        The seconds that the fake chat model waits before the first
+        token, by default 0.0. The chains are timed without the model if 0
+    token_latency : float, optional
+        The seconds that the fake chat model waits between the tokens, by default 0.0
+    notion_zip : bool, optional
+        Ingest the export from a zip file, by default False
+    seed : int, optional
+        Seeds the corpus and the questions, by default 0
+
+    Returns
+    -------
+    dict[str, Any]
+        The parameters, the environment and the timings of every stage
+    """
+    if vector_stores is None:
+        vector_stores = list(EMBEDDERS)
+
+    work_dir = Path(work_dir)
+    stores_dir = work_dir / "stores"
+    notion_path = generate_notion_export(
+        work_dir / "notion",
+        num_pages=num_pages,
+        paragraphs_per_page=paragraphs_per_page,
+        seed=seed,
+        as_zip=notion_zip,
+    )
+    cv_path = generate_cv(work_dir / "cv.pdf", num_pages=cv_pages, seed=seed)
+    questions = generate_questions(num_questions, seed=seed)
+    embedding_function = RandomEmbeddings(size=dimensions)
+
+    print("benchmarking the ingestion")
+    ingest = benchmark_ingest(notion_path, cv_path, num_workers)
+
+    print("benchmarking the vector stores")
+    documents = NotionIngestor(notion_path, default_splitter()).ingest()
+    stores = benchmark_stores(
+        documents, embedding_function, questions, stores_dir, vector_stores
+    )
+
+    print("benchmarking the chains")
+    chains = benchmark_chains(
+        notion_path,
+        cv_path,
+        embedding_function,
+        questions,
+        stores_dir,
+        vector_stores[0],
+        llm_latency,
+        token_latency,
+    )
+
+    return {
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_commit": _git_commit(),
+        },
+        "parameters": {
+            "num_pages": num_pages,
+            "paragraphs_per_page": paragraphs_per_page,
+            "cv_pages": cv_pages,
+            "num_questions": num_questions,
+            "dimensions": dimensions,
+            "vector_stores": vector_stores,
+            "num_workers": num_workers,
+            "llm_latency": llm_latency,
+            "token_latency": token_latency,
+            "notion_zip": notion_zip,
+            "seed": seed,
+        },
+        "ingest": ingest,
+        "stores": stores,
+        "chains": chains,
+    }
+
+
+def write_results(results: dict[str, Any], path: str):
+    """Writes the results of a run as json
+
+    Parameters
+    ----------
+    results : dict[str, Any]
+        The results from `run_suite`
+    path : str
+        The path of the json file
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
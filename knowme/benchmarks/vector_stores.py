@@ -0,0 +1,161 @@
+"""
+Compares the Chroma store with the numpy store on a synthetic corpus.
+The embeddings are random vectors, so the benchmark runs offline and
+measures only the stores: the time to build, to open and to search
+them, and the recall of Chroma's approximate search.
+
+    python -m knowme.benchmarks.vector_stores --num-documents 2000
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from langchain_core.documents import Document
+from rich.console import Console
+from rich.table import Table
+
+from knowme.benchmarks.fakes import RandomEmbeddings
+from knowme.embedder import ChromaEmbedder, Embedder, NumpyEmbedder
+
+console = Console()
+
+
+def time_open(embedder: Embedder) -> float:
+    """The milliseconds taken to open the persisted store in a new process.
+    Opening it again in this process would reuse the clients and caches
+    of the first open"""
+    script = (
+        "import json, sys, time\n"
+        "from knowme.benchmarks.fakes import RandomEmbeddings\n"
+        f"from knowme.embedder import {type(embedder).__name__} as Embedder\n"
+        "embedder = Embedder(RandomEmbeddings(size=int(sys.argv[2])), sys.argv[1])\n"
+        "start = time.perf_counter()\n"
+        "embedder._open_store().similarity_search('warm up', k=1)\n"
+        "print(json.dumps((time.perf_counter() - start) * 1000))\n"
+    )
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            script,
+            str(embedder.embedding_store_directory),
+            str(getattr(embedder.embedding_function, "size", 1536)),
+        ],
+        check=True,
+        capture_output=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_store(
+    embedder: Embedder,
+    documents: list[Document],
+    queries: list[str],
+    k: int,
+) -> tuple[dict[str, float], list[list[str]]]:
+    """Builds, opens and searches a store
+
+    Parameters
+    ----------
+    embedder : Embedder
+        The embedder of the store
+    documents : list[Document]
+        The documents of the store
+    queries : list[str]
+        The queries to search for
+    k : int
+        The number of documents to retrieve for every query
+
+    Returns
+    -------
+    tuple[dict[str, float], list[list[str]]]
+        The timings in milliseconds and the contents
+        of the retrieved documents of every query
+    """
+    start = time.perf_counter()
+    embedder.store_embeddings(documents, source={"type": "benchmark"})
+    build_ms = (time.perf_counter() - start) * 1000
+
+    open_ms = time_open(embedder)
+    vectorstore = embedder._open_store()
+
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        retrieved = vectorstore.similarity_search(query, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([document.page_content for document in retrieved])
+
+    latencies.sort()
+    timings = {
+        "build_ms": build_ms,
+        "open_and_first_query_ms": open_ms,
+        "query_p50_ms": statistics.median(latencies),
+        "query_p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+    }
+    return timings, results
+
+
+@click.command()
+@click.option("--num-documents", type=int, default=2000, help="The size of the corpus")
+@click.option("--num-queries", type=int, default=200, help="The number of queries")
+@click.option("--dimensions", type=int, default=1536, help="The size of the vectors")
+@click.option("--k", type=int, default=6, help="The documents retrieved per query")
+def main(num_documents: int, num_queries: int, dimensions: int, k: int):
+    """Benchmarks the Chroma store against the numpy store"""
+    embedding_function = RandomEmbeddings(size=dimensions)
+    num_topics = max(1, num_documents // 50)
+    documents = [
+        Document(
+            page_content=f"topic-{index % num_topics} chunk {index}",
+            metadata={"filename": f"{index % num_topics}.md"},
+        )
+        for index in range(num_documents)
+    ]
+    queries = [
+        f"topic-{index % num_topics} query {index}" for index in range(num_queries)
+    ]
+
+    timings = {}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, embedder_class in (
+            ("chroma", ChromaEmbedder),
+            ("numpy", NumpyEmbedder),
+        ):
+            embedder = embedder_class(
+                embedding_function=embedding_function,
+                embedding_store_directory=str(Path(directory, name)),
+            )
+            timings[name], results[name] = benchmark_store(
+                embedder, documents, queries, k
+            )
+
+    # The numpy search is exact. It is the reference for the recall of Chroma
+    recall = statistics.mean(
+        len(set(approximate) & set(exact)) / len(exact)
+        for approximate, exact in zip(results["chroma"], results["numpy"])
+    )
+
+    table = Table(title=f"{num_documents} documents, {dimensions} dimensions, k={k}")
+    table.add_column("metric")
+    for name in timings:
+        table.add_column(name, justify="right")
+    for metric in timings["chroma"]:
+        table.add_row(metric, *[f"{timings[name][metric]:.2f}" for name in timings])
+    console.print(table)
+    console.print(f"recall@{k} of chroma against the exact search: {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Keyword search over the chunks of a store.
+A question that names a company, a paper or a tool is often missed by
+the vector search. The BM25 index finds the chunks with the exact words
+and its results are fused with the results of the vector search.
+"""
+
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from heapq import nlargest
+from pathlib import Path
+from typing import Hashable, Iterable, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+INDEX_FILENAME = "bm25_index.json"
+INDEX_VERSION = 1
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits the text into lower cased words
+
+    Parameters
+    ----------
+    text : str
+        The text
+
+    Returns
+    -------
+    list[str]
+        The words of the text
+    """
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """An inverted index of the chunks that is ranked with BM25
+
+        Parameters
+        ----------
+        k1 : float, optional
+            How quickly the score saturates as a word repeats
+            in a chunk, by default 1.5
+        b : float, optional
+            How much the long chunks are penalized, by default 0.75
+        """
+        self.k1 = k1
+        self.b = b
+
+        # id -> (page content, metadata, term frequencies, length)
+        self._documents: dict[str, tuple[str, dict, dict[str, int], int]] = {}
+        # term -> id -> term frequency
+        self._postings: dict[str, dict[str, int]] = defaultdict(dict)
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def _add(self, id_: str, page_content: str, metadata: dict, terms: dict[str, int]):
+        if id_ in self._documents:
+            self._remove(id_)
+        length = sum(terms.values())
+        self._documents[id_] = (page_content, metadata, terms, length)
+        self._total_length += length
+        for term, frequency in terms.items():
+            self._postings[term][id_] = frequency
+
+    def _remove(self, id_: str):
+        _, _, terms, length = self._documents.pop(id_)
+        self._total_length -= length
+        for term in terms:
+            postings = self._postings[term]
+            postings.pop(id_, None)
+            if not postings:
+                del self._postings[term]
+
+    def add_documents(self, documents: Iterable[Document], ids: Iterable[str]):
+        """Adds the documents to the index. The documents with
+        an id that is already in the index replace the older ones
+
+        Parameters
+        ----------
+        documents : Iterable[Document]
+            The documents
+        ids : Iterable[str]
+            The ids of the documents in the vector store
+        """
+        entries = [
+            (id_, document, Counter(tokenize(document.page_content)))
+            for document, id_ in zip(documents, ids)
+        ]
+        with self._lock:
+            for id_, document, terms in entries:
+                self._add(id_, document.page_content, document.metadata, dict(terms))
+
+    def delete(self, ids: Iterable[str]):
+        """Removes the documents from the index"""
+        with self._lock:
+            for id_ in ids:
+                if id_ in self._documents:
+                    self._remove(id_)
+
+    def search(self, query: str, k: int = 6) -> list[tuple[Document, float]]:
+        """Returns the documents that match the words of the query best
+
+        Parameters
+        ----------
+        query : str
+            The query
+        k : int, optional
+            The number of documents to return, by default 6
+
+        Returns
+        -------
+        list[tuple[Document, float]]
+            The documents with their BM25 scores, the best first.
+            Only the documents with at least one word of the query are returned
+        """
+        with self._lock:
+            num_documents = len(self._documents)
+            if num_documents == 0:
+                return []
+            average_length = self._total_length / num_documents
+
+            scores: dict[str, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                frequency = len(postings)
+                idf = math.log(
+                    1 + (num_documents - frequency + 0.5) / (frequency + 0.5)
+                )
+                for id_, term_frequency in postings.items():
+                    length = self._documents[id_][3]
+                    scores[id_] += (
+                        idf
+                        * term_frequency
+                        * (self.k1 + 1)
+                        / (
+                            term_frequency
+                            + self.k1 * (1 - self.b + self.b * length / average_length)
+                        )
+                    )
+
+            top = nlargest(k, scores.items(), key=lambda item: item[1])
+            return [
+                (
+                    Document(
+                        page_content=self._documents[id_][0],
+                        metadata=self._documents[id_][1],
+                    ),
+                    score,
+                )
+                for id_, score in top
+            ]
+
+    def save(self, directory: str):
+        """Writes the index into the store directory
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the vector store
+        """
+        with self._lock:
+            documents = {
+                id_: {"page_content": entry[0], "metadata": entry[1], "terms": entry[2]}
+                for id_, entry in self._documents.items()
+            }
+        data = {
+            "version": INDEX_VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "documents": documents,
+        }
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        path = Path(directory, INDEX_FILENAME)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(data, fp)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["BM25Index"]:
+        """Reads the index from the store directory
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the vector store
+
+        Returns
+        -------
+        Optional[BM25Index]
+            The index. None if the store has no index
+            or the index cannot be read
+        """
+        path = Path(directory, INDEX_FILENAME)
+        if not path.is_file():
+            return None
+
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        if data.get("version") != INDEX_VERSION:
+            return None
+
+        index = cls(k1=data["k1"], b=data["b"])
+        for id_, entry in data["documents"].items():
+            index._add(id_, entry["page_content"], entry["metadata"], entry["terms"])
+        return index
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return Path(directory, INDEX_FILENAME).is_file()
+
+
+def _document_key(document: Document) -> Hashable:
+    # The chunks do not carry their ids. A chunk is identified
+    # by its file, its position in the file and its content
+    metadata = document.metadata
+    return (
+        metadata.get("filename", metadata.get("source")),
+        metadata.get("start_index"),
+        document.page_content,
+    )
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[Document]], k: int = 60
+) -> list[Document]:
+    """Fuses the rankings of many retrievers. Every document is
+    scored by the sum of 1 / (k + rank) over the rankings
+
+    Parameters
+    ----------
+    rankings : list[list[Document]]
+        The documents returned by every retriever, the best first
+    k : int, optional
+        Dampens the advantage of the top ranks, by default 60
+
+    Returns
+    -------
+    list[Document]
+        The documents of all the rankings, the best first
+    """
+    scores: dict[Hashable, float] = defaultdict(float)
+    documents: dict[Hashable, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = _document_key(document)
+            scores[key] += 1 / (k + rank)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Retrieves the chunks with both the vector search and the keyword
+    search and fuses the two rankings with reciprocal rank fusion"""
+
+    vector_store: VectorStore
+    keyword_index: BM25Index
+    k: int = 6
+    # The number of candidates that are fetched from each search
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    def _fuse(self, vector_documents: list[Document], query: str) -> list[Document]:
+        keyword_documents = [
+            document for document, _ in self.keyword_index.search(query, self.fetch_k)
+        ]
+        fused = reciprocal_rank_fusion(
+            [vector_documents, keyword_documents], k=self.rrf_k
+        )
+        return fused[: self.k]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector_documents = self.vector_store.similarity_search(query, k=self.fetch_k)
+        return self._fuse(vector_documents, query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector_documents = await self.vector_store.asimilarity_search(
+            query, k=self.fetch_k
+        )
+        return self._fuse(vector_documents, query)
@@ -0,0 +1,121 @@
+import tempfile
+
+import click
+from rich.console import Console
+from rich.table import Table
+
+from knowme.benchmarks.suite import run_suite, write_results
+
+console = Console()
+
+
+def _rows(prefix: str, results: dict) -> list[tuple[str, str]]:
+    # Flattens the nested results into (metric, value) rows
+    rows = []
+    for name, value in results.items():
+        metric = f"{prefix}.{name}" if prefix else name
+        if isinstance(value, dict):
+            rows.extend(_rows(metric, value))
+        elif isinstance(value, float):
+            rows.append((metric, f"{value:.2f}"))
+        else:
+            rows.append((metric, str(value)))
+    return rows
+
+
+@click.command()
+@click.option("--num-pages", type=int, default=50, help="Pages in the Notion export")
+@click.option(
+    "--paragraphs-per-page", type=int, default=10, help="Paragraphs in every page"
+)
+@click.option("--cv-pages", type=int, default=2, help="Pages in the CV")
+@click.option("--num-questions", type=int, default=20, help="Questions per chain")
+@click.option("--dimensions", type=int, default=1536, help="The size of the vectors")
+@click.option(
+    "--vector-store",
+    "vector_stores",
+    type=click.Choice(["chroma", "numpy"]),
+    multiple=True,
+    help="The vector stores to benchmark. All of them by default",
+)
+@click.option("--workers", type=int, default=4, help="Workers of parallel ingestion")
+@click.option(
+    "--llm-latency",
+    type=float,
+    default=0.0,
+    help="Seconds the fake model waits before the first token",
+)
+@click.option(
+    "--token-latency",
+    type=float,
+    default=0.0,
+    help="Seconds the fake model waits between the tokens",
+)
+@click.option("--notion-zip", is_flag=True, help="Ingest the export from a zip file")
+@click.option("--seed", type=int, default=0, help="Seeds the synthetic corpus")
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Where the corpus and stores are written. A temporary directory by default",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    default="knowme_bench.json",
+    help="The json file the results are written to",
+)
+def bench(
+    num_pages,
+    paragraphs_per_page,
+    cv_pages,
+    num_questions,
+    dimensions,
+    vector_stores,
+    workers,
+    llm_latency,
+    token_latency,
+    notion_zip,
+    seed,
+    work_dir,
+    output,
+):
+    """Benchmark the ingestion, the stores and the chains offline
+
+    No OpenAI calls are made. A synthetic Notion export and CV are
+    generated, the embeddings are seeded by the text and the chat
+    model answers with a fixed text
+    """
+    parameters = dict(
+        num_pages=num_pages,
+        paragraphs_per_page=paragraphs_per_page,
+        cv_pages=cv_pages,
+        num_questions=num_questions,
+        dimensions=dimensions,
+        vector_stores=list(vector_stores) or None,
+        num_workers=workers,
+        llm_latency=llm_latency,
+        token_latency=token_latency,
+        notion_zip=notion_zip,
+        seed=seed,
+    )
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run_suite(directory, **parameters)
+    else:
+        results = run_suite(work_dir, **parameters)
+
+    write_results(results, output)
+
+    for section in ("ingest", "stores", "chains"):
+        table = Table(title=section)
+        table.add_column("metric")
+        table.add_column("value", justify="right")
+        for metric, value in _rows("", results[section]):
+            table.add_row(metric, value)
+        console.print(table)
+    console.print(f"[green] Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -1,6 +1,8 @@
 import click
 from art import tprint
+from knowme.commands.bench import bench
 from knowme.commands.download import download
+from knowme.commands.serve import serve
 from knowme.commands.setup import setup
 
 
@@ -14,6 +16,8 @@ def main():
     tprint("KNOW ME")
     knowme.add_command(download)
     knowme.add_command(setup)
+    knowme.add_command(bench)
+    knowme.add_command(serve)
     knowme()
 
 
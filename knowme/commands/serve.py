@@ -0,0 +1,164 @@
+import os
+
+import click
+from dotenv import load_dotenv
+from rich.console import Console
+
+from knowme.instrumentation import default_instrumentation
+from knowme.load_chains import load_sources
+from knowme.profiles import ProfileRegistry
+
+load_dotenv()
+
+console = Console()
+
+
+@click.command()
+@click.option("--host", type=str, default="127.0.0.1", help="The host to bind")
+@click.option("--port", type=int, default=8000, help="The port to bind")
+@click.option(
+    "--notion",
+    "notion_path",
+    type=click.Path(exists=True),
+    default=None,
+    help="The folder or the .zip file of the Notion export",
+)
+@click.option(
+    "--cv",
+    "cv_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="The CV in .pdf format",
+)
+@click.option(
+    "--profiles",
+    "profiles_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='A json file that maps every profile id to its "notion" and "cv"',
+)
+@click.option(
+    "--memory-budget-mb",
+    type=int,
+    default=2048,
+    help="The size of the open profiles beyond which the idle ones are closed",
+)
+@click.option(
+    "--max-idle-seconds",
+    type=float,
+    default=None,
+    help="Close the profiles that have not been used for this long",
+)
+@click.option(
+    "--stores-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Where the vector stores are kept. STORES_DIR by default",
+)
+@click.option(
+    "--vector-store",
+    type=click.Choice(["chroma", "numpy"]),
+    default="chroma",
+    help="The kind of vector store",
+)
+@click.option("--openai-model", type=str, default="gpt-4", help="The chat model")
+@click.option(
+    "--cv-extraction",
+    type=click.Choice(["unstructured", "fast"]),
+    default="unstructured",
+    help='How the CVs are read. "fast" reads the text layer of the pdf',
+)
+@click.option(
+    "--fan-out", is_flag=True, help="The agent asks both sources concurrently"
+)
+@click.option(
+    "--query-batch-window-ms",
+    type=float,
+    default=None,
+    help="Embed the queries that arrive within this window with one request",
+)
+@click.option(
+    "--query-batch-size", type=int, default=64, help="The most queries in a request"
+)
+@click.option(
+    "--metrics-log",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the timings of every answer to this json lines file",
+)
+def serve(
+    host,
+    port,
+    notion_path,
+    cv_path,
+    profiles_path,
+    memory_budget_mb,
+    max_idle_seconds,
+    stores_dir,
+    vector_store,
+    openai_model,
+    cv_extraction,
+    fan_out,
+    query_batch_window_ms,
+    query_batch_size,
+    metrics_log,
+):
+    """Serve the chats over HTTP, with the answers streamed as server-sent events"""
+    # The server is an optional extra of the package
+    import uvicorn
+
+    from knowme.server import create_app
+
+    if notion_path is None and cv_path is None and profiles_path is None:
+        raise click.UsageError(
+            "Pass the Notion export with --notion, --cv, both or --profiles"
+        )
+
+    stores_dir = stores_dir or os.environ.get("STORES_DIR")
+    if stores_dir is None:
+        raise click.UsageError(
+            "Pass --stores-dir or run `knowme setup directories` first"
+        )
+
+    if metrics_log is not None:
+        default_instrumentation.log_path = metrics_log
+
+    chains = {}
+    if notion_path is not None or cv_path is not None:
+        with console.status("Loading the chains"):
+            chains = load_sources(
+                stores_dir=stores_dir,
+                notion_path=notion_path,
+                cv_path=cv_path,
+                vector_store=vector_store,
+                openai_model=openai_model,
+                fan_out=fan_out,
+                instrumentation=default_instrumentation,
+                query_batch_window_ms=query_batch_window_ms,
+                query_batch_size=query_batch_size,
+                cv_extraction=cv_extraction,
+            )
+        console.print(f"[green] Serving {', '.join(sorted(chains))} on {host}:{port}")
+
+    profiles = None
+    if profiles_path is not None:
+        # The profiles are opened by their first request
+        profiles = ProfileRegistry(
+            stores_dir=stores_dir,
+            memory_budget_bytes=memory_budget_mb * 1024 * 1024,
+            max_idle_seconds=max_idle_seconds,
+            vector_store=vector_store,
+            openai_model=openai_model,
+            fan_out=fan_out,
+            query_batch_window_ms=query_batch_window_ms,
+            query_batch_size=query_batch_size,
+            instrumentation=default_instrumentation,
+            cv_extraction=cv_extraction,
+        )
+        profiles.register_from_file(profiles_path)
+        console.print(
+            f"[green] Serving {len(profiles.profiles())} profiles on {host}:{port}"
+        )
+
+    app = create_app(chains, instrumentation=default_instrumentation, profiles=profiles)
+    uvicorn.run(app, host=host, port=port)
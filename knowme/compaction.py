@@ -0,0 +1,179 @@
+"""
+Compacts the retrieved chunks before they are stuffed into the prompt.
+The chunks overlap with their neighbours, so the hits from the same
+file repeat text. The overlapping and adjacent chunks of a file are
+merged, the near duplicates are dropped and the context is capped by
+a token budget.
+"""
+
+import re
+from typing import Callable, Hashable, Optional
+
+from langchain_core.documents import Document
+
+
+def estimate_text_tokens(text: str) -> int:
+    """A cheap estimate of the number of tokens in the text.
+    This is about four characters per token for English text"""
+    return len(text) // 4
+
+
+def _source(document: Document) -> Optional[Hashable]:
+    return document.metadata.get("filename", document.metadata.get("source"))
+
+
+def _words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+class ContextCompactor:
+    def __init__(
+        self,
+        max_tokens: Optional[int] = 2000,
+        duplicate_threshold: float = 0.9,
+        merge_gap: int = 2,
+        token_counter: Callable[[str], int] = estimate_text_tokens,
+    ):
+        """Merges, deduplicates and packs the retrieved chunks
+
+        Parameters
+        ----------
+        max_tokens : Optional[int], optional
+            The token budget of the context, by default 2000
+            The best ranked chunks that fit are kept. The first chunk is
+            always kept. There is no budget if this is None
+        duplicate_threshold : float, optional
+            The chunks whose words overlap this much with a chunk that is
+            ranked higher are dropped, by default 0.9
+        merge_gap : int, optional
+            The chunks of a file that are at most these many characters
+            apart are merged, by default 2. The splitter strips the
+            whitespace between the chunks
+        token_counter : Callable[[str], int], optional
+            Counts the tokens of a text, by default `estimate_text_tokens`
+        """
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.merge_gap = merge_gap
+        self.token_counter = token_counter
+
+    def merge(self, documents: list[Document]) -> list[Document]:
+        """Merges the overlapping and adjacent chunks of every file
+
+        Parameters
+        ----------
+        documents : list[Document]
+            The retrieved chunks, the best first
+
+        Returns
+        -------
+        list[Document]
+            The merged chunks. A merged chunk takes the rank
+            of the best of its chunks
+        """
+        # (rank, document) of the chunks that can be merged per file
+        groups: dict[Hashable, list[tuple[int, Document]]] = {}
+        merged: list[tuple[int, Document]] = []
+        for rank, document in enumerate(documents):
+            source = _source(document)
+            if source is None or "start_index" not in document.metadata:
+                merged.append((rank, document))
+            else:
+                groups.setdefault(source, []).append((rank, document))
+
+        for chunks in groups.values():
+            chunks.sort(key=lambda chunk: chunk[1].metadata["start_index"])
+            rank, current = chunks[0]
+            text = current.page_content
+            # The position in the file where the merged chunk ends
+            end = current.metadata["start_index"] + len(text)
+            for next_rank, document in chunks[1:]:
+                start = document.metadata["start_index"]
+                if start > end + self.merge_gap:
+                    merged.append(
+                        (rank, Document(page_content=text, metadata=current.metadata))
+                    )
+                    rank, current, text = next_rank, document, document.page_content
+                    end = start + len(text)
+                    continue
+
+                # The text of the next chunk that is already
+                # in the merged chunk is skipped
+                if start <= end:
+                    text += document.page_content[end - start :]
+                else:
+                    text += "\n" + document.page_content
+                end = max(end, start + len(document.page_content))
+                rank = min(rank, next_rank)
+            merged.append(
+                (rank, Document(page_content=text, metadata=current.metadata))
+            )
+
+        merged.sort(key=lambda chunk: chunk[0])
+        return [document for _, document in merged]
+
+    def deduplicate(self, documents: list[Document]) -> list[Document]:
+        """Drops the chunks that are near duplicates of a chunk ranked higher
+
+        Parameters
+        ----------
+        documents : list[Document]
+            The chunks, the best first
+
+        Returns
+        -------
+        list[Document]
+            The chunks without the near duplicates
+        """
+        kept: list[tuple[Document, set[str]]] = []
+        for document in documents:
+            words = _words(document.page_content)
+            is_duplicate = any(
+                words
+                and len(words & kept_words) / len(words | kept_words)
+                >= self.duplicate_threshold
+                for _, kept_words in kept
+            )
+            if not is_duplicate:
+                kept.append((document, words))
+        return [document for document, _ in kept]
+
+    def pack(self, documents: list[Document]) -> list[Document]:
+        """Keeps the best ranked chunks that fit in the token budget
+
+        Parameters
+        ----------
+        documents : list[Document]
+            The chunks, the best first
+
+        Returns
+        -------
+        list[Document]
+            The chunks that fit. The first chunk is always kept
+        """
+        if self.max_tokens is None or not documents:
+            return documents
+
+        packed = [documents[0]]
+        used = self.token_counter(documents[0].page_content)
+        for document in documents[1:]:
+            tokens = self.token_counter(document.page_content)
+            if used + tokens <= self.max_tokens:
+                packed.append(document)
+                used += tokens
+        return packed
+
+    def compact(self, documents: list[Document]) -> list[Document]:
+        """Merges, deduplicates and packs the retrieved chunks
+
+        Parameters
+        ----------
+        documents : list[Document]
+            The retrieved chunks, the best first
+
+        Returns
+        -------
+        list[Document]
+            The chunks that are stuffed into the prompt
+        """
+        return self.pack(self.deduplicate(self.merge(documents)))
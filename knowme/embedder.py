@@ -1,16 +1,86 @@
-from typing import Optional
+import gc
+import hashlib
+import shutil
+import threading
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Union
+from chromadb.api.client import SharedSystemClient
 from langchain_chroma import Chroma
 from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore
 from pathlib import Path
 from langchain_core.documents import Document
 
+from rich.progress import Progress
+
+from knowme.bm25 import BM25Index
+from knowme.manifest import StoreManifest, embedding_name
+from knowme.numpy_store import NumpyVectorStore
+
+if TYPE_CHECKING:
+    from knowme.ingest import NotionIngestor
+
+# Either the documents or a function that produces them when called.
+# A function lets the ingestion be skipped when the store is reused
+Documents = Union[Iterable[Document], Callable[[], Iterable[Document]]]
+
+
+# The stores that are open in the process, by their directory. The chains
+# hold their store, so a directory is in use while one of its stores is alive
+_open_stores: dict[str, weakref.WeakSet] = {}
+_open_stores_lock = threading.Lock()
+
+
+def _directory_key(embedding_store_directory: str) -> str:
+    return str(Path(embedding_store_directory).resolve())
+
+
+def is_store_in_use(embedding_store_directory: str) -> bool:
+    """Whether a store of the directory is held by a chain of the process
+
+    Parameters
+    ----------
+    embedding_store_directory : str
+        The directory of the store
+
+    Returns
+    -------
+    bool
+        True if a store that was opened from the directory is still alive
+    """
+    key = _directory_key(embedding_store_directory)
+    with _open_stores_lock:
+        if not _open_stores.get(key):
+            return False
+    # The chains of an evicted profile might only be
+    # freed by the garbage collector
+    gc.collect()
+    with _open_stores_lock:
+        return bool(_open_stores.get(key))
+
+
+class StoreInUseError(RuntimeError):
+    """Raised instead of removing a store that a chain of the process holds"""
+
+
+class Embedder(ABC):
+    # The name of the kind of store. It is recorded in the manifest
+    # so that a store directory is not opened as another kind of store
+    store_type: str = ""
 
-class ChromaEmbedder:
     def __init__(
         self,
         embedding_function: Embeddings,
         embedding_store_directory: Optional[str],
+        batch_size: int = 64,
+        max_concurrency: int = 4,
+        show_progress: bool = False,
+        keyword_index: bool = False,
     ):
         """This stores the embedding of the documents into a vector store
         This only considers the RecursiveCharacterTextSplitter for now
@@ -25,44 +95,539 @@ class ChromaEmbedder:
             store the emebeddings in this store. Further calls to the
             `store_embeddings` will retrieve the store from this
             directory
+        batch_size: int
+            The number of documents that are embedded in one request
+            and written to the store together, by default 64
+        max_concurrency: int
+            The maximum number of embedding requests in flight, by default 4
+            The memory used while building the store is bounded by
+            batch_size * max_concurrency documents
+        show_progress: bool
+            Show a progress bar while the documents are embedded,
+            by default False
+        keyword_index: bool
+            Build a BM25 index of the documents next to the store,
+            by default False. The index is available as `self.keyword_index`
+            once the store has been built or loaded. It keeps the text of
+            the documents, so it is only built for the hybrid search
         """
+        if batch_size < 1 or max_concurrency < 1:
+            raise ValueError("batch_size and max_concurrency should be at least 1")
+
         self.embedding_function = embedding_function
         self.embedding_store_directory = embedding_store_directory
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.show_progress = show_progress
+        self.build_keyword_index = keyword_index
+        self.keyword_index: Optional[BM25Index] = None
+
+    def is_store_valid(self, manifest: Optional[StoreManifest]) -> bool:
+        """Whether the persisted store can be reused
+
+        Parameters
+        ----------
+        manifest : Optional[StoreManifest]
+            The manifest describing the store that is expected.
+            If None, any existing store directory is reused
+
+        Returns
+        -------
+        bool
+            True if the store directory exists and it was
+            built from the same source
+        """
+        if not self.embedding_store_directory:
+            return False
+
+        if not Path(self.embedding_store_directory).is_dir():
+            return False
+
+        if manifest is None:
+            return True
+
+        stored_manifest = StoreManifest.load(self.embedding_store_directory)
+        return stored_manifest is not None and stored_manifest.matches(manifest)
+
+    def _load_keyword_index(self, vectorstore: VectorStore):
+        """Loads the keyword index of the persisted store. The index
+        is rebuilt from the documents in the store if it is missing,
+        so the embeddings are not computed again
+
+        Parameters
+        ----------
+        vectorstore : VectorStore
+            The opened store
+        """
+        if not self.build_keyword_index:
+            self.keyword_index = None
+            return
+        self.keyword_index = BM25Index.load(self.embedding_store_directory)
+        if self.keyword_index is not None:
+            return
+
+        print("the keyword index is missing. rebuilding it from the store")
+        documents, ids = self._stored_documents(vectorstore)
+        self.keyword_index = BM25Index()
+        self.keyword_index.add_documents(documents, ids)
+        self._save_keyword_index()
 
-    def store_embeddings(self, documents: list[Document]) -> VectorStore:
+    def _save_keyword_index(self):
+        if self.keyword_index is not None and self.embedding_store_directory:
+            self.keyword_index.save(self.embedding_store_directory)
+
+    def store_version(self) -> Optional[str]:
+        """The version of the persisted store. This changes
+        every time the store is built or updated
+
+        Returns
+        -------
+        Optional[str]
+            The time at which the store was last written.
+            None if the store has no manifest
+        """
+        if not self.embedding_store_directory:
+            return None
+
+        manifest = StoreManifest.load(self.embedding_store_directory)
+        if manifest is None:
+            return None
+        return manifest.created_at
+
+    def store_embeddings(
+        self, documents: Documents, source: Optional[dict[str, Any]] = None
+    ) -> VectorStore:
         """This creates the vector store from the embeddings and then returns it
-        Either the mebeddings are created based on the texts and metadatas that
+        Either the mebeddings are created based on the documents that
         you pass or loaded from the directory
+
         Parameters
         ----------
-        texts : list[str]
-            The list of strings that has been ingested.
-        metadatas : Optional[list[dict]]
-            Metadata associated with the text
+        documents : Documents
+            The list of documents that has been ingested. This can also be
+            a function that returns the documents. The function is
+            called only if the store has to be built
+        source : Optional[dict[str, Any]], optional
+            A description of the source of the documents, by default None
+            When provided, a manifest is stored with the store and the
+            store is only reused if it was built from the same source
 
         Returns
         -------
         VectorStore
             Vector store that can be used to retrieve documents
         """
+        manifest = None
+        if source is not None:
+            manifest = StoreManifest(
+                source=source,
+                embedding=embedding_name(self.embedding_function),
+                store=self.store_type,
+            )
+
+        # If the store has been built from the same source
+        # just load the embeddings. Otherwise, create the embeddings
+        # and store them.
+        if self.is_store_valid(manifest):
+            vectorstore = self._track(self._open_store())
+            self._load_keyword_index(vectorstore)
+            return vectorstore
 
-        # If the user has provided a directory to store
-        # and there is no such directory, then we create the embeddings
-        # and store them. otherwise, you just load the embeddings
         if (
             self.embedding_store_directory
-            and not Path(self.embedding_store_directory).is_dir()
+            and Path(self.embedding_store_directory).is_dir()
         ):
-            print("creating the embedding store")
-            vectorstore = Chroma.from_documents(
-                documents=documents,
-                embedding=self.embedding_function,
-                persist_directory=self.embedding_store_directory,
+            print("the embedding store is stale. rebuilding it")
+            self._remove_store()
+
+        if callable(documents):
+            documents = documents()
+
+        print("creating the embedding store")
+        vectorstore = self._track(self._open_store())
+        self.keyword_index = BM25Index() if self.build_keyword_index else None
+        num_documents = self.add_documents(vectorstore, documents)
+        self._save_keyword_index()
+
+        # The manifest is written last. A store that was only
+        # partially built does not have a manifest and is rebuilt
+        if manifest is not None and self.embedding_store_directory:
+            manifest.num_documents = num_documents
+            manifest.save(self.embedding_store_directory)
+
+        return vectorstore
+
+    def _track(self, vectorstore: VectorStore) -> VectorStore:
+        # Records the store as open until it is garbage collected
+        if self.embedding_store_directory:
+            key = _directory_key(self.embedding_store_directory)
+            with _open_stores_lock:
+                _open_stores.setdefault(key, weakref.WeakSet()).add(vectorstore)
+        return vectorstore
+
+    def _ensure_not_in_use(self):
+        if is_store_in_use(self.embedding_store_directory):
+            raise StoreInUseError(
+                f"The store {self.embedding_store_directory} is stale but it is "
+                "used by a loaded chain. It is not removed under the chain"
             )
-        else:
-            return Chroma(
-                persist_directory=str(self.embedding_store_directory),
-                embedding_function=self.embedding_function,
+
+    @abstractmethod
+    def _open_store(self) -> VectorStore:
+        """Opens the store in the store directory. An empty
+        store is created if the directory has no store"""
+
+    @abstractmethod
+    def _write_batch(
+        self,
+        vectorstore: VectorStore,
+        documents: list[Document],
+        ids: list[str],
+        embeddings: list[list[float]],
+    ):
+        """Writes the documents with their embeddings to the store"""
+
+    @abstractmethod
+    def _existing_ids(self, vectorstore: VectorStore, ids: list[str]) -> list[str]:
+        """The ids that are in the store"""
+
+    @abstractmethod
+    def _stored_documents(
+        self, vectorstore: VectorStore
+    ) -> tuple[list[Document], list[str]]:
+        """All the documents in the store with their ids"""
+
+    def _flush(self, vectorstore: VectorStore):
+        """Persists the documents that were written to the store"""
+
+    def _remove_store(self):
+        """Deletes the store directory before the store is rebuilt"""
+        self._ensure_not_in_use()
+        shutil.rmtree(self.embedding_store_directory)
+
+    def add_documents(
+        self,
+        vectorstore: VectorStore,
+        documents: Iterable[Document],
+        ids: Optional[Iterable[str]] = None,
+    ) -> int:
+        """Embeds the documents in batches and writes them to the store.
+        Up to `max_concurrency` batches are embedded concurrently and
+        the batches are written to the store in order as they are embedded.
+        The documents are also added to the keyword index if there is one
+
+        Parameters
+        ----------
+        vectorstore : VectorStore
+            The store to write the documents to
+        documents : Iterable[Document]
+            The documents. This can be a generator
+        ids : Optional[Iterable[str]], optional
+            The ids of the documents, by default None
+            Random ids are used if this is not provided
+
+        Returns
+        -------
+        int
+            The number of documents that were written
+        """
+        documents = iter(documents)
+        ids = iter(ids) if ids is not None else None
+
+        def batches():
+            while batch := list(islice(documents, self.batch_size)):
+                if ids is None:
+                    batch_ids = [str(uuid.uuid4()) for _ in batch]
+                else:
+                    batch_ids = list(islice(ids, len(batch)))
+                yield batch, batch_ids
+
+        num_documents = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor, Progress(
+            disable=not self.show_progress, transient=True
+        ) as progress:
+            task = progress.add_task("Embedding documents", total=None)
+            in_flight = deque()
+
+            def write_oldest():
+                future, batch, batch_ids = in_flight.popleft()
+                self._write_batch(vectorstore, batch, batch_ids, future.result())
+                if self.keyword_index is not None:
+                    self.keyword_index.add_documents(batch, batch_ids)
+                progress.advance(task, len(batch))
+                return len(batch)
+
+            for batch, batch_ids in batches():
+                texts = [document.page_content for document in batch]
+                future = executor.submit(self.embedding_function.embed_documents, texts)
+                in_flight.append((future, batch, batch_ids))
+                if len(in_flight) >= self.max_concurrency:
+                    num_documents += write_oldest()
+
+            while in_flight:
+                num_documents += write_oldest()
+
+        self._flush(vectorstore)
+        return num_documents
+
+    def sync_embeddings(self, ingestor: "NotionIngestor") -> VectorStore:
+        """Incrementally updates the store from a notion export.
+        Only the markdown files that were added or changed since the
+        last sync are embedded. The chunks of changed and removed files
+        are deleted from the store.
+
+        Parameters
+        ----------
+        ingestor : NotionIngestor
+            The ingestor of the notion export
+
+        Returns
+        -------
+        VectorStore
+            Vector store that can be used to retrieve documents
+        """
+        if not self.embedding_store_directory:
+            raise ValueError("Incremental indexing requires a store directory")
+
+        source = ingestor.source_info()
+        manifest = StoreManifest(
+            source=source,
+            embedding=embedding_name(self.embedding_function),
+            store=self.store_type,
+        )
+        stored_manifest = StoreManifest.load(self.embedding_store_directory)
+
+        # Nothing has changed since the last sync
+        if (
+            stored_manifest is not None
+            and stored_manifest.files is not None
+            and stored_manifest.matches(manifest)
+        ):
+            vectorstore = self._track(self._open_store())
+            self._load_keyword_index(vectorstore)
+            return vectorstore
+
+        # The files can be reused only if the store was
+        # built from the same export with the same splitter and embeddings
+        previous_files = {}
+        is_incremental = (
+            stored_manifest is not None
+            and stored_manifest.files is not None
+            and stored_manifest.embedding == manifest.embedding
+            and stored_manifest.store == manifest.store
+            and all(
+                stored_manifest.source.get(key) == source.get(key)
+                for key in ("type", "path", "splitter")
             )
+        )
+        if is_incremental:
+            previous_files = stored_manifest.files
+        else:
+            if Path(self.embedding_store_directory).is_dir():
+                print(
+                    "the embedding store cannot be updated incrementally. rebuilding it"
+                )
+                self._remove_store()
+            self.keyword_index = BM25Index() if self.build_keyword_index else None
+
+        vectorstore = self._track(self._open_store())
+        if is_incremental:
+            # The files of an empty export are reused as well
+            self._load_keyword_index(vectorstore)
+
+        files = {}
+        stale_ids = []
+        documents = []
+        ids = []
+        for relative_path, signature in sorted(ingestor.file_signatures().items()):
+            previous = previous_files.get(relative_path)
+
+            # The signature is checked before hashing the content of the
+            # file. The entries of older manifests have no signature
+            if previous is not None and previous.get("signature") == signature:
+                files[relative_path] = previous
+                continue
+
+            content = ingestor.read_file(relative_path)
+            content_hash = hashlib.sha256(content).hexdigest()
+            if previous is not None and previous["sha256"] == content_hash:
+                files[relative_path] = {
+                    "sha256": content_hash,
+                    "signature": signature,
+                    "ids": previous["ids"],
+                }
+                continue
+
+            if previous is not None:
+                stale_ids.extend(previous["ids"])
+
+            file_documents = ingestor.ingest_file(relative_path, content)
+            path_hash = hashlib.sha256(relative_path.encode()).hexdigest()[:16]
+            file_ids = [
+                f"{path_hash}-{content_hash[:16]}-{index}"
+                for index in range(len(file_documents))
+            ]
+            documents.extend(file_documents)
+            ids.extend(file_ids)
+            files[relative_path] = {
+                "sha256": content_hash,
+                "signature": signature,
+                "ids": file_ids,
+            }
+
+        for relative_path in previous_files.keys() - files.keys():
+            stale_ids.extend(previous_files[relative_path]["ids"])
+
+        print(
+            f"syncing the embedding store: {len(documents)} chunks to embed, "
+            f"{len(stale_ids)} chunks to delete"
+        )
+
+        # Chunks left behind by an earlier sync that was
+        # interrupted before writing the manifest are deleted as well
+        if ids:
+            stale_ids.extend(self._existing_ids(vectorstore, ids))
+
+        if stale_ids:
+            vectorstore.delete(ids=stale_ids)
+            if self.keyword_index is not None:
+                self.keyword_index.delete(stale_ids)
+
+        if documents:
+            self.add_documents(vectorstore, documents, ids=ids)
+        self._save_keyword_index()
+
+        manifest.files = files
+        manifest.num_documents = sum(len(entry["ids"]) for entry in files.values())
+        manifest.save(self.embedding_store_directory)
 
         return vectorstore
+
+
+def release_chroma_client(embedding_store_directory: str) -> bool:
+    """Stops the Chroma client of a store directory. Chroma keeps the
+    client of every directory that was opened until the process exits.
+    The client is opened again by the next store of the directory
+
+    Parameters
+    ----------
+    embedding_store_directory : str
+        The directory of the store
+
+    Returns
+    -------
+    bool
+        True if a client of the directory was open
+    """
+    system = SharedSystemClient._identifier_to_system.pop(
+        str(embedding_store_directory), None
+    )
+    if system is None:
+        return False
+    system.stop()
+    return True
+
+
+class ChromaEmbedder(Embedder):
+    """Stores the embeddings in a persistent Chroma collection"""
+
+    store_type = "chroma"
+
+    def _open_store(self) -> VectorStore:
+        return Chroma(
+            persist_directory=(
+                str(self.embedding_store_directory)
+                if self.embedding_store_directory
+                else None
+            ),
+            embedding_function=self.embedding_function,
+        )
+
+    def _write_batch(
+        self,
+        vectorstore: Chroma,
+        documents: list[Document],
+        ids: list[str],
+        embeddings: list[list[float]],
+    ):
+        # Chroma does not accept empty metadata. The documents
+        # without metadata are written separately
+        with_metadata = [index for index, doc in enumerate(documents) if doc.metadata]
+        without_metadata = [
+            index for index, doc in enumerate(documents) if not doc.metadata
+        ]
+        if with_metadata:
+            vectorstore._collection.upsert(
+                ids=[ids[index] for index in with_metadata],
+                embeddings=[embeddings[index] for index in with_metadata],
+                metadatas=[documents[index].metadata for index in with_metadata],
+                documents=[documents[index].page_content for index in with_metadata],
+            )
+        if without_metadata:
+            vectorstore._collection.upsert(
+                ids=[ids[index] for index in without_metadata],
+                embeddings=[embeddings[index] for index in without_metadata],
+                documents=[documents[index].page_content for index in without_metadata],
+            )
+
+    def _existing_ids(self, vectorstore: Chroma, ids: list[str]) -> list[str]:
+        return vectorstore.get(ids=ids, include=[])["ids"]
+
+    def _stored_documents(
+        self, vectorstore: Chroma
+    ) -> tuple[list[Document], list[str]]:
+        stored = vectorstore.get(include=["documents", "metadatas"])
+        metadatas = stored["metadatas"] or [None] * len(stored["ids"])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(stored["documents"], metadatas)
+        ]
+        return documents, stored["ids"]
+
+    def _remove_store(self):
+        self._ensure_not_in_use()
+        # Chroma caches the client of a directory in the process. A
+        # client of the deleted directory cannot write to the new one.
+        # The clients of the other directories are left open
+        release_chroma_client(self.embedding_store_directory)
+        super()._remove_store()
+
+
+class NumpyEmbedder(Embedder):
+    """Stores the embeddings in a memory mapped numpy matrix.
+    This is faster to open and to search than Chroma for the few
+    thousand chunks of a profile"""
+
+    store_type = "numpy"
+
+    def _open_store(self) -> VectorStore:
+        return NumpyVectorStore(
+            embedding_function=self.embedding_function,
+            persist_directory=self.embedding_store_directory,
+        )
+
+    def _write_batch(
+        self,
+        vectorstore: NumpyVectorStore,
+        documents: list[Document],
+        ids: list[str],
+        embeddings: list[list[float]],
+    ):
+        # The matrix is written to disk once all the batches are added
+        vectorstore.add_embeddings(
+            texts=[document.page_content for document in documents],
+            embeddings=embeddings,
+            metadatas=[document.metadata for document in documents],
+            ids=ids,
+        )
+
+    def _existing_ids(self, vectorstore: NumpyVectorStore, ids: list[str]) -> list[str]:
+        return vectorstore.existing_ids(ids)
+
+    def _stored_documents(
+        self, vectorstore: NumpyVectorStore
+    ) -> tuple[list[Document], list[str]]:
+        return vectorstore.get_documents()
+
+    def _flush(self, vectorstore: NumpyVectorStore):
+        vectorstore.persist()
@@ -0,0 +1,212 @@
+"""
+Micro-batching of the query embeddings.
+Every retrieval embeds its query with a request of a single text. The
+queries of concurrent sessions that arrive within a small window are
+collected and embedded with one batched request instead, and every
+caller gets back its own vector.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
+
+from langchain_core.embeddings import Embeddings
+
+
+class BatchingEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        max_wait_ms: float = 10.0,
+        max_batch_size: int = 64,
+        max_concurrent_batches: int = 4,
+    ):
+        """Batches the queries that are embedded concurrently.
+        A batch is sent once `max_batch_size` queries are waiting or
+        `max_wait_ms` after its first query arrived, whichever comes first.
+        The queries are embedded with `embed_documents` of the wrapped
+        function. This gives the same vectors as `embed_query` for the
+        OpenAI embeddings, which do not treat queries differently.
+        The documents are passed through as they are batched already
+
+        Parameters
+        ----------
+        embedding_function : Embeddings
+            The embedding function whose queries are batched
+        max_wait_ms : float, optional
+            How long the first query of a batch waits for
+            others, in milliseconds, by default 10
+        max_batch_size : int, optional
+            The maximum number of queries in a batch, by default 64
+        max_concurrent_batches : int, optional
+            The number of batches that are embedded at the same time,
+            by default 4. The next batch is collected meanwhile
+        """
+        if max_batch_size < 1:
+            raise ValueError("The max_batch_size should be at least 1")
+        self.embedding_function = embedding_function
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self.max_concurrent_batches = max_concurrent_batches
+        self.num_batches = 0
+        self.num_queries = 0
+        self.largest_batch = 0
+
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._collector: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = False
+
+    def _start(self):
+        # The threads are started by the first query, so that a loaded
+        # chain that is never asked anything does not hold threads.
+        # Called with the lock held
+        if self._collector is not None:
+            return
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrent_batches,
+            thread_name_prefix="knowme-embedding-batch",
+        )
+        self._collector = threading.Thread(
+            target=self._collect,
+            args=(self._executor,),
+            name="knowme-embedding-batcher",
+            daemon=True,
+        )
+        self._collector.start()
+
+    def _collect(self, executor: ThreadPoolExecutor):
+        # The executor is passed in as `close` clears the attribute
+        # while the last batches are still being collected
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            stop = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            executor.submit(self._embed_batch, batch)
+            if stop:
+                return
+
+    def _embed_batch(self, batch: list[tuple[str, Future]]):
+        # The callers that gave up on their query are left out
+        batch = [
+            (text, future)
+            for text, future in batch
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+
+        # The same question is often asked by more than one session
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = self.embedding_function.embed_documents(texts)
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+
+        with self._lock:
+            self.num_batches += 1
+            self.num_queries += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+        vector_of = dict(zip(texts, vectors))
+        for text, future in batch:
+            future.set_result(vector_of[text])
+
+    def submit(self, text: str) -> Future:
+        """Queues a query to be embedded with the next batch
+
+        Parameters
+        ----------
+        text : str
+            The query
+
+        Returns
+        -------
+        Future
+            Resolves to the vector of the query
+
+        Raises
+        ------
+        RuntimeError
+            If the batcher is closed
+        """
+        future: Future = Future()
+        # The query is queued under the lock so that it
+        # cannot end up behind the stop sentinel of `close`
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The batcher is closed")
+            self._start()
+            self._queue.put((text, future))
+        return future
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.submit(text).result()
+
+    async def aembed_query(self, text: str) -> list[float]:
+        # The event loop is not blocked while the batch is collected
+        return await asyncio.wrap_future(self.submit(text))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embedding_function.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embedding_function.aembed_documents(texts)
+
+    def close(self):
+        """Embeds the queries that are waiting and stops the threads.
+        No query can be submitted once the batcher is closed"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            collector, executor = self._collector, self._executor
+            self._collector = None
+            self._executor = None
+            if collector is None:
+                return
+            self._queue.put(None)
+        collector.join()
+        executor.shutdown(wait=True)
+
+    def stats(self) -> dict[str, Any]:
+        """The number of batches and queries that were embedded
+
+        Returns
+        -------
+        dict[str, Any]
+            The number of batches, of queries, the mean
+            and the largest size of the batches
+        """
+        with self._lock:
+            return {
+                "batches": self.num_batches,
+                "queries": self.num_queries,
+                "mean_batch_size": (
+                    self.num_queries / self.num_batches if self.num_batches else 0.0
+                ),
+                "largest_batch": self.largest_batch,
+            }
@@ -0,0 +1,213 @@
+"""
+An on-disk cache of embeddings that wraps any embedding function.
+The embeddings are keyed by the hash of the model name and the text, so
+a chunk is embedded only once no matter which store it ends up in.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+
+from knowme.manifest import embedding_name
+
+# The maximum number of parameters in a single sqlite query
+SQLITE_MAX_PARAMS = 500
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        cache_dir: str,
+        max_size_bytes: int = 512 * 1024 * 1024,
+    ):
+        """Caches the embeddings of the wrapped embedding function on disk.
+        The vectors are stored as packed float32 values in a sqlite database.
+        The least recently used vectors are evicted when the
+        cache grows beyond `max_size_bytes`
+
+        Parameters
+        ----------
+        embedding_function : Embeddings
+            The embedding function whose embeddings are cached
+        cache_dir : str
+            The directory where the cache is stored
+        max_size_bytes : int, optional
+            The maximum size of the stored vectors, by default 512MB
+        """
+        self.embedding_function = embedding_function
+        self.model_name = embedding_name(embedding_function)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(Path(cache_dir, "embeddings.sqlite")), check_same_thread=False
+        )
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+                "ON embeddings (last_access)"
+            )
+        (self._size_bytes,) = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+
+    def _key(self, kind: str, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode()).digest()
+
+    @staticmethod
+    def _pack(vector: list[float]) -> bytes:
+        return array("f", vector).tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> list[float]:
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def _lookup(self, keys: list[bytes]) -> dict[bytes, list[float]]:
+        found = {}
+        now = time.time()
+        with self._lock, self._connection:
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                chunk = keys[start : start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = self._unpack(blob)
+                self._connection.execute(
+                    f"UPDATE embeddings SET last_access = ? WHERE key IN ({placeholders})",
+                    [now, *chunk],
+                )
+        return found
+
+    def _store(self, entries: dict[bytes, list[float]]):
+        now = time.time()
+        rows = [(key, self._pack(vector), now) for key, vector in entries.items()]
+        keys = list(entries)
+        with self._lock, self._connection:
+            # Replaced rows are already counted, so only add the size difference
+            replaced = 0
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                chunk = keys[start : start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                (size,) = self._connection.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchone()
+                replaced += size
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            self._size_bytes += sum(len(blob) for _, blob, _ in rows) - replaced
+            if self._size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict the least recently used vectors until the cache
+        # is 10% under its maximum size. This avoids evicting on every insert
+        target = int(0.9 * self.max_size_bytes)
+        cursor = self._connection.execute(
+            "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access"
+        )
+        evicted = []
+        size_bytes = self._size_bytes
+        for key, size in cursor:
+            if size_bytes <= target:
+                break
+            evicted.append((key,))
+            size_bytes -= size
+        cursor.close()
+
+        self._connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        (self._size_bytes,) = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+
+    def _embed(self, kind: str, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(kind, text) for text in texts]
+        found = self._lookup(keys)
+
+        # The same text might appear more than once in a batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing[key] = text
+
+        num_missing = sum(key not in found for key in keys)
+        with self._lock:
+            self.hits += len(keys) - num_missing
+            self.misses += num_missing
+
+        if missing:
+            if kind == "query":
+                (text,) = missing.values()
+                vectors = [self.embedding_function.embed_query(text)]
+            else:
+                vectors = self.embedding_function.embed_documents(
+                    list(missing.values())
+                )
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed("document", texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed("query", [text])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        # The lookups are quick. A miss awaits the wrapped function
+        # so that a batched query does not block the event loop
+        key = self._key("query", text)
+        found = self._lookup([key])
+        with self._lock:
+            if key in found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if key in found:
+            return found[key]
+
+        vector = await self.embedding_function.aembed_query(text)
+        self._store({key: vector})
+        return vector
+
+    def stats(self) -> dict[str, Any]:
+        """The hits and misses of the cache
+
+        Returns
+        -------
+        dict[str, Any]
+            The number of hits, misses, the hit rate
+            and the size of the stored vectors
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size_bytes": self._size_bytes,
+        }
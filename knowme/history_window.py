@@ -0,0 +1,209 @@
+"""
+Keeps the chat history that is sent to the llm within a token budget.
+The latest turns are kept as they are. The older turns are folded into
+a running summary. The summary of a session is extended with the turns
+that have aged out since the last time, instead of summarizing the
+whole conversation on every turn.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+
+def estimate_tokens(messages: Sequence[BaseMessage]) -> int:
+    """A cheap estimate of the number of tokens in the messages.
+    This is about four characters per token for English text
+    and a few tokens of overhead for every message
+
+    Parameters
+    ----------
+    messages : Sequence[BaseMessage]
+        The messages
+
+    Returns
+    -------
+    int
+        The estimated number of tokens
+    """
+    return sum(len(str(message.content)) // 4 + 4 for message in messages)
+
+
+def _message_hash(message: BaseMessage) -> str:
+    return hashlib.sha256(f"{message.type}\0{message.content}".encode()).hexdigest()
+
+
+class HistoryWindow:
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        max_tokens: int = 1500,
+        keep_last_turns: int = 3,
+        token_counter: Callable[[Sequence[BaseMessage]], int] = estimate_tokens,
+        max_sessions: int = 1000,
+    ):
+        """Fits the chat history into a token budget
+
+        Parameters
+        ----------
+        llm : BaseChatModel
+            The model that summarizes the older turns.
+            A small and fast model is enough for this
+        max_tokens : int, optional
+            The token budget of the history, by default 1500
+            The history is sent as it is while it is within the budget
+        keep_last_turns : int, optional
+            The number of latest turns that are kept as they are, by default 3
+        token_counter : Callable[[Sequence[BaseMessage]], int], optional
+            Counts the tokens of the messages, by default `estimate_tokens`
+        max_sessions : int, optional
+            The number of sessions whose summaries are kept, by default 1000
+        """
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.keep_last_turns = keep_last_turns
+        self.token_counter = token_counter
+        self.max_sessions = max_sessions
+
+        self.summary_prompt = ChatPromptTemplate.from_messages(
+            [
+                (
+                    "system",
+                    "Progressively summarize a conversation about a candidate. "
+                    "Extend the current summary with the new lines of the "
+                    "conversation and return only the new summary. Keep the "
+                    "facts about the candidate and what the user asked about.",
+                ),
+                (
+                    "human",
+                    "Current summary:\n{summary}\n\nNew lines:\n{lines}",
+                ),
+            ]
+        )
+        self.summary_chain = self.summary_prompt | self.llm | StrOutputParser()
+
+        # session id -> (number of summarized messages,
+        # hashes of the last summarized messages, summary)
+        self._summaries: OrderedDict[str, tuple[int, tuple[str, ...], str]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def _split(
+        self, session_id: str, messages: Sequence[BaseMessage]
+    ) -> tuple[str, list[BaseMessage], int, list[BaseMessage]]:
+        """Splits the messages into the summary so far, the older messages,
+        the position of the first older message that is not yet in the
+        summary and the latest messages"""
+        keep = 2 * self.keep_last_turns
+        older = list(messages[:-keep]) if keep else list(messages)
+        recent = list(messages[-keep:]) if keep else []
+
+        with self._lock:
+            summarized, tail, summary = self._summaries.get(session_id, (0, (), ""))
+
+        # Find where the summary stopped. The history only grows at the
+        # end and loses messages at the start when the store trims it.
+        # So the last summarized messages are looked for at or before
+        # the position where the summary stopped. If they are not
+        # found, the history has changed and it is summarized again
+        start = 0
+        if tail:
+            hashes = [_message_hash(message) for message in older]
+            for end in range(min(summarized, len(older)), len(tail) - 1, -1):
+                if tuple(hashes[end - len(tail) : end]) == tail:
+                    start = end
+                    break
+            else:
+                summary = ""
+
+        return summary, older, start, recent
+
+    def _save(self, session_id: str, summarized: list[BaseMessage], summary: str):
+        tail = tuple(_message_hash(message) for message in summarized[-4:])
+        with self._lock:
+            self._summaries[session_id] = (len(summarized), tail, summary)
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > self.max_sessions:
+                self._summaries.popitem(last=False)
+
+    def _window(self, summary: str, recent: list[BaseMessage]) -> list[BaseMessage]:
+        window = list(recent)
+        summary_messages = []
+        if summary:
+            summary_messages = [
+                SystemMessage(content=f"Summary of the earlier conversation: {summary}")
+            ]
+
+        # The latest turns might not fit either. The oldest of them
+        # are dropped, but the latest turn is always kept
+        while (
+            len(window) > 2
+            and self.token_counter(summary_messages + window) > self.max_tokens
+        ):
+            window = window[2:]
+        return summary_messages + window
+
+    @staticmethod
+    def _lines(messages: Sequence[BaseMessage]) -> str:
+        return "\n".join(f"{message.type}: {message.content}" for message in messages)
+
+    def apply(
+        self, messages: Sequence[BaseMessage], session_id: str
+    ) -> list[BaseMessage]:
+        """Returns the history that fits within the token budget
+
+        Parameters
+        ----------
+        messages : Sequence[BaseMessage]
+            The full history of the session
+        session_id : str
+            The session the history belongs to
+
+        Returns
+        -------
+        list[BaseMessage]
+            The history as it is if it fits. Otherwise, a summary
+            of the older turns followed by the latest turns
+        """
+        if self.token_counter(messages) <= self.max_tokens:
+            return list(messages)
+
+        summary, older, start, recent = self._split(session_id, messages)
+        unsummarized = older[start:]
+        if unsummarized:
+            summary = self.summary_chain.invoke(
+                {"summary": summary or "None", "lines": self._lines(unsummarized)}
+            )
+            self._save(session_id, older, summary)
+
+        return self._window(summary, recent)
+
+    async def aapply(
+        self, messages: Sequence[BaseMessage], session_id: str
+    ) -> list[BaseMessage]:
+        """The async version of `apply`"""
+        if self.token_counter(messages) <= self.max_tokens:
+            return list(messages)
+
+        summary, older, start, recent = self._split(session_id, messages)
+        unsummarized = older[start:]
+        if unsummarized:
+            summary = await self.summary_chain.ainvoke(
+                {"summary": summary or "None", "lines": self._lines(unsummarized)}
+            )
+            self._save(session_id, older, summary)
+
+        return self._window(summary, recent)
+
+    def summary(self, session_id: str) -> Optional[str]:
+        """The running summary of the session, if there is one"""
+        with self._lock:
+            entry = self._summaries.get(session_id)
+        return entry[2] if entry else None
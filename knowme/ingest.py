@@ -1,24 +1,390 @@
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, BinaryIO, Iterator, Optional, Union
 from langchain_community.document_loaders import UnstructuredPDFLoader
 from langchain_core.documents import Document
 from langchain.text_splitter import TextSplitter
+from pypdf import PdfReader, PdfWriter
+
+from knowme.artifact_cache import ArtifactCache, artifact_key
+from knowme.manifest import splitter_config
+
+
+def split_markdown(
+    content: bytes,
+    filename: str,
+    splitter: TextSplitter,
+    artifact_cache: Optional[ArtifactCache] = None,
+) -> list[Document]:
+    """Splits the content of a single markdown file.
+    This is a module level function so that it can be
+    sent to the workers of a process pool
+
+    Parameters
+    ----------
+    content : bytes
+        The content of the markdown file
+    filename : str
+        The name of the file that is stored with the chunks
+    splitter : TextSplitter
+        A splitter that splits the documents into smaller pieces of text
+    artifact_cache : Optional[ArtifactCache], optional
+        If provided, the chunks of a file whose content has been split
+        before with the same splitter are read from the cache, by default None
+
+    Returns
+    -------
+    list[Document]
+        The chunks of the file
+    """
+    key = None
+    if artifact_cache is not None:
+        key = artifact_key("markdown", hashlib.sha256(content).hexdigest(), splitter)
+        documents = artifact_cache.get(key, path_key="filename", path=filename)
+        if documents is not None:
+            return documents
+
+    # The newlines are translated as when the file is read as text
+    data = content.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+    documents = splitter.create_documents(
+        texts=[data], metadatas=[{"filename": filename}]
+    )
+    if artifact_cache is not None:
+        artifact_cache.put(key, documents, path_key="filename")
+    return documents
+
+
+def read_and_split(
+    filepath: Path,
+    splitter: TextSplitter,
+    artifact_cache: Optional[ArtifactCache] = None,
+) -> list[Document]:
+    """Reads and splits a single markdown file.
+    This is a module level function so that it can be
+    sent to the workers of a process pool
+
+    Parameters
+    ----------
+    filepath : Path
+        The path of the markdown file
+    splitter : TextSplitter
+        A splitter that splits the documents into smaller pieces of text
+    artifact_cache : Optional[ArtifactCache], optional
+        The cache of the chunks, by default None
+
+    Returns
+    -------
+    list[Document]
+        The chunks of the file
+    """
+    with open(filepath, "rb") as fp:
+        content = fp.read()
+    return split_markdown(content, str(filepath), splitter, artifact_cache)
+
+
+def is_markdown_member(info: zipfile.ZipInfo) -> bool:
+    """Whether a member of a zip file is a markdown file.
+    The metadata that macOS adds to the archives is skipped"""
+    return (
+        not info.is_dir()
+        and info.filename.endswith(".md")
+        and not info.filename.startswith("__MACOSX/")
+    )
+
+
+def zip_fingerprint(zip_source: Union[str, Path, BinaryIO]) -> str:
+    """A fingerprint of the markdown files in a zip file.
+    Only the central directory of the archive is read. The images
+    and the attachments of the export are not read at all
+
+    Parameters
+    ----------
+    zip_source : Union[str, Path, BinaryIO]
+        The path of the zip file or the zip file itself
+
+    Returns
+    -------
+    str
+        The hex digest of the sha256 of the names, sizes
+        and checksums of the markdown files
+    """
+    fingerprint = hashlib.sha256()
+    with zipfile.ZipFile(zip_source) as archive:
+        members = sorted(
+            (info for info in archive.infolist() if is_markdown_member(info)),
+            key=lambda info: info.filename,
+        )
+        for info in members:
+            fingerprint.update(
+                f"{info.filename}\0{info.file_size}\0{info.CRC}\n".encode()
+            )
+    return fingerprint.hexdigest()
+
+
+def folder_fingerprint(folder_path: Union[str, Path]) -> str:
+    """A fingerprint of the markdown files in a folder. It depends on the
+    content of the files only, so a copy of the folder or an export that
+    is extracted again has the same fingerprint
+
+    Parameters
+    ----------
+    folder_path : Union[str, Path]
+        The folder of the export
+
+    Returns
+    -------
+    str
+        The hex digest of the sha256 of the names, sizes
+        and content hashes of the markdown files
+    """
+    folder_path = Path(folder_path)
+    fingerprint = hashlib.sha256()
+    for filepath in sorted(
+        folder_path.glob("**/*.md"),
+        key=lambda filepath: filepath.relative_to(folder_path).as_posix(),
+    ):
+        relative_path = filepath.relative_to(folder_path).as_posix()
+        fingerprint.update(
+            f"{relative_path}\0{filepath.stat().st_size}\0"
+            f"{file_sha256(filepath)}\n".encode()
+        )
+    return fingerprint.hexdigest()
 
 
 class NotionIngestor:
-    def __init__(self, folder_path: str, splitter: TextSplitter):
-        """_summary_
+    def __init__(
+        self,
+        folder_path: Union[str, Path, BinaryIO],
+        splitter: TextSplitter,
+        num_workers: Optional[int] = None,
+        executor_type: str = "thread",
+        artifact_cache: Optional[ArtifactCache] = None,
+    ):
+        """Reads the markdown files of a notion export and splits them
 
         Parameters
         ----------
-        folder_path : str
+        folder_path : Union[str, Path, BinaryIO]
             Path where notion page has been exported
-            The page exported by notion is .zip folder
-            Unzip the folder first
+            The page exported by notion is .zip folder. This can be the
+            unzipped folder, the path of the .zip file or the .zip file
+            itself, such as an uploaded file. Only the markdown files are
+            read from a .zip file. Nothing is extracted to the disk
         splitter : TextSplitter
             A splitter that splits the documents into smaller pieces of text
+        num_workers : Optional[int], optional
+            The number of workers that read and split the files in parallel,
+            by default None. The files are read one after the other if
+            this is None or 1
+        executor_type : str, optional
+            Either "thread" or "process", by default "thread"
+            Use "process" when splitting is the bottleneck. The splitter
+            has to be picklable in this case
+        artifact_cache : Optional[ArtifactCache], optional
+            If provided, the chunks of the files are cached by their
+            content and the splitter, by default None
         """
+        if executor_type not in ("thread", "process"):
+            raise ValueError(
+                f"executor_type should be thread or process. Got {executor_type}"
+            )
+
         self.splitter = splitter
-        self.folder_path = Path(folder_path)
+        self.num_workers = num_workers
+        self.executor_type = executor_type
+        self.artifact_cache = artifact_cache
+
+        # Either a folder or a zip file, given by its path or as a file
+        self.zip_source: Optional[Union[Path, BinaryIO]] = None
+        self.folder_path: Optional[Path] = None
+        if hasattr(folder_path, "read"):
+            self.zip_source = folder_path
+        elif Path(folder_path).is_file() and zipfile.is_zipfile(folder_path):
+            self.zip_source = Path(folder_path)
+        else:
+            self.folder_path = Path(folder_path)
+
+    @property
+    def is_zip(self) -> bool:
+        return self.zip_source is not None
+
+    def _zip_source(self) -> Union[Path, BinaryIO]:
+        # A file object is read from the start every time
+        if hasattr(self.zip_source, "seek"):
+            self.zip_source.seek(0)
+        return self.zip_source
+
+    def _open_zip(self) -> zipfile.ZipFile:
+        return zipfile.ZipFile(self._zip_source())
+
+    def markdown_files(self) -> list[str]:
+        """The markdown files in the export, in a stable order
+
+        Returns
+        -------
+        list[str]
+            The sorted paths of all the .md files in the export,
+            relative to the folder or the root of the zip file
+        """
+        if self.is_zip:
+            with self._open_zip() as archive:
+                return sorted(
+                    info.filename
+                    for info in archive.infolist()
+                    if is_markdown_member(info)
+                )
+
+        return sorted(
+            filepath.relative_to(self.folder_path).as_posix()
+            for filepath in self.folder_path.glob("**/*.md")
+        )
+
+    def file_signatures(self) -> dict[str, str]:
+        """A cheap signature of every markdown file that changes when the
+        file changes. This is the size and the modification time of a file
+        in a folder and the size and the checksum of a file in a zip file
+
+        Returns
+        -------
+        dict[str, str]
+            The signature of every markdown file, by its relative path
+        """
+        if self.is_zip:
+            with self._open_zip() as archive:
+                return {
+                    info.filename: f"{info.file_size}:{info.CRC}"
+                    for info in archive.infolist()
+                    if is_markdown_member(info)
+                }
+
+        signatures = {}
+        for relative_path in self.markdown_files():
+            stat = (self.folder_path / relative_path).stat()
+            signatures[relative_path] = f"{stat.st_size}:{stat.st_mtime_ns}"
+        return signatures
+
+    def _filename(self, relative_path: str) -> str:
+        # The name of the file that is stored with its chunks
+        if self.is_zip:
+            return relative_path
+        return str(self.folder_path / relative_path)
+
+    def read_file(self, relative_path: str) -> bytes:
+        """The content of a single markdown file
+
+        Parameters
+        ----------
+        relative_path : str
+            The path of the file in the export
+
+        Returns
+        -------
+        bytes
+            The content of the file
+        """
+        if self.is_zip:
+            with self._open_zip() as archive:
+                return archive.read(relative_path)
+
+        with open(self.folder_path / relative_path, "rb") as fp:
+            return fp.read()
+
+    def ingest_file(
+        self, relative_path: str, content: Optional[bytes] = None
+    ) -> list[Document]:
+        """Reads and splits a single markdown file
+
+        Parameters
+        ----------
+        relative_path : str
+            The path of the file in the export
+        content : Optional[bytes], optional
+            The content of the file, if it has been read already
+
+        Returns
+        -------
+        list[Document]
+            The chunks of the file
+        """
+        if content is None:
+            content = self.read_file(relative_path)
+        return split_markdown(
+            content, self._filename(relative_path), self.splitter, self.artifact_cache
+        )
+
+    def _create_executor(self) -> Executor:
+        if self.executor_type == "process":
+            return ProcessPoolExecutor(max_workers=self.num_workers)
+        return ThreadPoolExecutor(max_workers=self.num_workers)
+
+    def _iter_contents(self) -> Iterator[tuple[str, bytes]]:
+        # The members are read one after the other from a single
+        # handle of the zip file. Only the markdown members are decompressed
+        with self._open_zip() as archive:
+            for relative_path in self.markdown_files():
+                yield relative_path, archive.read(relative_path)
+
+    def iter_documents(self) -> Iterator[Document]:
+        """Streams the chunks of the export file by file.
+        The chunks are yielded in the sorted order of the files
+        irrespective of the order in which the workers finish
+
+        Yields
+        ------
+        Document
+            A chunk of a markdown file
+        """
+        if not self.num_workers or self.num_workers <= 1:
+            if self.is_zip:
+                for relative_path, content in self._iter_contents():
+                    yield from self.ingest_file(relative_path, content)
+            else:
+                for relative_path in self.markdown_files():
+                    yield from self.ingest_file(relative_path)
+            return
+
+        # The files of a folder are read by the workers. The files of
+        # a zip file are read here and only split by the workers
+        if self.is_zip:
+            tasks = (
+                (
+                    split_markdown,
+                    content,
+                    self._filename(relative_path),
+                    self.splitter,
+                    self.artifact_cache,
+                )
+                for relative_path, content in self._iter_contents()
+            )
+        else:
+            tasks = (
+                (
+                    read_and_split,
+                    self.folder_path / relative_path,
+                    self.splitter,
+                    self.artifact_cache,
+                )
+                for relative_path in self.markdown_files()
+            )
+
+        # Only a few files are in flight at any time so that the
+        # memory does not hold every page of a large export
+        max_in_flight = 2 * self.num_workers
+        with self._create_executor() as executor:
+            pending = deque()
+            for function, *arguments in tasks:
+                pending.append(executor.submit(function, *arguments))
+                if len(pending) >= max_in_flight:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
 
     def ingest(self) -> list[Document]:
         """Reads the documents.
@@ -31,27 +397,101 @@ class NotionIngestor:
         """
         # Ingest all the documents that has been read
         # This also performs some kind of cleaning of the information
+        return list(self.iter_documents())
+
+    def source_path(self) -> Optional[str]:
+        """The path of the export. None for a zip file without a path"""
+        if self.folder_path is not None:
+            return str(self.folder_path.resolve())
+        if isinstance(self.zip_source, Path):
+            return str(self.zip_source.resolve())
+        return None
+
+    def source_info(self) -> dict[str, Any]:
+        """Describes the notion export without reading it.
+        This is used to decide whether a persisted store
+        was built from the same export
+
+        Returns
+        -------
+        dict[str, Any]
+            The path of the export, the number of markdown files and a
+            fingerprint of their names and content. The fingerprint
+            of a zip file only depends on the content of its markdown files
+        """
+        if self.is_zip:
+            fingerprint = zip_fingerprint(self._zip_source())
+            num_files = len(self.markdown_files())
+        else:
+            # The modification times are not restored when an
+            # export is extracted again. Only the content is compared
+            fingerprint = folder_fingerprint(self.folder_path)
+            num_files = len(self.markdown_files())
+
+        return {
+            "type": "notion",
+            "format": "zip" if self.is_zip else "folder",
+            "path": self.source_path(),
+            "num_files": num_files,
+            "fingerprint": fingerprint,
+            "splitter": splitter_config(self.splitter),
+        }
+
 
-        # Read .md files in all the
-        markdown_files = self.folder_path.glob("**/*.md")
+def file_sha256(filepath: Path) -> str:
+    """The hash of the content of a file
 
-        all_data = []
-        metadatas = []
+    Parameters
+    ----------
+    filepath : Path
+        The path of the file
 
-        for filepath in markdown_files:
-            with open(filepath) as fp:
-                data = fp.read()
-                all_data.append(data)
-                metadatas.append({"filename": str(filepath)})
+    Returns
+    -------
+    str
+        The hex digest of the sha256 of the file content
+    """
+    content_hash = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
 
-        documents = self.splitter.create_documents(texts=all_data, metadatas=metadatas)
-        split_documents = self.splitter.split_documents(documents)
 
-        return split_documents
+def extract_page_texts(pdf_bytes: bytes, page_numbers: list[int]) -> list[str]:
+    """Extracts the text layer of some pages of a pdf.
+    This is a module level function so that it can be
+    sent to the workers of a process pool
+
+    Parameters
+    ----------
+    pdf_bytes : bytes
+        The content of the pdf
+    page_numbers : list[int]
+        The zero based numbers of the pages
+
+    Returns
+    -------
+    list[str]
+        The text of every page
+    """
+    # Every worker reads the pdf on its own. A reader
+    # cannot be shared between threads
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[number].extract_text() or "" for number in page_numbers]
 
 
 class CVIngestor:
-    def __init__(self, filename: str, splitter: TextSplitter):
+    def __init__(
+        self,
+        filename: str,
+        splitter: TextSplitter,
+        mode: str = "unstructured",
+        num_workers: Optional[int] = None,
+        executor_type: str = "process",
+        min_page_chars: int = 20,
+        artifact_cache: Optional[ArtifactCache] = None,
+    ):
         """This ingests a cv in a pdf format
 
         Parameters
@@ -60,13 +500,170 @@ class CVIngestor:
             The name of the file to ingest
         splitter: TextSplitter
             A splitter that splits the documents into smaller pieces of text
+        mode: str
+            Either "unstructured" or "fast", by default "unstructured"
+            The "fast" mode reads the text layer of the pdf with pypdf and
+            uses unstructured only for the pages without usable text,
+            such as scanned pages. A CV that is exported from a word
+            processor never needs unstructured
+        num_workers: Optional[int]
+            The number of workers that read the pages in parallel in the
+            "fast" mode, by default None. The pages are read one after
+            the other if this is None or 1
+        executor_type: str
+            Either "thread" or "process", by default "process"
+            Reading the text layer holds the GIL, so the threads
+            do not read the pages any faster
+        min_page_chars: int
+            A page with fewer characters of text than this is parsed
+            with unstructured in the "fast" mode, by default 20
+        artifact_cache: Optional[ArtifactCache]
+            If provided, the chunks of the CV are cached by its content,
+            the mode and the splitter, by default None. A CV that is
+            uploaded again is not parsed again
         """
+        if mode not in ("unstructured", "fast"):
+            raise ValueError(f"mode should be unstructured or fast. Got {mode}")
+        if executor_type not in ("thread", "process"):
+            raise ValueError(
+                f"executor_type should be thread or process. Got {executor_type}"
+            )
+
         self.filename = filename
         self.splitter = splitter
+        self.mode = mode
+        self.num_workers = num_workers
+        self.executor_type = executor_type
+        self.min_page_chars = min_page_chars
+        self.artifact_cache = artifact_cache
+
+        # How every page was read in the last ingestion. Filled in the fast mode
+        self.page_report: list[dict[str, Any]] = []
 
     def ingest(self) -> list[Document]:
-        loader = UnstructuredPDFLoader(self.filename)
-        pages: list[Document] = loader.load()
+        if self.artifact_cache is None:
+            return self._parse_and_split()
+
+        key = artifact_key(
+            "cv",
+            file_sha256(self.filename),
+            self.splitter,
+            mode=self.mode,
+            min_page_chars=self.min_page_chars,
+        )
+        documents = self.artifact_cache.get(
+            key, path_key="source", path=str(self.filename)
+        )
+        if documents is not None:
+            print("reusing the parsed CV")
+            self.page_report = []
+            return documents
+
+        documents = self._parse_and_split()
+        self.artifact_cache.put(key, documents, path_key="source")
+        return documents
+
+    def _parse_and_split(self) -> list[Document]:
+        if self.mode == "fast":
+            pages = [self._extract_fast()]
+        else:
+            loader = UnstructuredPDFLoader(self.filename)
+            pages: list[Document] = loader.load()
         pages = self.splitter.split_documents(pages)
 
         return pages
+
+    def _page_texts(self, pdf_bytes: bytes, num_pages: int) -> list[str]:
+        page_numbers = list(range(num_pages))
+        num_workers = min(self.num_workers or 1, num_pages)
+        if self.executor_type == "process":
+            # More processes than cores only add the cost of starting them
+            num_workers = min(num_workers, os.cpu_count() or 1)
+        if num_workers <= 1:
+            return extract_page_texts(pdf_bytes, page_numbers)
+
+        # The pages are dealt out to the workers
+        ranges = [page_numbers[index::num_workers] for index in range(num_workers)]
+        executor_class = (
+            ProcessPoolExecutor
+            if self.executor_type == "process"
+            else ThreadPoolExecutor
+        )
+        texts = [""] * num_pages
+        with executor_class(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(extract_page_texts, pdf_bytes, numbers)
+                for numbers in ranges
+            ]
+            for numbers, future in zip(ranges, futures):
+                for number, text in zip(numbers, future.result()):
+                    texts[number] = text
+        return texts
+
+    def _extract_with_unstructured(self, reader: PdfReader, page_number: int) -> str:
+        # Only the page without text is given to unstructured
+        writer = PdfWriter()
+        writer.add_page(reader.pages[page_number])
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as fp:
+            writer.write(fp)
+            fp.flush()
+            documents = UnstructuredPDFLoader(fp.name).load()
+        return "\n\n".join(document.page_content for document in documents)
+
+    def _extract_fast(self) -> Document:
+        """Reads the text layer of the pdf and falls
+        back to unstructured for the pages without text
+
+        Returns
+        -------
+        Document
+            The text of all the pages. This is the same
+            document that the unstructured loader returns
+        """
+        with open(self.filename, "rb") as fp:
+            pdf_bytes = fp.read()
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        texts = self._page_texts(pdf_bytes, len(reader.pages))
+
+        self.page_report = []
+        for page_number, text in enumerate(texts):
+            method = "text"
+            if len(text.strip()) < self.min_page_chars:
+                method = "unstructured"
+                text = self._extract_with_unstructured(reader, page_number)
+                texts[page_number] = text
+            self.page_report.append(
+                {"page": page_number + 1, "method": method, "chars": len(text.strip())}
+            )
+
+        num_fallbacks = sum(
+            page["method"] == "unstructured" for page in self.page_report
+        )
+        print(
+            f"read {len(texts) - num_fallbacks} pages from the text layer "
+            f"and {num_fallbacks} pages with unstructured"
+        )
+
+        return Document(
+            page_content="\n\n".join(text.strip() for text in texts if text.strip()),
+            metadata={"source": self.filename},
+        )
+
+    def source_info(self) -> dict[str, Any]:
+        """Describes the CV without parsing it.
+        This is used to decide whether a persisted store
+        was built from the same file
+
+        Returns
+        -------
+        dict[str, Any]
+            The path of the CV, the hash of its content
+            and the mode of extraction
+        """
+        return {
+            "type": "cv",
+            "path": str(Path(self.filename).resolve()),
+            "sha256": file_sha256(self.filename),
+            "mode": self.mode,
+            "splitter": splitter_config(self.splitter),
+        }
@@ -0,0 +1,626 @@
+"""
+Records where the time of every answer goes. The runnables of the chains
+and the agent are tagged with the stage they belong to: rewriting the
+question, retrieving and compacting the chunks, generating the answer or
+the turns of the agent. A callback handler times the stages of a request
+and counts their tokens and chunks. The records are kept per request and
+per session and can be exported as Prometheus text or as json lines.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.outputs import LLMResult
+
+from knowme.compaction import estimate_text_tokens
+
+STAGE_TAG_PREFIX = "knowme-stage:"
+
+# The upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def stage_tag(stage: str) -> str:
+    """The tag of the runnables of a stage, such as "rewrite" or "generate" """
+    return f"{STAGE_TAG_PREFIX}{stage}"
+
+
+def _stage(tags: Optional[list[str]]) -> Optional[str]:
+    # The tags of the parent runs come first. The last stage is the innermost
+    stages = [
+        tag[len(STAGE_TAG_PREFIX) :]
+        for tag in tags or []
+        if tag.startswith(STAGE_TAG_PREFIX)
+    ]
+    return stages[-1] if stages else None
+
+
+def _new_stage() -> dict[str, Any]:
+    return {
+        "calls": 0,
+        "wall_ms": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "chunks": 0,
+    }
+
+
+def _count_documents(outputs: Any) -> Optional[int]:
+    if isinstance(outputs, dict) and "output" in outputs:
+        outputs = outputs["output"]
+    if isinstance(outputs, list) and all(
+        isinstance(output, Document) for output in outputs
+    ):
+        return len(outputs)
+    return None
+
+
+class StageTimer(BaseCallbackHandler):
+    def __init__(
+        self,
+        instrumentation: "Instrumentation",
+        source: str,
+        session_id: str,
+    ):
+        """Times the stages of a single request. The request is recorded
+        once its outermost run ends
+
+        Parameters
+        ----------
+        instrumentation : Instrumentation
+            Collects the record of the request
+        source : str
+            What answered the request, such as "site", "cv" or "agent"
+        session_id : str
+            The session of the request
+        """
+        self.instrumentation = instrumentation
+        self.source = source
+        self.session_id = session_id
+        self.request_id = uuid.uuid4().hex
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.stages: dict[str, dict[str, Any]] = defaultdict(_new_stage)
+        self.finished = False
+
+        # The first run that the timer sees. The timer can be given to a
+        # run that is nested in the run of another timer, such as a chain
+        # that is called by a tool of the agent
+        self._root_run_id: Optional[UUID] = None
+        # run id -> (stage, start, whether it is the outermost run of its stage)
+        self._runs: dict[UUID, tuple[str, float, bool]] = {}
+        # run id -> prompt tokens estimated from the messages
+        self._prompt_estimates: dict[UUID, int] = {}
+        self._lock = threading.Lock()
+
+    def _start_run(
+        self, run_id: UUID, parent_run_id: Optional[UUID], tags: Optional[list[str]]
+    ):
+        stage = _stage(tags)
+        with self._lock:
+            if self._root_run_id is None:
+                self._root_run_id = run_id
+            if stage is None:
+                return
+            parent = self._runs.get(parent_run_id)
+            # The children of a run inherit its tags. Only the
+            # outermost run of a stage is timed
+            outermost = parent is None or parent[0] != stage
+            self._runs[run_id] = (stage, time.perf_counter(), outermost)
+            if outermost:
+                self.stages[stage]["calls"] += 1
+
+    def _end_run(self, run_id: UUID, outputs: Any = None):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            if run is None:
+                return
+            stage, start, outermost = run
+            if outermost:
+                self.stages[stage]["wall_ms"] += (time.perf_counter() - start) * 1000
+                num_documents = _count_documents(outputs)
+                if num_documents is not None:
+                    # The chunks that leave the stage, after
+                    # the merging and the deduplication
+                    self.stages[stage]["chunks"] = num_documents
+
+    def on_chain_start(
+        self,
+        serialized,
+        inputs,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[list[str]] = None,
+        **kwargs: Any,
+    ):
+        self._start_run(run_id, parent_run_id, tags)
+
+    def on_chain_end(
+        self,
+        outputs,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ):
+        self._end_run(run_id, outputs)
+        if run_id == self._root_run_id:
+            self.finish()
+
+    def on_chain_error(
+        self,
+        error: BaseException,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ):
+        self._end_run(run_id)
+        if run_id == self._root_run_id:
+            self.finish(error=repr(error))
+
+    def on_chat_model_start(
+        self,
+        serialized,
+        messages,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[list[str]] = None,
+        **kwargs: Any,
+    ):
+        self._start_run(run_id, parent_run_id, tags)
+        prompt_estimate = sum(
+            estimate_text_tokens(str(message.content))
+            for batch in messages
+            for message in batch
+        )
+        with self._lock:
+            self._prompt_estimates[run_id] = prompt_estimate
+
+    def on_llm_start(
+        self,
+        serialized,
+        prompts,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[list[str]] = None,
+        **kwargs: Any,
+    ):
+        self._start_run(run_id, parent_run_id, tags)
+        prompt_estimate = sum(estimate_text_tokens(prompt) for prompt in prompts)
+        with self._lock:
+            self._prompt_estimates[run_id] = prompt_estimate
+
+    def on_llm_end(
+        self,
+        response: LLMResult,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ):
+        with self._lock:
+            run = self._runs.get(run_id)
+            prompt_estimate = self._prompt_estimates.pop(run_id, 0)
+        if run is not None:
+            prompt_tokens, completion_tokens = self._token_usage(
+                response, prompt_estimate
+            )
+            with self._lock:
+                self.stages[run[0]]["prompt_tokens"] += prompt_tokens
+                self.stages[run[0]]["completion_tokens"] += completion_tokens
+        self._end_run(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        with self._lock:
+            self._prompt_estimates.pop(run_id, None)
+        self._end_run(run_id)
+
+    @staticmethod
+    def _token_usage(response: LLMResult, prompt_estimate: int) -> tuple[int, int]:
+        # The usage reported by the model is preferred.
+        # The tokens are estimated from the text otherwise
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(
+                    getattr(generation, "message", None), "usage_metadata", None
+                )
+                if usage:
+                    return usage["input_tokens"], usage["output_tokens"]
+
+        usage = (response.llm_output or {}).get("token_usage")
+        if usage:
+            return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+        completion = sum(
+            estimate_text_tokens(generation.text)
+            for generations in response.generations
+            for generation in generations
+        )
+        return prompt_estimate, completion
+
+    def on_retriever_start(
+        self,
+        serialized,
+        query: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[list[str]] = None,
+        **kwargs: Any,
+    ):
+        self._start_run(run_id, parent_run_id, tags)
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any):
+        self._end_run(run_id, list(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end_run(run_id)
+
+    def on_tool_start(
+        self,
+        serialized,
+        input_str: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[list[str]] = None,
+        **kwargs: Any,
+    ):
+        self._start_run(run_id, parent_run_id, tags)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        self._end_run(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end_run(run_id)
+
+    def add_stage(self, stage: str, wall_ms: float):
+        """Records a stage that is not run as a langchain runnable"""
+        with self._lock:
+            self.stages[stage]["calls"] += 1
+            self.stages[stage]["wall_ms"] += wall_ms
+
+    def finish(self, error: Optional[str] = None, cached: bool = False):
+        """Records the request. Only the first call records it
+
+        Parameters
+        ----------
+        error : Optional[str], optional
+            The error that ended the request, by default None
+        cached : bool, optional
+            Whether the answer came from the answer cache, by default False
+        """
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            record = {
+                "request_id": self.request_id,
+                "source": self.source,
+                "session_id": self.session_id,
+                "started_at": self.started_at,
+                "total_ms": (time.perf_counter() - self.start) * 1000,
+                "cached": cached,
+                "error": error,
+                "stages": {
+                    stage: dict(values) for stage, values in self.stages.items()
+                },
+            }
+        self.instrumentation.record(record)
+
+
+class Instrumentation:
+    def __init__(
+        self,
+        max_requests: int = 1000,
+        max_sessions: int = 1000,
+        log_path: Optional[str] = None,
+    ):
+        """Collects the records of the requests of the chains and the agent
+
+        Parameters
+        ----------
+        max_requests : int, optional
+            The number of the latest requests that are kept, by default 1000
+        max_sessions : int, optional
+            The number of sessions whose totals are kept, by default 1000
+            The least recently used sessions are dropped beyond this
+        log_path : Optional[str], optional
+            If provided, every request is appended to this file
+            as a line of json, by default None
+        """
+        self.max_sessions = max_sessions
+        self.log_path = log_path
+
+        self._requests: deque[dict[str, Any]] = deque(maxlen=max_requests)
+        self._sessions: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        # (source, stage) -> the totals that are exported to Prometheus
+        self._stage_totals: dict[tuple[str, str], dict[str, Any]] = {}
+        # (source, status) -> the number of requests and their histogram
+        self._request_totals: dict[tuple[str, str], dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # Serializes the appends to the log outside of `_lock`
+        self._log_lock = threading.Lock()
+
+    def timer(self, source: str, session_id: str) -> StageTimer:
+        """A callback handler that times a single request
+
+        Parameters
+        ----------
+        source : str
+            What answers the request, such as "site", "cv" or "agent"
+        session_id : str
+            The session of the request
+
+        Returns
+        -------
+        StageTimer
+            The handler. It is passed in the callbacks of the run
+        """
+        return StageTimer(self, source, session_id)
+
+    @staticmethod
+    def _observe(totals: dict[str, Any], seconds: float):
+        totals["count"] += 1
+        totals["sum"] += seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                totals["buckets"][index] += 1
+
+    @staticmethod
+    def _new_histogram() -> dict[str, Any]:
+        return {"count": 0, "sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+
+    def record(self, record: dict[str, Any]):
+        """Adds the record of a request
+
+        Parameters
+        ----------
+        record : dict[str, Any]
+            The record from `StageTimer.finish`
+        """
+        with self._lock:
+            self._requests.append(record)
+
+            session_key = f"{record['source']}:{record['session_id']}"
+            session = self._sessions.pop(session_key, None)
+            if session is None:
+                session = {
+                    "source": record["source"],
+                    "session_id": record["session_id"],
+                    "requests": 0,
+                    "total_ms": 0.0,
+                    "stages": defaultdict(_new_stage),
+                }
+            self._sessions[session_key] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+            session["requests"] += 1
+            session["total_ms"] += record["total_ms"]
+
+            status = (
+                "error" if record["error"] else "cached" if record["cached"] else "ok"
+            )
+            request_totals = self._request_totals.setdefault(
+                (record["source"], status), self._new_histogram()
+            )
+            self._observe(request_totals, record["total_ms"] / 1000)
+
+            for stage, values in record["stages"].items():
+                for field in (
+                    "calls",
+                    "wall_ms",
+                    "prompt_tokens",
+                    "completion_tokens",
+                    "chunks",
+                ):
+                    session["stages"][stage][field] += values[field]
+
+                stage_totals = self._stage_totals.setdefault(
+                    (record["source"], stage),
+                    {
+                        **self._new_histogram(),
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "chunks": 0,
+                    },
+                )
+                self._observe(stage_totals, values["wall_ms"] / 1000)
+                stage_totals["prompt_tokens"] += values["prompt_tokens"]
+                stage_totals["completion_tokens"] += values["completion_tokens"]
+                stage_totals["chunks"] += values["chunks"]
+
+            # Serialized under the lock so the line is a snapshot of the record
+            line = json.dumps(record) + "\n" if self.log_path is not None else None
+
+        if line is not None:
+            with self._log_lock, open(self.log_path, "a") as fp:
+                fp.write(line)
+
+    def requests(
+        self, session_id: Optional[str] = None, limit: Optional[int] = None
+    ) -> list[dict[str, Any]]:
+        """The latest requests, the newest first
+
+        Parameters
+        ----------
+        session_id : Optional[str], optional
+            Only the requests of this session, by default None
+        limit : Optional[int], optional
+            The maximum number of requests, by default None
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            The records of the requests
+        """
+        with self._lock:
+            records = [
+                record
+                for record in reversed(self._requests)
+                if session_id is None or record["session_id"] == session_id
+            ]
+        return records[:limit] if limit is not None else records
+
+    def sessions(self, session_id: Optional[str] = None) -> list[dict[str, Any]]:
+        """The totals of the sessions, the most recently used first
+
+        Parameters
+        ----------
+        session_id : Optional[str], optional
+            Only the totals of this session, by default None.
+            A session has totals for every source that it has asked
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            The number of requests, their total time and
+            the totals of every stage of the sessions
+        """
+        with self._lock:
+            return [
+                {
+                    **session,
+                    "stages": {
+                        stage: dict(values)
+                        for stage, values in session["stages"].items()
+                    },
+                }
+                for session in reversed(self._sessions.values())
+                if session_id is None or session["session_id"] == session_id
+            ]
+
+    def to_prometheus(self) -> str:
+        """The totals in the Prometheus text format
+
+        Returns
+        -------
+        str
+            The histograms of the request and stage latencies
+            and the counters of the tokens and the chunks
+        """
+        lines = []
+
+        def histogram(name: str, labels: str, totals: dict[str, Any]):
+            for bound, count in zip(LATENCY_BUCKETS, totals["buckets"]):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {totals["count"]}')
+            lines.append(f"{name}_sum{{{labels}}} {totals['sum']}")
+            lines.append(f"{name}_count{{{labels}}} {totals['count']}")
+
+        with self._lock:
+            lines.append(
+                "# HELP knowme_request_duration_seconds The time to answer a request"
+            )
+            lines.append("# TYPE knowme_request_duration_seconds histogram")
+            for (source, status), totals in sorted(self._request_totals.items()):
+                histogram(
+                    "knowme_request_duration_seconds",
+                    f'source="{source}",status="{status}"',
+                    totals,
+                )
+
+            lines.append(
+                "# HELP knowme_stage_duration_seconds The time spent in a stage of a request"
+            )
+            lines.append("# TYPE knowme_stage_duration_seconds histogram")
+            for (source, stage), totals in sorted(self._stage_totals.items()):
+                histogram(
+                    "knowme_stage_duration_seconds",
+                    f'source="{source}",stage="{stage}"',
+                    totals,
+                )
+
+            lines.append("# HELP knowme_stage_tokens_total The tokens used by a stage")
+            lines.append("# TYPE knowme_stage_tokens_total counter")
+            for (source, stage), totals in sorted(self._stage_totals.items()):
+                for kind in ("prompt", "completion"):
+                    lines.append(
+                        f'knowme_stage_tokens_total{{source="{source}",stage="{stage}",'
+                        f'kind="{kind}"}} {totals[f"{kind}_tokens"]}'
+                    )
+
+            lines.append(
+                "# HELP knowme_stage_chunks_total The chunks that left a stage"
+            )
+            lines.append("# TYPE knowme_stage_chunks_total counter")
+            for (source, stage), totals in sorted(self._stage_totals.items()):
+                lines.append(
+                    f'knowme_stage_chunks_total{{source="{source}",stage="{stage}"}} '
+                    f'{totals["chunks"]}'
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def export_jsonl(self, path: str):
+        """Writes the kept requests to a file, one line of json per request
+
+        Parameters
+        ----------
+        path : str
+            The path of the file
+        """
+        with self._lock:
+            records = list(self._requests)
+        with open(path, "w") as fp:
+            for record in records:
+                fp.write(json.dumps(record) + "\n")
+
+
+def start_metrics_server(
+    instrumentation: "Instrumentation", host: str = "127.0.0.1", port: int = 9464
+) -> ThreadingHTTPServer:
+    """Serves the Prometheus text of the instrumentation on /metrics
+    from a background thread
+
+    Parameters
+    ----------
+    instrumentation : Instrumentation
+        The instrumentation whose totals are served
+    host : str, optional
+        The host to listen on, by default "127.0.0.1"
+    port : int, optional
+        The port to listen on, by default 9464
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The server. Call `shutdown` to stop it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = instrumentation.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# The instrumentation shared by the chains and the agents of the process
+default_instrumentation = Instrumentation()
@@ -1,18 +1,41 @@
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+import re
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.vectorstores import VectorStore
 
+from knowme.answer_cache import AnswerCache
+from knowme.bm25 import BM25Index, HybridRetriever
+from knowme.compaction import ContextCompactor
+from knowme.history_window import HistoryWindow
+from knowme.instrumentation import Instrumentation, StageTimer, stage_tag
+from knowme.rewrite import RewritePolicy
+from knowme.session_store import SessionStore, default_session_store
+
 
 class KnowmeChain:
     def __init__(
         self,
         llm: BaseChatModel,
         vector_store: VectorStore,
+        answer_cache: Optional[AnswerCache] = None,
+        store_version: Optional[str] = None,
+        rewrite_llm: Optional[BaseChatModel] = None,
+        rewrite_policy: Optional[RewritePolicy] = None,
+        session_store: Optional[SessionStore] = None,
+        history_namespace: str = "default",
+        history_scope: Optional[str] = None,
+        history_window: Optional[HistoryWindow] = None,
+        keyword_index: Optional[BM25Index] = None,
+        context_compactor: Optional[ContextCompactor] = None,
+        instrumentation: Optional[Instrumentation] = None,
     ):
         """This is a retrieval based chat model to know more about a person
         This retrieves information from different vector stores.
@@ -24,21 +47,84 @@ class KnowmeChain:
             for this
         vector_store: VectorStore
             This is the vector store that embeds all the documents
+        answer_cache: Optional[AnswerCache]
+            If provided, the answers to the questions that start a session
+            are cached and reused for the same questions, or for similar
+            ones if the cache is given an embedding function
+        store_version: Optional[str]
+            The version of the vector store. The cached answers are
+            not reused once the store changes
+        rewrite_llm: Optional[BaseChatModel]
+            The model that rewrites the question with the help of the
+            chat history. A smaller and faster model than the one that
+            answers can be used here. The `llm` is used if this is None
+        rewrite_policy: Optional[RewritePolicy]
+            Decides when the question is rewritten and caches the rewrites
+        session_store: Optional[SessionStore]
+            Stores the chat history of the sessions. The store that is
+            shared by the process is used if this is None
+        history_namespace: str
+            The histories are kept apart from the histories of the other
+            chains that use the same store. The chains with the same
+            namespace share the histories of a session
+        history_scope: Optional[str]
+            If provided, the histories are also kept apart from the chains
+            of the same namespace with another scope, such as the chains
+            of another store
+        history_window: Optional[HistoryWindow]
+            If provided, the history sent to the rewrite and the answer
+            prompts is kept within a token budget. The older turns are
+            replaced by a running summary
+        keyword_index: Optional[BM25Index]
+            If provided, the documents are retrieved with both the vector
+            search and a BM25 keyword search. The two rankings are fused
+            with reciprocal rank fusion
+        context_compactor: Optional[ContextCompactor]
+            If provided, the overlapping chunks of a file are merged, the
+            near duplicates are dropped and the context is capped by a
+            token budget before it is stuffed into the prompt
+        instrumentation: Optional[Instrumentation]
+            If provided, the wall time, the tokens and the chunks of every
+            stage of a request are recorded. The stages are "history",
+            "rewrite", "retrieve", "compact" and "generate"
         """
         self.llm = llm
         self.vector_store = vector_store
+        self.answer_cache = answer_cache
+        self.store_version = store_version
+        self.rewrite_llm = rewrite_llm if rewrite_llm is not None else llm
+        self.rewrite_policy = (
+            rewrite_policy if rewrite_policy is not None else RewritePolicy()
+        )
 
         self.search_type = "similarity"
         self.top_k_retrieval = 6
 
+        self.keyword_index = keyword_index
+        self.context_compactor = context_compactor
+        self.instrumentation = instrumentation
+
         # COnvert the vector store as retriever
-        self.retriever = self.vector_store.as_retriever(
-            search_type=self.search_type, search_kwargs={"k": self.top_k_retrieval}
-        )
+        if self.keyword_index is not None:
+            self.retriever = HybridRetriever(
+                vector_store=self.vector_store,
+                keyword_index=self.keyword_index,
+                k=self.top_k_retrieval,
+            )
+        else:
+            self.retriever = self.vector_store.as_retriever(
+                search_type=self.search_type,
+                search_kwargs={"k": self.top_k_retrieval},
+            )
 
         # create the session store. These ar elike cookies and session
         # for persisting a given chat
-        self.session_store = {}
+        self.session_store = (
+            session_store if session_store is not None else default_session_store
+        )
+        self.history_namespace = history_namespace
+        self.history_scope = history_scope
+        self.history_window = history_window
 
         # Refer to the chat history to rewrite the query from the user
         self.contextual_history_prompt = (
@@ -58,9 +144,21 @@ class KnowmeChain:
             ]
         )
 
-        self.history_retriever = create_history_aware_retriever(
-            self.llm, self.retriever, self.contextual_rewrite_prompt
+        self.rewrite_chain = (
+            self.contextual_rewrite_prompt | self.rewrite_llm | StrOutputParser()
+        )
+
+        # The question is rewritten only when the policy asks for it.
+        # Otherwise it is sent to the retriever as is
+        self.history_retriever = RunnableLambda(
+            self._rewrite_query, afunc=self._arewrite_query
+        ).with_config(tags=[stage_tag("rewrite")]) | self.retriever.with_config(
+            tags=[stage_tag("retrieve")]
         )
+        if self.context_compactor is not None:
+            self.history_retriever = self.history_retriever | RunnableLambda(
+                self.context_compactor.compact
+            ).with_config(tags=[stage_tag("compact")])
 
         # Create the chat chain here
         # This needs to have the `context` variable to
@@ -84,11 +182,25 @@ class KnowmeChain:
         )
 
         # This is the normal llm with a prompt
-        self.chain = create_stuff_documents_chain(self.llm, self.chat_prompt)
+        self.chain = create_stuff_documents_chain(
+            self.llm, self.chat_prompt
+        ).with_config(tags=[stage_tag("generate")])
 
         # This rewrites the history with a new prompt to be fed to the previous chain
         self.rag_chain = create_retrieval_chain(self.history_retriever, self.chain)
 
+        # The window replaces the history before it reaches the prompts.
+        # The full history is still what is stored in the session
+        if self.history_window is not None:
+            self.rag_chain = (
+                RunnablePassthrough.assign(
+                    chat_history=RunnableLambda(
+                        self._window_history, afunc=self._awindow_history
+                    ).with_config(tags=[stage_tag("history")])
+                )
+                | self.rag_chain
+            )
+
         # This remembers the message history with a given session store
         self.knowme_chain = RunnableWithMessageHistory(
             self.rag_chain,
@@ -98,6 +210,79 @@ class KnowmeChain:
             output_messages_key="answer",
         )
 
+    def _window_history(self, inputs: dict[str, Any], config: RunnableConfig) -> list:
+        """Fits the chat history of the session into the token budget
+
+        Parameters
+        ----------
+        inputs : dict[str, Any]
+            The input of the chain with the history under "chat_history"
+        config : RunnableConfig
+            The config of the run. This has the session id
+
+        Returns
+        -------
+        list
+            The history that is sent to the prompts
+        """
+        session_id = config["configurable"]["session_id"]
+        return self.history_window.apply(
+            inputs.get("chat_history", []),
+            self._session_key(session_id),
+        )
+
+    async def _awindow_history(
+        self, inputs: dict[str, Any], config: RunnableConfig
+    ) -> list:
+        session_id = config["configurable"]["session_id"]
+        return await self.history_window.aapply(
+            inputs.get("chat_history", []),
+            self._session_key(session_id),
+        )
+
+    def _rewrite_query(self, inputs: dict[str, Any]) -> str:
+        """Rewrites the question with the help of the chat history if needed
+
+        Parameters
+        ----------
+        inputs : dict[str, Any]
+            The input of the chain. This has the question
+            under "input" and the history under "chat_history"
+
+        Returns
+        -------
+        str
+            The question that is used to retrieve the documents
+        """
+        chat_history = inputs.get("chat_history", [])
+        query = inputs["input"]
+        if not self.rewrite_policy.needs_rewrite(chat_history, query):
+            return query
+
+        rewritten = self.rewrite_policy.get(chat_history, query)
+        if rewritten is None:
+            rewritten = self.rewrite_chain.invoke(inputs)
+            self.rewrite_policy.put(chat_history, query, rewritten)
+        return rewritten
+
+    async def _arewrite_query(self, inputs: dict[str, Any]) -> str:
+        chat_history = inputs.get("chat_history", [])
+        query = inputs["input"]
+        if not self.rewrite_policy.needs_rewrite(chat_history, query):
+            return query
+
+        rewritten = self.rewrite_policy.get(chat_history, query)
+        if rewritten is None:
+            rewritten = await self.rewrite_chain.ainvoke(inputs)
+            self.rewrite_policy.put(chat_history, query, rewritten)
+        return rewritten
+
+    def _session_key(self, session_id: str) -> str:
+        # The key of the session in the session store and the history window
+        if self.history_scope is None:
+            return f"{self.history_namespace}:{session_id}"
+        return f"{self.history_namespace}:{self.history_scope}:{session_id}"
+
     def get_session_history(self, session_id) -> BaseChatMessageHistory:
         """Return the Message history with a chain if it is present
 
@@ -112,10 +297,76 @@ class KnowmeChain:
             The message history if present. Otherwise a new
             Message History is created.
         """
-        if session_id not in self.session_store:
-            self.session_store[session_id] = ChatMessageHistory()
+        return self.session_store.get_history(self._session_key(session_id))
+
+    def _timer(self, session_id: str) -> Optional[StageTimer]:
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.timer(self.history_namespace, session_id)
+
+    @staticmethod
+    def _run_config(session_id: str, timer: Optional[StageTimer]) -> RunnableConfig:
+        config: RunnableConfig = {"configurable": {"session_id": session_id}}
+        # The timer records the request when the run ends
+        if timer is not None:
+            config["callbacks"] = [timer]
+        return config
+
+    @staticmethod
+    def _finish_cached(timer: Optional[StageTimer]):
+        if timer is not None:
+            timer.finish(cached=True)
+
+    def _is_cacheable(self, user_input: str, session_id: str) -> bool:
+        # Only the questions that start a session or can be understood
+        # on their own are cached. The other questions refer to the earlier answers
+        if self.answer_cache is None:
+            return False
+        history = self.get_session_history(session_id)
+        return not history.messages or self.rewrite_policy.is_self_contained(user_input)
+
+    def _cached_output(
+        self, user_input: str, session_id: str, answer: str
+    ) -> dict[str, Any]:
+        # The cached answer is added to the history so
+        # that the next questions can refer to it
+        history = self.get_session_history(session_id)
+        history.add_user_message(user_input)
+        history.add_ai_message(answer)
+        return {
+            "input": user_input,
+            "chat_history": [],
+            "context": [],
+            "answer": answer,
+            "cached": True,
+        }
+
+    @staticmethod
+    def _cached_chunks(output: dict[str, Any]) -> list[dict[str, Any]]:
+        # The cached answer is streamed word by word like the answers of
+        # the model. The first chunk carries the other keys of the output
+        words = re.findall(r"\s*\S+(?:\s+$)?", output["answer"]) or [""]
+        first = {key: value for key, value in output.items() if key != "answer"}
+        first["answer"] = words[0]
+        return [first] + [{"answer": word, "cached": True} for word in words[1:]]
 
-        return self.session_store[session_id]
+    def _caching_stream(self, stream: Iterator, user_input: str) -> Iterator:
+        answer = []
+        for chunk in stream:
+            if chunk.get("answer"):
+                answer.append(chunk["answer"])
+            yield chunk
+        self.answer_cache.put(user_input, "".join(answer), scope=self.store_version)
+
+    async def _acaching_stream(
+        self, stream: AsyncIterator, user_input: str
+    ) -> AsyncIterator:
+        answer = []
+        async for chunk in stream:
+            if chunk.get("answer"):
+                answer.append(chunk["answer"])
+            yield chunk
+        self.answer_cache.put(user_input, "".join(answer), scope=self.store_version)
 
     def chat(self, user_input: str, session_id: str):
         """Return the response from the chat agent
@@ -127,14 +378,26 @@ class KnowmeChain:
         session_id : str
             The session id that the input belongs to
         """
+        timer = self._timer(session_id)
+        is_cacheable = self._is_cacheable(user_input, session_id)
+        if is_cacheable:
+            answer = self.answer_cache.get(user_input, scope=self.store_version)
+            if answer is not None:
+                self._finish_cached(timer)
+                return self._cached_output(user_input, session_id, answer)
 
-        return self.knowme_chain.invoke(
+        output = self.knowme_chain.invoke(
             {"input": user_input},
-            config={
-                "configurable": {"session_id": session_id},
-            },
+            config=self._run_config(session_id, timer),
         )
 
+        if is_cacheable:
+            self.answer_cache.put(
+                user_input, output["answer"], scope=self.store_version
+            )
+
+        return output
+
     def chat_stream(self, user_input: str, session_id: str):
         """Returns a stream to the client
 
@@ -152,11 +415,94 @@ class KnowmeChain:
         Stream
             A langchain stream. This can be used for building the UI
             The stream can be used with streamlit or other libraries that
-            support streaming from langchain
+            support streaming from langchain. A cached answer is
+            streamed word by word
+        """
+        timer = self._timer(session_id)
+        is_cacheable = self._is_cacheable(user_input, session_id)
+        if is_cacheable:
+            answer = self.answer_cache.get(user_input, scope=self.store_version)
+            if answer is not None:
+                self._finish_cached(timer)
+                output = self._cached_output(user_input, session_id, answer)
+                return iter(self._cached_chunks(output))
+
+        stream = self.knowme_chain.stream(
+            {"input": user_input},
+            config=self._run_config(session_id, timer),
+        )
+
+        if is_cacheable:
+            return self._caching_stream(stream, user_input)
+        return stream
+
+    async def achat(self, user_input: str, session_id: str):
+        """Return the response from the chat agent asynchronously
+
+        Parameters
+        ----------
+        user_input : str
+            The user typed query
+        session_id : str
+            The session id that the input belongs to
+        """
+        timer = self._timer(session_id)
+        is_cacheable = self._is_cacheable(user_input, session_id)
+        if is_cacheable:
+            answer = self.answer_cache.get(user_input, scope=self.store_version)
+            if answer is not None:
+                self._finish_cached(timer)
+                return self._cached_output(user_input, session_id, answer)
+
+        output = await self.knowme_chain.ainvoke(
+            {"input": user_input},
+            config=self._run_config(session_id, timer),
+        )
+
+        if is_cacheable:
+            self.answer_cache.put(
+                user_input, output["answer"], scope=self.store_version
+            )
+
+        return output
+
+    def achat_stream(self, user_input: str, session_id: str):
+        """Returns an async stream to the client
+
+        Parameters
+        ----------
+        user_input : str
+            The user typed query
+
+        session_id : str
+            The session id which is a unique identifier of the
+            chat that you have had to the input.
+
+        Returns
+        -------
+        AsyncIterator
+            A langchain async stream. The chunks are the same as
+            the ones of `chat_stream`
         """
-        return self.knowme_chain.stream(
+        timer = self._timer(session_id)
+        is_cacheable = self._is_cacheable(user_input, session_id)
+        if is_cacheable:
+            answer = self.answer_cache.get(user_input, scope=self.store_version)
+            if answer is not None:
+                self._finish_cached(timer)
+                output = self._cached_output(user_input, session_id, answer)
+                return self._aiter(self._cached_chunks(output))
+
+        stream = self.knowme_chain.astream(
             {"input": user_input},
-            config={
-                "configurable": {"session_id": session_id},
-            },
+            config=self._run_config(session_id, timer),
         )
+
+        if is_cacheable:
+            return self._acaching_stream(stream, user_input)
+        return stream
+
+    @staticmethod
+    async def _aiter(chunks: list) -> AsyncIterator:
+        for chunk in chunks:
+            yield chunk
@@ -1,34 +1,238 @@
 import os
-from typing import Optional
+import threading
+from typing import Any, BinaryIO, Optional, Union
 
 from dotenv import load_dotenv
 from langchain.text_splitter import TextSplitter
 from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 
-from knowme.embedder import ChromaEmbedder
-from knowme.ingest import NotionIngestor, CVIngestor
+from knowme.agent import KnowMeAgent
+from knowme.answer_cache import AnswerCache
+from knowme.artifact_cache import ArtifactCache
+from knowme.compaction import ContextCompactor
+from knowme.embedder import ChromaEmbedder, Embedder, NumpyEmbedder
+from knowme.embedding_batcher import BatchingEmbeddings
+from knowme.embedding_cache import CachedEmbeddings
+from knowme.history_window import HistoryWindow
+from knowme.instrumentation import Instrumentation
+from knowme.ingest import (
+    NotionIngestor,
+    CVIngestor,
+    file_sha256,
+    folder_fingerprint,
+    zip_fingerprint,
+)
 from knowme.knowme_chain import KnowmeChain
+from knowme.manifest import embedding_name, splitter_config
+from knowme.registry import ChainRegistry, chain_registry
+from knowme.session_store import SessionStore
+from knowme.store_paths import StoreResolver
 
 # Load the environment variables
 load_dotenv()
 
+# How the CVs are read by default. The "fast" mode
+# reads the text layer of the pdf with pypdf instead
+DEFAULT_CV_EXTRACTION = "unstructured"
+
+# The kinds of vector stores that the chains can be loaded with
+EMBEDDERS: dict[str, type[Embedder]] = {
+    "chroma": ChromaEmbedder,
+    "numpy": NumpyEmbedder,
+}
+
+# The query batchers shared by the chains of the process. The queries of
+# all the chains that use the same embedding model are batched together
+_query_batchers: dict[tuple, BatchingEmbeddings] = {}
+_query_batchers_lock = threading.Lock()
+
+
+def shared_query_batcher(
+    embedding_function: Embeddings,
+    query_batch_window_ms: float,
+    query_batch_size: int = 64,
+    key: Optional[str] = None,
+) -> BatchingEmbeddings:
+    """The batcher of the queries of an embedding model. It is
+    created by the first chain and shared by all the later ones
+
+    Parameters
+    ----------
+    embedding_function : Embeddings
+        The embedding function whose queries are batched
+    query_batch_window_ms : float
+        The queries that arrive within this many
+        milliseconds are embedded with one request
+    query_batch_size : int, optional
+        The maximum number of queries in one request, by default 64
+    key : Optional[str], optional
+        The batcher is shared by the embedding functions with the same key,
+        by default None. The given embedding function is only shared
+        with itself if this is None
+
+    Returns
+    -------
+    BatchingEmbeddings
+        The batcher
+    """
+    batcher_key = (
+        key if key is not None else id(embedding_function),
+        query_batch_window_ms,
+        query_batch_size,
+    )
+    with _query_batchers_lock:
+        batcher = _query_batchers.get(batcher_key)
+        if batcher is None:
+            batcher = BatchingEmbeddings(
+                embedding_function=embedding_function,
+                max_wait_ms=query_batch_window_ms,
+                max_batch_size=query_batch_size,
+            )
+            _query_batchers[batcher_key] = batcher
+        return batcher
+
+
+def create_embedding_function(
+    embedding_function: Optional[Embeddings] = None,
+    embedding_cache_dir: Optional[str] = None,
+    query_batch_window_ms: Optional[float] = None,
+    query_batch_size: int = 64,
+) -> Embeddings:
+    """The embedding function used by the loaders
+
+    Parameters
+    ----------
+    embedding_function : Optional[Embeddings], optional
+        The embedding function to use, by default None
+        The OpenAI embeddings are used if this is None
+    embedding_cache_dir : Optional[str], optional
+        If provided, the embeddings are cached on disk
+        in this directory, by default None
+    query_batch_window_ms : Optional[float], optional
+        If provided, the queries that arrive within this many milliseconds
+        are embedded with one request, by default None. The batcher is
+        shared with the other embedding functions of the same model
+    query_batch_size : int, optional
+        The maximum number of queries in one request, by default 64
+
+    Returns
+    -------
+    Embeddings
+        The embedding function
+    """
+    # The OpenAI embeddings of the process share a batcher
+    batcher_key = None
+    if embedding_function is None:
+        embedding_function = OpenAIEmbeddings(
+            openai_api_key=os.environ["OPENAI_API_KEY"]
+        )
+        batcher_key = embedding_name(embedding_function)
+
+    # The cache is in front of the batches so that
+    # the cached queries do not wait for the window
+    if query_batch_window_ms is not None:
+        embedding_function = shared_query_batcher(
+            embedding_function,
+            query_batch_window_ms,
+            query_batch_size=query_batch_size,
+            key=batcher_key,
+        )
+
+    if embedding_cache_dir is not None:
+        embedding_function = CachedEmbeddings(
+            embedding_function=embedding_function, cache_dir=embedding_cache_dir
+        )
+
+    return embedding_function
+
+
+def default_splitter() -> TextSplitter:
+    """The splitter used by the loaders when none is given"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, add_start_index=True
+    )
+
+
+def create_embedder(
+    vector_store: str,
+    embedding_function: Embeddings,
+    embedding_store_directory: str,
+    keyword_index: bool = False,
+) -> Embedder:
+    """The embedder that builds the vector store
+
+    Parameters
+    ----------
+    vector_store : str
+        The kind of vector store. One of "chroma" or "numpy"
+    embedding_function : Embeddings
+        The embedding function
+    embedding_store_directory : str
+        Location where the embeddings will be stored
+    keyword_index : bool, optional
+        Build and load the BM25 index of the store for
+        the hybrid search, by default False
+
+    Returns
+    -------
+    Embedder
+        The embedder for the kind of vector store
+    """
+    if vector_store not in EMBEDDERS:
+        raise ValueError(
+            f"Unknown vector store {vector_store}. "
+            f"Choose one of {', '.join(EMBEDDERS)}"
+        )
+    return EMBEDDERS[vector_store](
+        embedding_function=embedding_function,
+        embedding_store_directory=embedding_store_directory,
+        keyword_index=keyword_index,
+    )
+
+
+def _history_scope(embedding_store_directory: Optional[str]) -> Optional[str]:
+    # The chains of different stores never share a history,
+    # even when the same session id is sent to both
+    if not embedding_store_directory:
+        return None
+    return os.path.basename(os.path.normpath(embedding_store_directory))
+
 
 def load_site_answer_chain(
-    notion_folderpath: str,
+    notion_folderpath: Union[str, BinaryIO],
     embedding_store_directory: str,
     embedding_function: Optional[Embeddings] = None,
     splitter: Optional[TextSplitter] = None,
     openai_model: Optional[str] = "gpt-4",
+    incremental: bool = False,
+    ingest_workers: Optional[int] = None,
+    embedding_cache_dir: Optional[str] = None,
+    artifact_cache_dir: Optional[str] = None,
+    cache_answers: bool = False,
+    semantic_cache: bool = False,
+    rewrite_model: Optional[str] = None,
+    session_store: Optional[SessionStore] = None,
+    history_token_budget: Optional[int] = None,
+    vector_store: str = "chroma",
+    hybrid_search: bool = False,
+    context_token_budget: Optional[int] = 2000,
+    llm: Optional[BaseChatModel] = None,
+    rewrite_llm: Optional[BaseChatModel] = None,
+    instrumentation: Optional[Instrumentation] = None,
+    query_batch_window_ms: Optional[float] = None,
+    query_batch_size: int = 64,
 ):
     """This loads the site answer chain, with some default decisions made by the code
 
     Parameters
     ----------
-    notion_folderpath : str
+    notion_folderpath : Union[str, BinaryIO]
         Folderpath where the information about the site is stored
+        This can also be the exported .zip file, by its path or as a file
     embedding_store_directory : str
         Location where the embeddings will be stored
     embedding_function : Optional[Embeddings], optional
@@ -37,27 +241,136 @@ def load_site_answer_chain(
         A splitter that splits the documents into smaller pieces of text, by default None
     openai_mdoel : Optional[str], optional
         The name of the openai model, by default "gpt4"
+    incremental : bool, optional
+        If True, the store is updated incrementally. Only the markdown
+        files that were added or changed are embedded and the chunks of
+        removed files are deleted, by default False
+    ingest_workers : Optional[int], optional
+        The number of threads that read and split the markdown files
+        in parallel, by default None
+    embedding_cache_dir : Optional[str], optional
+        If provided, the embeddings are cached on disk in this directory
+        and reused when the store is rebuilt, by default None
+    artifact_cache_dir : Optional[str], optional
+        If provided, the parsed and split chunks are cached on disk in this
+        directory by the content of the files, by default None
+    cache_answers : bool, optional
+        Cache the answers to the questions that start a session. The
+        same question is answered from the cache, by default False
+        The answers are shared by all the sessions of the chain
+    semantic_cache : bool, optional
+        The cached answers are also reused for similar questions, by
+        default False. Every question is embedded once more for this
+    rewrite_model : Optional[str], optional
+        The openai model that rewrites the follow up questions with the help
+        of the chat history, by default None. The model that answers
+        rewrites them if this is None. A smaller model such as
+        "gpt-3.5-turbo" rewrites faster
+    session_store : Optional[SessionStore], optional
+        Stores the chat histories, by default None
+        The store shared by the process is used if this is None
+    history_token_budget : Optional[int], optional
+        If provided, the number of tokens of the chat history that are
+        sent to the llm, by default None. The older turns are summarized
+        by the rewrite model beyond this, which costs an llm call. The
+        whole history is sent if this is None
+    vector_store : str, optional
+        The kind of vector store, by default "chroma". The "numpy" store
+        keeps the embeddings in a memory mapped matrix. It opens and
+        searches faster for the few thousand chunks of a profile
+    hybrid_search : bool, optional
+        Fuse the vector search with a BM25 keyword search, by default False
+        This finds the chunks that name the exact company, paper or tool.
+        The BM25 index is only built and stored next to the store if True
+    context_token_budget : Optional[int], optional
+        The number of tokens of the retrieved chunks that are stuffed into
+        the prompt, by default 2000. The overlapping chunks of a file are
+        merged and the near duplicates are dropped before that. The chunks
+        are stuffed as they are retrieved if this is None
+    llm : Optional[BaseChatModel], optional
+        The chat model that answers the questions, by default None
+        A ChatOpenAI model of `openai_model` is used if this is None
+    rewrite_llm : Optional[BaseChatModel], optional
+        The chat model that rewrites the follow up questions, by default None
+        A ChatOpenAI model of `rewrite_model` is used if this is None,
+        or the answering model if both are None
+    instrumentation : Optional[Instrumentation], optional
+        If provided, the time, the tokens and the chunks of every stage
+        of the requests are recorded, by default None
+    query_batch_window_ms : Optional[float], optional
+        If provided, the queries of concurrent sessions that arrive within
+        this many milliseconds are embedded with one request, by default None
+    query_batch_size : int, optional
+        The maximum number of queries in one request, by default 64
     """
 
-    if embedding_function is None:
-        embedding_function = OpenAIEmbeddings(
-            openai_api_key=os.environ["OPENAI_API_KEY"]
-        )
+    embedding_function = create_embedding_function(
+        embedding_function,
+        embedding_cache_dir,
+        query_batch_window_ms=query_batch_window_ms,
+        query_batch_size=query_batch_size,
+    )
 
     if splitter is None:
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200, add_start_index=True
-        )
+        splitter = default_splitter()
 
-    ingestor = NotionIngestor(folder_path=notion_folderpath, splitter=splitter)
-    documents = ingestor.ingest()
-    store = ChromaEmbedder(
-        embedding_function=embedding_function,
-        embedding_store_directory=embedding_store_directory,
+    artifact_cache = None
+    if artifact_cache_dir is not None:
+        artifact_cache = ArtifactCache(artifact_cache_dir)
+
+    ingestor = NotionIngestor(
+        folder_path=notion_folderpath,
+        splitter=splitter,
+        num_workers=ingest_workers,
+        artifact_cache=artifact_cache,
+    )
+    store = create_embedder(
+        vector_store,
+        embedding_function,
+        embedding_store_directory,
+        keyword_index=hybrid_search,
+    )
+    if incremental:
+        vectorstore = store.sync_embeddings(ingestor)
+    else:
+        # The documents are only ingested if the store has to be built
+        vectorstore = store.store_embeddings(
+            ingestor.iter_documents, source=ingestor.source_info()
+        )
+    if llm is None:
+        llm = ChatOpenAI(model=openai_model, api_key=os.environ["OPENAI_API_KEY"])
+    if rewrite_llm is None and rewrite_model is not None:
+        rewrite_llm = ChatOpenAI(
+            model=rewrite_model, temperature=0, api_key=os.environ["OPENAI_API_KEY"]
+        )
+    answer_cache = None
+    if cache_answers:
+        # The exact tier does not embed the questions
+        answer_cache = AnswerCache(embedding_function if semantic_cache else None)
+    history_window = None
+    if history_token_budget is not None:
+        history_window = HistoryWindow(
+            llm=rewrite_llm if rewrite_llm is not None else llm,
+            max_tokens=history_token_budget,
+        )
+    chain = KnowmeChain(
+        llm,
+        vectorstore,
+        answer_cache=answer_cache,
+        store_version=store.store_version(),
+        rewrite_llm=rewrite_llm,
+        session_store=session_store,
+        history_window=history_window,
+        keyword_index=store.keyword_index,
+        context_compactor=(
+            ContextCompactor(max_tokens=context_token_budget)
+            if context_token_budget is not None
+            else None
+        ),
+        history_namespace="site",
+        history_scope=_history_scope(embedding_store_directory),
+        instrumentation=instrumentation,
     )
-    chromastore = store.store_embeddings(documents)
-    llm = ChatOpenAI(model=openai_model, api_key=os.environ["OPENAI_API_KEY"])
-    chain = KnowmeChain(llm, chromastore)
     return chain
 
 
@@ -67,6 +380,23 @@ def load_cv_answer_chain(
     embedding_function: Optional[Embeddings] = None,
     splitter: Optional[TextSplitter] = None,
     openai_model: Optional[str] = "gpt-4",
+    embedding_cache_dir: Optional[str] = None,
+    artifact_cache_dir: Optional[str] = None,
+    cache_answers: bool = False,
+    semantic_cache: bool = False,
+    rewrite_model: Optional[str] = None,
+    session_store: Optional[SessionStore] = None,
+    history_token_budget: Optional[int] = None,
+    vector_store: str = "chroma",
+    hybrid_search: bool = False,
+    context_token_budget: Optional[int] = 2000,
+    cv_extraction: str = DEFAULT_CV_EXTRACTION,
+    ingest_workers: Optional[int] = None,
+    llm: Optional[BaseChatModel] = None,
+    rewrite_llm: Optional[BaseChatModel] = None,
+    instrumentation: Optional[Instrumentation] = None,
+    query_batch_window_ms: Optional[float] = None,
+    query_batch_size: int = 64,
 ):
     """This loads the site answer chain, with some default decisions made.
     This is a convenience method that can be used to load the chain
@@ -83,25 +413,498 @@ def load_cv_answer_chain(
         A splitter that splits the documents into smaller pieces of text, by default None
     openai_mdoel : Optional[str], optional
         The name of the openai model, by default "gpt4"
+    embedding_cache_dir : Optional[str], optional
+        If provided, the embeddings are cached on disk in this directory
+        and reused when the store is rebuilt, by default None
+    artifact_cache_dir : Optional[str], optional
+        If provided, the parsed and split chunks are cached on disk in this
+        directory by the content of the files, by default None
+    cache_answers : bool, optional
+        Cache the answers to the questions that start a session. The
+        same question is answered from the cache, by default False
+        The answers are shared by all the sessions of the chain
+    semantic_cache : bool, optional
+        The cached answers are also reused for similar questions, by
+        default False. Every question is embedded once more for this
+    rewrite_model : Optional[str], optional
+        The openai model that rewrites the follow up questions with the help
+        of the chat history, by default None. The model that answers
+        rewrites them if this is None. A smaller model such as
+        "gpt-3.5-turbo" rewrites faster
+    session_store : Optional[SessionStore], optional
+        Stores the chat histories, by default None
+        The store shared by the process is used if this is None
+    history_token_budget : Optional[int], optional
+        If provided, the number of tokens of the chat history that are
+        sent to the llm, by default None. The older turns are summarized
+        by the rewrite model beyond this, which costs an llm call. The
+        whole history is sent if this is None
+    vector_store : str, optional
+        The kind of vector store, by default "chroma". The "numpy" store
+        keeps the embeddings in a memory mapped matrix. It opens and
+        searches faster for the few thousand chunks of a profile
+    hybrid_search : bool, optional
+        Fuse the vector search with a BM25 keyword search, by default False
+        This finds the chunks that name the exact company, paper or tool.
+        The BM25 index is only built and stored next to the store if True
+    context_token_budget : Optional[int], optional
+        The number of tokens of the retrieved chunks that are stuffed into
+        the prompt, by default 2000. The overlapping chunks of a file are
+        merged and the near duplicates are dropped before that. The chunks
+        are stuffed as they are retrieved if this is None
+    cv_extraction : str, optional
+        Either "fast" or "unstructured", by default "unstructured". The
+        "fast" mode reads the text layer of the pdf and uses unstructured
+        only for the pages without text
+    ingest_workers : Optional[int], optional
+        The number of processes that read the pages of the pdf in parallel
+        in the "fast" mode, by default None. The pages are read one
+        after the other if this is None or 1
+    llm : Optional[BaseChatModel], optional
+        The chat model that answers the questions, by default None
+        A ChatOpenAI model of `openai_model` is used if this is None
+    rewrite_llm : Optional[BaseChatModel], optional
+        The chat model that rewrites the follow up questions, by default None
+        A ChatOpenAI model of `rewrite_model` is used if this is None,
+        or the answering model if both are None
+    instrumentation : Optional[Instrumentation], optional
+        If provided, the time, the tokens and the chunks of every stage
+        of the requests are recorded, by default None
+    query_batch_window_ms : Optional[float], optional
+        If provided, the queries of concurrent sessions that arrive within
+        this many milliseconds are embedded with one request, by default None
+    query_batch_size : int, optional
+        The maximum number of queries in one request, by default 64
     """
 
-    if embedding_function is None:
-        embedding_function = OpenAIEmbeddings(
-            openai_api_key=os.environ["OPENAI_API_KEY"]
-        )
+    embedding_function = create_embedding_function(
+        embedding_function,
+        embedding_cache_dir,
+        query_batch_window_ms=query_batch_window_ms,
+        query_batch_size=query_batch_size,
+    )
 
     if splitter is None:
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200, add_start_index=True
-        )
+        splitter = default_splitter()
 
-    ingestor = CVIngestor(filename=cv_filepath, splitter=splitter)
-    documents = ingestor.ingest()
-    store = ChromaEmbedder(
-        embedding_function=embedding_function,
-        embedding_store_directory=embedding_store_directory,
+    artifact_cache = None
+    if artifact_cache_dir is not None:
+        artifact_cache = ArtifactCache(artifact_cache_dir)
+
+    ingestor = CVIngestor(
+        filename=cv_filepath,
+        splitter=splitter,
+        mode=cv_extraction,
+        num_workers=ingest_workers,
+        artifact_cache=artifact_cache,
+    )
+    store = create_embedder(
+        vector_store,
+        embedding_function,
+        embedding_store_directory,
+        keyword_index=hybrid_search,
+    )
+    # The documents are only ingested if the store has to be built
+    vectorstore = store.store_embeddings(ingestor.ingest, source=ingestor.source_info())
+    if llm is None:
+        llm = ChatOpenAI(model=openai_model, api_key=os.environ["OPENAI_API_KEY"])
+    if rewrite_llm is None and rewrite_model is not None:
+        rewrite_llm = ChatOpenAI(
+            model=rewrite_model, temperature=0, api_key=os.environ["OPENAI_API_KEY"]
+        )
+    answer_cache = None
+    if cache_answers:
+        # The exact tier does not embed the questions
+        answer_cache = AnswerCache(embedding_function if semantic_cache else None)
+    history_window = None
+    if history_token_budget is not None:
+        history_window = HistoryWindow(
+            llm=rewrite_llm if rewrite_llm is not None else llm,
+            max_tokens=history_token_budget,
+        )
+    chain = KnowmeChain(
+        llm,
+        vectorstore,
+        answer_cache=answer_cache,
+        store_version=store.store_version(),
+        rewrite_llm=rewrite_llm,
+        session_store=session_store,
+        history_window=history_window,
+        keyword_index=store.keyword_index,
+        context_compactor=(
+            ContextCompactor(max_tokens=context_token_budget)
+            if context_token_budget is not None
+            else None
+        ),
+        history_namespace="cv",
+        history_scope=_history_scope(embedding_store_directory),
+        instrumentation=instrumentation,
     )
-    chromastore = store.store_embeddings(documents)
-    llm = ChatOpenAI(model=openai_model, api_key=os.environ["OPENAI_API_KEY"])
-    chain = KnowmeChain(llm, chromastore)
     return chain
+
+
+def _kwargs_key(kwargs: dict[str, Any]) -> tuple:
+    # The options of the loaders are part of the key. The objects, such
+    # as the models and the stores, are known by their identity. The
+    # chain holds them, so an id is not reused while the chain is cached
+    return tuple(
+        sorted(
+            (
+                name,
+                (
+                    value
+                    if isinstance(value, (str, int, float, bool, type(None)))
+                    else ("id", id(value))
+                ),
+            )
+            for name, value in kwargs.items()
+        )
+    )
+
+
+def _registry_key(
+    source_type: str,
+    source: Union[str, BinaryIO],
+    embedding_store_directory: str,
+    openai_model: Optional[str],
+    splitter: Optional[TextSplitter],
+    kwargs: dict[str, Any],
+) -> tuple:
+    # The sources are known by their content, so an export
+    # that is edited in place loads a new chain
+    if hasattr(source, "read"):
+        source = f"zip:{zip_fingerprint(source)}"
+    elif source_type == "site":
+        source = f"notion:{notion_content_hash(source)}"
+    else:
+        source = f"{source_type}:{file_sha256(source)}"
+
+    splitter_key = None
+    if splitter is not None:
+        splitter_key = tuple(sorted(splitter_config(splitter).items()))
+    return (
+        source_type,
+        source,
+        str(embedding_store_directory),
+        openai_model,
+        splitter_key,
+        _kwargs_key(kwargs),
+    )
+
+
+def get_site_answer_chain(
+    notion_folderpath: Union[str, BinaryIO],
+    embedding_store_directory: str,
+    splitter: Optional[TextSplitter] = None,
+    openai_model: Optional[str] = "gpt-4",
+    registry: ChainRegistry = chain_registry,
+    **kwargs,
+) -> KnowmeChain:
+    """Returns the site answer chain from the registry.
+    The chain is loaded with `load_site_answer_chain` only the first time
+    it is requested for the same content, store, model, splitter and options
+
+    Parameters
+    ----------
+    notion_folderpath : Union[str, BinaryIO]
+        Folderpath where the information about the site is stored
+        This can also be the exported .zip file, by its path or as a file
+    embedding_store_directory : str
+        Location where the embeddings will be stored
+    splitter : Optional[TextSplitter], optional
+        A splitter that splits the documents into smaller pieces of text, by default None
+    openai_model : Optional[str], optional
+        The name of the openai model, by default "gpt-4"
+    registry : ChainRegistry, optional
+        The registry of the chains, by default the one shared by the process
+    kwargs
+        Passed to `load_site_answer_chain`
+    """
+    key = _registry_key(
+        "site",
+        notion_folderpath,
+        embedding_store_directory,
+        openai_model,
+        splitter,
+        kwargs,
+    )
+    return registry.get_or_create(
+        key,
+        lambda: load_site_answer_chain(
+            notion_folderpath=notion_folderpath,
+            embedding_store_directory=embedding_store_directory,
+            splitter=splitter,
+            openai_model=openai_model,
+            **kwargs,
+        ),
+    )
+
+
+def get_cv_answer_chain(
+    cv_filepath: str,
+    embedding_store_directory: str,
+    splitter: Optional[TextSplitter] = None,
+    openai_model: Optional[str] = "gpt-4",
+    registry: ChainRegistry = chain_registry,
+    **kwargs,
+) -> KnowmeChain:
+    """Returns the cv answer chain from the registry.
+    The chain is loaded with `load_cv_answer_chain` only the first time
+    it is requested for the same content, store, model, splitter and options
+
+    Parameters
+    ----------
+    cv_filepath : str
+        The path of the CV
+    embedding_store_directory : str
+        Location where the embeddings will be stored
+    splitter : Optional[TextSplitter], optional
+        A splitter that splits the documents into smaller pieces of text, by default None
+    openai_model : Optional[str], optional
+        The name of the openai model, by default "gpt-4"
+    registry : ChainRegistry, optional
+        The registry of the chains, by default the one shared by the process
+    kwargs
+        Passed to `load_cv_answer_chain`
+    """
+    key = _registry_key(
+        "cv",
+        cv_filepath,
+        embedding_store_directory,
+        openai_model,
+        splitter,
+        kwargs,
+    )
+    return registry.get_or_create(
+        key,
+        lambda: load_cv_answer_chain(
+            cv_filepath=cv_filepath,
+            embedding_store_directory=embedding_store_directory,
+            splitter=splitter,
+            openai_model=openai_model,
+            **kwargs,
+        ),
+    )
+
+
+def get_agent(
+    website_chain: KnowmeChain,
+    cv_chain: KnowmeChain,
+    openai_model: Optional[str] = "gpt-4",
+    fan_out: bool = False,
+    registry: ChainRegistry = chain_registry,
+    llm: Optional[BaseChatModel] = None,
+    instrumentation: Optional[Instrumentation] = None,
+) -> KnowMeAgent:
+    """Returns the agent for the two chains from the registry
+
+    Parameters
+    ----------
+    website_chain : KnowmeChain
+        The chain that answers questions about the website
+    cv_chain : KnowmeChain
+        The chain that answers questions from the CV
+    openai_model : Optional[str], optional
+        The model used by the agent to chose the tools, by default "gpt-4"
+    fan_out : bool, optional
+        Ask both chains concurrently and combine their answers instead
+        of letting the agent chose the tools, by default False
+    registry : ChainRegistry, optional
+        The registry of the chains, by default the one shared by the process
+    llm : Optional[BaseChatModel], optional
+        The chat model of the agent, by default None
+        A ChatOpenAI model of `openai_model` is used if this is None
+    instrumentation : Optional[Instrumentation], optional
+        If provided, the time and the tokens of the turns of the agent
+        are recorded, by default None
+    """
+    # The agent holds a reference to the chains. The ids are not reused
+    # while the agent is in the registry
+    key = (
+        "agent",
+        id(website_chain),
+        id(cv_chain),
+        openai_model,
+        fan_out,
+        id(llm) if llm is not None else None,
+        id(instrumentation) if instrumentation is not None else None,
+    )
+    return registry.get_or_create(
+        key,
+        lambda: KnowMeAgent(
+            website_chain=website_chain,
+            cv_chain=cv_chain,
+            openai_model=openai_model,
+            fan_out=fan_out,
+            llm=llm,
+            instrumentation=instrumentation,
+        ),
+    )
+
+
+def notion_content_hash(notion_path: str) -> str:
+    """The hash of the markdown files of a Notion export, a folder or a zip"""
+    if str(notion_path).endswith(".zip"):
+        return zip_fingerprint(notion_path)
+    # The same value as the fingerprint in the manifest of the store
+    return folder_fingerprint(notion_path)
+
+
+def resolve_source_stores(
+    resolver: StoreResolver,
+    embedding: Union[str, Embeddings],
+    notion_path: Optional[str] = None,
+    cv_path: Optional[str] = None,
+    splitter: Optional[TextSplitter] = None,
+    vector_store: str = "chroma",
+    cv_extraction: str = DEFAULT_CV_EXTRACTION,
+) -> dict[str, str]:
+    """The directories of the stores of the sources, resolved by their
+    content like the app does. The same sources share the same stores
+
+    Parameters
+    ----------
+    resolver : StoreResolver
+        Resolves the directories of the stores
+    embedding : Union[str, Embeddings]
+        The embedding function or its name from `embedding_name`
+    notion_path : Optional[str], optional
+        The folder or the .zip file of the Notion export, by default None
+    cv_path : Optional[str], optional
+        The path of the CV, by default None
+    splitter : Optional[TextSplitter], optional
+        The splitter of the sources, by default `default_splitter`
+    vector_store : str, optional
+        The kind of vector store, by default "chroma"
+    cv_extraction : str, optional
+        How the CV is read, "fast" or "unstructured", by default
+        "unstructured". It has to be the one the CV chain is loaded with
+
+    Returns
+    -------
+    dict[str, str]
+        The directory of the store of the "site" and of the "cv"
+    """
+    if splitter is None:
+        splitter = default_splitter()
+
+    directories = {}
+    if notion_path is not None:
+        directories["site"] = resolver.resolve(
+            name=str(notion_path),
+            kind="notion",
+            content_hash=notion_content_hash(notion_path),
+            embedding=embedding,
+            splitter=splitter,
+            vector_store=vector_store,
+        )
+    if cv_path is not None:
+        directories["cv"] = resolver.resolve(
+            name=str(cv_path),
+            kind="cv",
+            content_hash=file_sha256(cv_path),
+            embedding=embedding,
+            splitter=splitter,
+            vector_store=vector_store,
+            mode=cv_extraction,
+        )
+    return directories
+
+
+def load_sources(
+    stores_dir: str,
+    notion_path: Optional[str] = None,
+    cv_path: Optional[str] = None,
+    vector_store: str = "chroma",
+    openai_model: Optional[str] = "gpt-4",
+    fan_out: bool = False,
+    instrumentation: Optional[Instrumentation] = None,
+    registry: ChainRegistry = chain_registry,
+    store_directories: Optional[dict[str, str]] = None,
+    cv_extraction: str = DEFAULT_CV_EXTRACTION,
+    **kwargs,
+) -> dict[str, Union[KnowmeChain, KnowMeAgent]]:
+    """Loads the chains of a Notion export and a CV. The stores are
+    resolved by the content of the sources with `resolve_source_stores`
+
+    Parameters
+    ----------
+    stores_dir : str
+        The directory of the vector stores
+    notion_path : Optional[str], optional
+        The folder or the .zip file of the Notion export, by default None
+    cv_path : Optional[str], optional
+        The path of the CV, by default None
+    vector_store : str, optional
+        The kind of vector store, by default "chroma"
+    openai_model : Optional[str], optional
+        The name of the openai model, by default "gpt-4"
+    fan_out : bool, optional
+        Ask both chains concurrently in the agent, by default False
+    instrumentation : Optional[Instrumentation], optional
+        Records the time and the tokens of every answer, by default None
+    registry : ChainRegistry, optional
+        The registry of the chains, by default the one shared by the process
+    store_directories : Optional[dict[str, str]], optional
+        The directories of the stores if they are resolved already, by default None
+    cv_extraction : str, optional
+        How the text of the CV is extracted, by default "unstructured"
+    kwargs
+        Passed to the loaders of the chains
+
+    Returns
+    -------
+    dict[str, Union[KnowmeChain, KnowMeAgent]]
+        The chain of every source. The agent is only loaded
+        when both the Notion export and the CV are given
+    """
+    splitter = default_splitter()
+    kwargs.setdefault("embedding_cache_dir", f"{stores_dir}/embedding_cache")
+    kwargs.setdefault("artifact_cache_dir", f"{stores_dir}/artifact_cache")
+    if store_directories is None:
+        embedding = kwargs.get("embedding_function") or create_embedding_function()
+        store_directories = resolve_source_stores(
+            StoreResolver(stores_dir),
+            embedding_name(embedding),
+            notion_path=notion_path,
+            cv_path=cv_path,
+            splitter=splitter,
+            vector_store=vector_store,
+            cv_extraction=cv_extraction,
+        )
+
+    chains = {}
+    if notion_path is not None:
+        chains["site"] = get_site_answer_chain(
+            notion_folderpath=notion_path,
+            embedding_store_directory=store_directories["site"],
+            splitter=splitter,
+            openai_model=openai_model,
+            registry=registry,
+            vector_store=vector_store,
+            instrumentation=instrumentation,
+            **kwargs,
+        )
+    if cv_path is not None:
+        chains["cv"] = get_cv_answer_chain(
+            cv_filepath=cv_path,
+            embedding_store_directory=store_directories["cv"],
+            splitter=splitter,
+            openai_model=openai_model,
+            registry=registry,
+            vector_store=vector_store,
+            instrumentation=instrumentation,
+            cv_extraction=cv_extraction,
+            **kwargs,
+        )
+    if "site" in chains and "cv" in chains:
+        chains["agent"] = get_agent(
+            website_chain=chains["site"],
+            cv_chain=chains["cv"],
+            openai_model=openai_model,
+            fan_out=fan_out,
+            registry=registry,
+            llm=kwargs.get("llm"),
+            instrumentation=instrumentation,
+        )
+    return chains
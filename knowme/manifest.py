@@ -0,0 +1,186 @@
+"""
+The manifest records what a persisted vector store was built from.
+It is written next to the store once the store has been fully built,
+so that a store directory is only reused when it was built from the
+same source, splitter and embedding model.
+"""
+
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+from langchain.text_splitter import TextSplitter
+from langchain_core.embeddings import Embeddings
+
+MANIFEST_FILENAME = "knowme_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def splitter_config(splitter: TextSplitter) -> dict[str, Any]:
+    """Describe the configuration of a splitter
+
+    Parameters
+    ----------
+    splitter : TextSplitter
+        The splitter that is used to split the documents
+
+    Returns
+    -------
+    dict[str, Any]
+        The class name of the splitter along with the
+        parameters that change the chunks that are produced
+    """
+    return {
+        "name": type(splitter).__name__,
+        "chunk_size": getattr(splitter, "_chunk_size", None),
+        "chunk_overlap": getattr(splitter, "_chunk_overlap", None),
+        "add_start_index": getattr(splitter, "_add_start_index", None),
+    }
+
+
+def embedding_name(embedding_function: Embeddings) -> str:
+    """The name of the embedding model
+
+    Parameters
+    ----------
+    embedding_function : Embeddings
+        The embedding function used to embed the documents
+
+    Returns
+    -------
+    str
+        The model name if the embedding function exposes one,
+        otherwise the name of its class. Wrappers such as the
+        embedding cache are named after the function they wrap
+    """
+    while isinstance(
+        getattr(embedding_function, "embedding_function", None), Embeddings
+    ):
+        embedding_function = embedding_function.embedding_function
+
+    model = getattr(embedding_function, "model", None)
+    if isinstance(model, str):
+        return f"{type(embedding_function).__name__}:{model}"
+    return type(embedding_function).__name__
+
+
+class StoreManifest:
+    def __init__(
+        self,
+        source: dict[str, Any],
+        embedding: Optional[str] = None,
+        num_documents: Optional[int] = None,
+        created_at: Optional[str] = None,
+        files: Optional[dict[str, dict[str, Any]]] = None,
+        store: Optional[str] = None,
+    ):
+        """Describes what a vector store was built from
+
+        Parameters
+        ----------
+        source : dict[str, Any]
+            A description of the source. This is provided by the ingestors
+            and includes the splitter configuration
+        embedding : Optional[str], optional
+            The name of the embedding model, by default None
+        num_documents : Optional[int], optional
+            The number of documents in the store, by default None
+        created_at : Optional[str], optional
+            The time at which the store was built, by default None
+        files : Optional[dict[str, dict[str, Any]]], optional
+            Used by the incremental indexing. Maps the relative path of
+            every source file to its content hash, size, modification
+            time and the ids of its chunks in the store, by default None
+        store : Optional[str], optional
+            The kind of vector store, such as "chroma" or "numpy", by default None
+        """
+        self.source = source
+        self.embedding = embedding
+        self.num_documents = num_documents
+        self.created_at = created_at
+        self.files = files
+        self.store = store
+
+    def matches(self, other: "StoreManifest") -> bool:
+        """Whether the store described by this manifest can be reused
+        in place of a store built as described by `other`
+        """
+        # The stores are named after the content of their source. The same
+        # content at another path, such as a copy uploaded for another
+        # profile, is described by the same fingerprint and reuses the store
+        return (
+            self._without_path(self.source) == self._without_path(other.source)
+            and self.embedding == other.embedding
+            and self.store == other.store
+        )
+
+    @staticmethod
+    def _without_path(source: dict[str, Any]) -> dict[str, Any]:
+        return {key: value for key, value in source.items() if key != "path"}
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "version": MANIFEST_VERSION,
+            "source": self.source,
+            "embedding": self.embedding,
+            "num_documents": self.num_documents,
+            "created_at": self.created_at,
+            "files": self.files,
+            "store": self.store,
+        }
+
+    def save(self, directory: str):
+        """Writes the manifest into the store directory
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the vector store
+        """
+        if self.created_at is None:
+            self.created_at = datetime.now(timezone.utc).isoformat()
+
+        path = Path(directory, MANIFEST_FILENAME)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["StoreManifest"]:
+        """Reads the manifest from the store directory
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the vector store
+
+        Returns
+        -------
+        Optional[StoreManifest]
+            The manifest. None if the store has no manifest
+            or the manifest cannot be read
+        """
+        path = Path(directory, MANIFEST_FILENAME)
+        if not path.is_file():
+            return None
+
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+
+        return cls(
+            source=data["source"],
+            embedding=data.get("embedding"),
+            num_documents=data.get("num_documents"),
+            created_at=data.get("created_at"),
+            files=data.get("files"),
+            # The stores built before the kind was recorded are Chroma stores
+            store=data.get("store", "chroma"),
+        )
@@ -0,0 +1,353 @@
+"""
+A vector store that keeps the embeddings in a single float32 matrix.
+A profile has a few hundred to a few thousand chunks. For that size a
+brute force search over a memory mapped matrix is faster to open and
+to query than a client, a database and an approximate index.
+"""
+
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+VECTORS_FILENAME = "vectors.npy"
+DOCUMENTS_FILENAME = "documents.jsonl"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class NumpyVectorStore(VectorStore):
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        persist_directory: Optional[str] = None,
+    ):
+        """Stores the embeddings in a contiguous float32 matrix.
+        The vectors are normalized when they are added, so a search
+        is a single matrix vector product followed by a partial sort
+
+        Parameters
+        ----------
+        embedding_function : Embeddings
+            Embeds the documents and the queries
+        persist_directory : Optional[str], optional
+            If provided, the matrix is stored in this directory as a numpy
+            file and memory mapped when the store is opened, by default None
+            The documents and their metadata are stored next to it
+        """
+        self.embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self._lock = threading.Lock()
+
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        # The rows are added to a buffer that doubles when it is full,
+        # and `_vectors` is a view of the filled rows. Copying the whole
+        # matrix for every batch would be quadratic in the number of rows
+        self._buffer: Optional[np.ndarray] = None
+        # The documents are only created for the search results.
+        # Creating a document for every row slows down opening the store
+        self._ids: list[str] = []
+        self._texts: list[str] = []
+        self._metadatas: list[dict] = []
+        self._index: dict[str, int] = {}
+
+        if persist_directory is not None:
+            self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _load(self):
+        vectors_path = Path(self.persist_directory, VECTORS_FILENAME)
+        documents_path = Path(self.persist_directory, DOCUMENTS_FILENAME)
+        if not vectors_path.is_file() or not documents_path.is_file():
+            return
+
+        with open(documents_path) as fp:
+            for line in fp:
+                record = json.loads(line)
+                self._ids.append(record["id"])
+                self._texts.append(record["page_content"])
+                self._metadatas.append(record["metadata"])
+        self._index = {id_: row for row, id_ in enumerate(self._ids)}
+
+        # The matrix is paged in by the os as it is searched
+        # instead of being read into memory when the store is opened.
+        # An empty file cannot be memory mapped
+        if self._ids:
+            self._vectors = np.load(vectors_path, mmap_mode="r")
+
+    def persist(self):
+        """Writes the matrix and the documents to the persist directory.
+        The files are replaced atomically, so a reader never sees a
+        partially written store"""
+        if self.persist_directory is None:
+            return
+
+        Path(self.persist_directory).mkdir(parents=True, exist_ok=True)
+        vectors_path = Path(self.persist_directory, VECTORS_FILENAME)
+        documents_path = Path(self.persist_directory, DOCUMENTS_FILENAME)
+
+        with self._lock:
+            tmp_path = vectors_path.with_suffix(".tmp.npy")
+            np.save(tmp_path, np.ascontiguousarray(self._vectors))
+            os.replace(tmp_path, vectors_path)
+
+            tmp_path = documents_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as fp:
+                for id_, text, metadata in zip(self._ids, self._texts, self._metadatas):
+                    record = {"id": id_, "page_content": text, "metadata": metadata}
+                    fp.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, documents_path)
+
+    def add_embeddings(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+    ) -> list[str]:
+        """Adds the texts with their embeddings to the store without
+        persisting them. The texts with an id that is already in the
+        store replace the older texts
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts
+        embeddings : list[list[float]]
+            The embeddings of the texts
+        metadatas : Optional[list[dict]], optional
+            The metadata of the texts, by default None
+        ids : Optional[list[str]], optional
+            The ids of the texts, by default None
+            Random ids are used if this is not provided
+
+        Returns
+        -------
+        list[str]
+            The ids of the texts
+        """
+        if not texts:
+            return []
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+
+        with self._lock:
+            if len(self._ids) == 0:
+                self._vectors = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+                self._buffer = None
+            elif vectors.shape[1] != self._vectors.shape[1]:
+                raise ValueError(
+                    f"The embeddings have {vectors.shape[1]} dimensions. "
+                    f"The store has {self._vectors.shape[1]} dimensions"
+                )
+
+            num_rows = len(self._ids)
+            new_rows = []
+            replaced_rows = []
+            for position, id_ in enumerate(ids):
+                metadata = metadatas[position] or {}
+                if id_ in self._index:
+                    row = self._index[id_]
+                    replaced_rows.append((row, position))
+                    self._texts[row] = texts[position]
+                    self._metadatas[row] = metadata
+                else:
+                    self._index[id_] = len(self._ids)
+                    self._ids.append(id_)
+                    self._texts.append(texts[position])
+                    self._metadatas.append(metadata)
+                    new_rows.append(position)
+
+            # A memory mapped matrix is read only. It is copied into the
+            # buffer on the first write. The searches hold on to the earlier
+            # view, so the buffer is also copied when a row is replaced
+            num_filled = num_rows + len(new_rows)
+            buffer = self._buffer
+            if buffer is None or num_filled > len(buffer) or replaced_rows:
+                capacity = num_filled
+                if buffer is not None and num_filled > len(buffer):
+                    capacity = max(num_filled, 2 * len(buffer))
+                elif buffer is not None:
+                    capacity = len(buffer)
+                buffer = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+                buffer[:num_rows] = self._vectors
+
+            buffer[num_rows:num_filled] = vectors[new_rows]
+            for row, position in replaced_rows:
+                buffer[row] = vectors[position]
+            self._buffer = buffer
+            self._vectors = buffer[:num_filled]
+
+        return list(ids)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        embeddings = self.embedding_function.embed_documents(texts)
+        ids = self.add_embeddings(texts, embeddings, metadatas=metadatas, ids=ids)
+        self.persist()
+        return ids
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return True
+
+        with self._lock:
+            removed = {self._index[id_] for id_ in ids if id_ in self._index}
+            if not removed:
+                return True
+            keep = [row for row in range(len(self._ids)) if row not in removed]
+            self._vectors = np.ascontiguousarray(self._vectors[keep])
+            self._buffer = None
+            self._ids = [self._ids[row] for row in keep]
+            self._texts = [self._texts[row] for row in keep]
+            self._metadatas = [self._metadatas[row] for row in keep]
+            self._index = {id_: row for row, id_ in enumerate(self._ids)}
+
+        self.persist()
+        return True
+
+    def existing_ids(self, ids: Iterable[str]) -> list[str]:
+        """The ids that are in the store"""
+        with self._lock:
+            return [id_ for id_ in ids if id_ in self._index]
+
+    def get_documents(self) -> tuple[list[Document], list[str]]:
+        """All the documents in the store with their ids"""
+        with self._lock:
+            documents = [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(self._texts, self._metadatas)
+            ]
+            return documents, list(self._ids)
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: Optional[dict[str, Any]] = None,
+    ) -> list[tuple[Document, float]]:
+        """Returns the documents that are most similar to the vector
+
+        Parameters
+        ----------
+        embedding : list[float]
+            The vector of the query
+        k : int, optional
+            The number of documents to return, by default 4
+        filter : Optional[dict[str, Any]], optional
+            Only the documents whose metadata has these values are
+            returned, by default None
+
+        Returns
+        -------
+        list[tuple[Document, float]]
+            The documents with their cosine similarity to the query,
+            the most similar first
+        """
+        with self._lock:
+            vectors, texts, metadatas = self._vectors, self._texts, self._metadatas
+        if len(texts) == 0 or k <= 0:
+            return []
+
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        scores = vectors @ query
+
+        if filter:
+            mask = np.array(
+                [
+                    all(metadata.get(key) == value for key, value in filter.items())
+                    for metadata in metadatas
+                ]
+            )
+            scores = np.where(mask, scores, -np.inf)
+            k = min(k, int(mask.sum()))
+            if k == 0:
+                return []
+
+        # Only the top k scores are sorted
+        k = min(k, len(scores))
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                Document(page_content=texts[row], metadata=metadatas[row]),
+                float(scores[row]),
+            )
+            for row in top
+        ]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score_by_vector(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(query, k, **kwargs)
+        ]
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        # The cosine similarity of the normalized vectors is mapped to [0, 1]
+        return [
+            (document, (score + 1) / 2)
+            for document, score in self.similarity_search_with_score(query, k, **kwargs)
+        ]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+        persist_directory: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding_function=embedding, persist_directory=persist_directory)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,495 @@
+"""
+A registry of the profiles that are served by one process.
+A profile is a person with a Notion export, a CV or both. Its chains
+are loaded on the first request and closed again once it has been idle
+and the open profiles need more memory than their budget. The chat
+models, the embedding function and the caches are shared by all the
+profiles, so an open profile costs little more than its stores.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_openai import ChatOpenAI
+
+from knowme.agent import KnowMeAgent
+from knowme.embedder import is_store_in_use, release_chroma_client
+from knowme.instrumentation import Instrumentation
+from knowme.knowme_chain import KnowmeChain
+from knowme.load_chains import (
+    DEFAULT_CV_EXTRACTION,
+    create_embedding_function,
+    default_splitter,
+    load_sources,
+    resolve_source_stores,
+)
+from knowme.manifest import embedding_name
+from knowme.registry import ChainRegistry, close_entry
+from knowme.store_paths import StoreResolver
+
+# The profile ids are part of the urls and of the session keys
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# The chains, the keyword indices and the answer caches of a profile
+# are counted on top of the size of its stores
+PROFILE_OVERHEAD_BYTES = 1024 * 1024
+
+
+def directory_size(directory: Union[str, Path]) -> int:
+    """The size of the files in a directory, in bytes"""
+    directory = Path(directory)
+    if not directory.is_dir():
+        return 0
+    return sum(path.stat().st_size for path in directory.rglob("*") if path.is_file())
+
+
+class _OpenProfile:
+    def __init__(
+        self,
+        profile_id: str,
+        chains: dict[str, Union[KnowmeChain, KnowMeAgent]],
+        store_directories: dict[str, str],
+        size_bytes: int,
+    ):
+        self.profile_id = profile_id
+        self.chains = chains
+        self.store_directories = store_directories
+        self.size_bytes = size_bytes
+        self.last_used = time.monotonic()
+        self.active = 0
+
+
+class ProfileRegistry:
+    def __init__(
+        self,
+        stores_dir: str,
+        memory_budget_bytes: int = 2 * 1024 * 1024 * 1024,
+        max_idle_seconds: Optional[float] = None,
+        vector_store: str = "chroma",
+        openai_model: Optional[str] = "gpt-4",
+        rewrite_model: Optional[str] = None,
+        fan_out: bool = False,
+        llm: Optional[BaseChatModel] = None,
+        rewrite_llm: Optional[BaseChatModel] = None,
+        embedding_function: Optional[Embeddings] = None,
+        query_batch_window_ms: Optional[float] = None,
+        query_batch_size: int = 64,
+        instrumentation: Optional[Instrumentation] = None,
+        **kwargs,
+    ):
+        """Maps the profile ids to their sources and opens their chains
+        on the first request. The least recently used idle profiles are
+        closed when the open profiles are larger than `memory_budget_bytes`.
+        The size of a profile is estimated by the size of its stores
+
+        Parameters
+        ----------
+        stores_dir : str
+            The directory of the vector stores of all the profiles
+        memory_budget_bytes : int, optional
+            The size that the open profiles can take, by default 2GB
+        max_idle_seconds : Optional[float], optional
+            If provided, the profiles that have not been used for this long
+            are closed whatever the budget, by default None
+        vector_store : str, optional
+            The kind of vector store, by default "chroma". The "numpy"
+            stores are memory mapped and are cheaper to keep open
+        openai_model : Optional[str], optional
+            The name of the openai model, by default "gpt-4"
+        rewrite_model : Optional[str], optional
+            The openai model that rewrites the follow up questions,
+            by default None. The model that answers rewrites them if this is None
+        fan_out : bool, optional
+            Ask both chains concurrently in the agents, by default False
+        llm : Optional[BaseChatModel], optional
+            The chat model shared by the profiles, by default None
+            A ChatOpenAI model of `openai_model` is used if this is None
+        rewrite_llm : Optional[BaseChatModel], optional
+            The chat model that rewrites the follow up questions of all the
+            profiles, by default None
+            A ChatOpenAI model of `rewrite_model` is used if this is None,
+            or the answering model if both are None
+        embedding_function : Optional[Embeddings], optional
+            The embedding function shared by the profiles, by default None
+            The OpenAI embeddings are used if this is None
+        query_batch_window_ms : Optional[float], optional
+            If provided, the queries of all the profiles that arrive within
+            this many milliseconds are embedded with one request, by default None
+        query_batch_size : int, optional
+            The maximum number of queries in one request, by default 64
+        instrumentation : Optional[Instrumentation], optional
+            Records the time and the tokens of every answer, by default None
+        kwargs
+            Passed to the loaders of the chains
+        """
+        self.stores_dir = stores_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_idle_seconds = max_idle_seconds
+        self.vector_store = vector_store
+        self.openai_model = openai_model
+        self.fan_out = fan_out
+        self.instrumentation = instrumentation
+        self.loader_kwargs = kwargs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # The clients are created once and shared by every profile
+        if llm is None:
+            llm = ChatOpenAI(model=openai_model, api_key=os.environ["OPENAI_API_KEY"])
+        if rewrite_llm is None and rewrite_model is not None:
+            rewrite_llm = ChatOpenAI(
+                model=rewrite_model,
+                temperature=0,
+                api_key=os.environ["OPENAI_API_KEY"],
+            )
+        self.llm = llm
+        self.rewrite_llm = rewrite_llm
+        self.embedding_function = create_embedding_function(
+            embedding_function,
+            embedding_cache_dir=f"{stores_dir}/embedding_cache",
+            query_batch_window_ms=query_batch_window_ms,
+            query_batch_size=query_batch_size,
+        )
+        self.resolver = StoreResolver(stores_dir)
+
+        self._sources: dict[str, dict[str, Optional[str]]] = {}
+        self._open: OrderedDict[str, _OpenProfile] = OrderedDict()
+        # The profiles that were evicted while in use. They are
+        # closed by the release of their last request
+        self._draining: list[_OpenProfile] = []
+        # The store directories whose Chroma client could not be
+        # released yet, as a chain still held their store
+        self._unreleased: set[str] = set()
+        self._lock = threading.Lock()
+        self._profile_locks: dict[str, threading.Lock] = {}
+
+    def register(
+        self,
+        profile_id: str,
+        notion_path: Optional[str] = None,
+        cv_path: Optional[str] = None,
+    ):
+        """Adds a profile. Nothing is loaded until it is requested.
+        A profile that is registered again is closed so that its
+        new sources are loaded by the next request
+
+        Parameters
+        ----------
+        profile_id : str
+            The id of the profile. Letters, digits, "-" and "_"
+        notion_path : Optional[str], optional
+            The folder or the .zip file of the Notion export, by default None
+        cv_path : Optional[str], optional
+            The path of the CV, by default None
+        """
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            raise ValueError(
+                f"The profile id {profile_id!r} should only have letters, "
+                "digits, - and _"
+            )
+        if notion_path is None and cv_path is None:
+            raise ValueError(f"The profile {profile_id} needs a Notion export or a CV")
+
+        with self._lock:
+            self._sources[profile_id] = {"notion": notion_path, "cv": cv_path}
+        self.evict(profile_id)
+
+    def register_from_file(self, filepath: str):
+        """Registers the profiles of a json file that maps every
+        profile id to its "notion" and "cv" paths. The relative
+        paths are relative to the json file
+
+        Parameters
+        ----------
+        filepath : str
+            The path of the json file
+        """
+        base_dir = Path(filepath).parent
+        with open(filepath) as fp:
+            profiles = json.load(fp)
+
+        for profile_id, sources in profiles.items():
+            paths = {
+                kind: str(base_dir / sources[kind]) if sources.get(kind) else None
+                for kind in ("notion", "cv")
+            }
+            self.register(profile_id, notion_path=paths["notion"], cv_path=paths["cv"])
+
+    def unregister(self, profile_id: str):
+        """Closes and removes a profile"""
+        self.evict(profile_id)
+        with self._lock:
+            self._sources.pop(profile_id, None)
+
+    def profiles(self) -> list[str]:
+        """The ids of the registered profiles"""
+        with self._lock:
+            return sorted(self._sources)
+
+    def __contains__(self, profile_id: str) -> bool:
+        with self._lock:
+            return profile_id in self._sources
+
+    def _load(self, profile_id: str) -> _OpenProfile:
+        sources = self._sources[profile_id]
+        store_directories = resolve_source_stores(
+            self.resolver,
+            embedding_name(self.embedding_function),
+            notion_path=sources["notion"],
+            cv_path=sources["cv"],
+            splitter=default_splitter(),
+            vector_store=self.vector_store,
+            cv_extraction=self.loader_kwargs.get(
+                "cv_extraction", DEFAULT_CV_EXTRACTION
+            ),
+        )
+        loader_kwargs = {
+            **self.loader_kwargs,
+            "llm": self.llm,
+            "rewrite_llm": self.rewrite_llm,
+            "embedding_function": self.embedding_function,
+            # The embedding function is cached and batched already
+            "embedding_cache_dir": None,
+        }
+        chains = load_sources(
+            stores_dir=self.stores_dir,
+            notion_path=sources["notion"],
+            cv_path=sources["cv"],
+            vector_store=self.vector_store,
+            openai_model=self.openai_model,
+            fan_out=self.fan_out,
+            instrumentation=self.instrumentation,
+            # The chains of a profile are dropped together with the profile
+            registry=ChainRegistry(),
+            store_directories=store_directories,
+            **loader_kwargs,
+        )
+        size_bytes = PROFILE_OVERHEAD_BYTES + sum(
+            directory_size(directory) for directory in store_directories.values()
+        )
+        return _OpenProfile(profile_id, chains, store_directories, size_bytes)
+
+    def acquire(self, profile_id: str) -> dict[str, Union[KnowmeChain, KnowMeAgent]]:
+        """Opens the profile if needed and marks it as in use.
+        A profile in use is never evicted. Call `release` once done
+
+        Parameters
+        ----------
+        profile_id : str
+            The id of the profile
+
+        Returns
+        -------
+        dict[str, Union[KnowmeChain, KnowMeAgent]]
+            The chain of every source of the profile
+
+        Raises
+        ------
+        KeyError
+            If the profile is not registered
+        """
+        with self._lock:
+            if profile_id not in self._sources:
+                raise KeyError(f"Unknown profile {profile_id}")
+            profile = self._open.get(profile_id)
+            if profile is not None:
+                self.hits += 1
+                profile.active += 1
+                profile.last_used = time.monotonic()
+                self._open.move_to_end(profile_id)
+                return profile.chains
+            profile_lock = self._profile_locks.setdefault(profile_id, threading.Lock())
+
+        with profile_lock:
+            # Another request might have opened the profile while waiting
+            with self._lock:
+                profile = self._open.get(profile_id)
+                if profile is not None:
+                    self.hits += 1
+                    profile.active += 1
+                    profile.last_used = time.monotonic()
+                    self._open.move_to_end(profile_id)
+                    return profile.chains
+                self.misses += 1
+
+            profile = self._load(profile_id)
+            profile.active += 1
+
+            with self._lock:
+                self._open[profile_id] = profile
+                self._profile_locks.pop(profile_id, None)
+                evicted = self._select_evictions()
+            self._close(evicted)
+
+        return profile.chains
+
+    def _find(
+        self,
+        profile_id: str,
+        chains: Optional[dict[str, Union[KnowmeChain, KnowMeAgent]]] = None,
+    ) -> Optional[_OpenProfile]:
+        # Called with the lock held. A profile that was evicted and opened
+        # again is both open and draining. The chains tell them apart
+        candidates = [self._open.get(profile_id), *reversed(self._draining)]
+        for profile in candidates:
+            if profile is None or profile.profile_id != profile_id:
+                continue
+            if chains is None or profile.chains is chains:
+                return profile
+        return None
+
+    def release(
+        self,
+        profile_id: str,
+        chains: Optional[dict[str, Union[KnowmeChain, KnowMeAgent]]] = None,
+    ):
+        """Marks the end of a request that acquired the profile
+
+        Parameters
+        ----------
+        profile_id : str
+            The id of the profile
+        chains : Optional[dict[str, Union[KnowmeChain, KnowMeAgent]]], optional
+            The chains returned by `acquire`, by default None. They tell
+            the profile that was evicted during the request apart from
+            the one that was opened again since
+        """
+        with self._lock:
+            profile = self._find(profile_id, chains)
+            if profile is None:
+                return
+            profile.active = max(profile.active - 1, 0)
+            profile.last_used = time.monotonic()
+            evicted = self._select_evictions()
+            if profile.active == 0 and profile in self._draining:
+                self._draining.remove(profile)
+                evicted.append(profile)
+        self._close(evicted)
+
+    @contextmanager
+    def use(
+        self, profile_id: str
+    ) -> Iterator[dict[str, Union[KnowmeChain, KnowMeAgent]]]:
+        """Acquires the profile for the duration of the block
+
+        Parameters
+        ----------
+        profile_id : str
+            The id of the profile
+
+        Yields
+        ------
+        dict[str, Union[KnowmeChain, KnowMeAgent]]
+            The chain of every source of the profile
+        """
+        chains = self.acquire(profile_id)
+        try:
+            yield chains
+        finally:
+            self.release(profile_id, chains)
+
+    def _select_evictions(self) -> list[_OpenProfile]:
+        # Called with the lock held. The least recently used idle
+        # profiles are closed first
+        now = time.monotonic()
+        evicted = []
+        if self.max_idle_seconds is not None:
+            for profile_id, profile in list(self._open.items()):
+                if (
+                    profile.active == 0
+                    and now - profile.last_used > self.max_idle_seconds
+                ):
+                    evicted.append(self._open.pop(profile_id))
+
+        size_bytes = sum(profile.size_bytes for profile in self._open.values())
+        for profile_id, profile in list(self._open.items()):
+            if size_bytes <= self.memory_budget_bytes:
+                break
+            if profile.active == 0:
+                evicted.append(self._open.pop(profile_id))
+                size_bytes -= profile.size_bytes
+
+        self.evictions += len(evicted)
+        return evicted
+
+    def _close(self, evicted: list[_OpenProfile]):
+        for profile in evicted:
+            for chain in (profile.chains or {}).values():
+                close_entry(chain)
+        if self.vector_store != "chroma":
+            return
+        # The Chroma client of a directory is shared by the process. Two
+        # profiles with the same source share a store, and the chains that
+        # are loaded outside the registry can use it as well. The client
+        # is only stopped once no chain of the process holds the store
+        with self._lock:
+            for profile in evicted:
+                profile.chains = None
+                self._unreleased.update(profile.store_directories.values())
+            directories = list(self._unreleased)
+            open_directories = {
+                directory
+                for profile in [*self._open.values(), *self._draining]
+                for directory in profile.store_directories.values()
+            }
+        for directory in directories:
+            if directory in open_directories or is_store_in_use(directory):
+                continue
+            release_chroma_client(directory)
+            with self._lock:
+                self._unreleased.discard(directory)
+
+    def evict(self, profile_id: Optional[str] = None):
+        """Closes a profile. It is opened again by the next request.
+        A profile in use is closed by the release of its last request
+
+        Parameters
+        ----------
+        profile_id : Optional[str], optional
+            The id of the profile, by default None
+            All the profiles are closed if this is None
+        """
+        with self._lock:
+            if profile_id is None:
+                evicted = list(self._open.values())
+                self._open.clear()
+            else:
+                profile = self._open.pop(profile_id, None)
+                evicted = [profile] if profile is not None else []
+            self.evictions += len(evicted)
+            self._draining.extend(profile for profile in evicted if profile.active)
+            evicted = [profile for profile in evicted if not profile.active]
+        self._close(evicted)
+
+    def stats(self) -> dict[str, Any]:
+        """The open profiles and their estimated size
+
+        Returns
+        -------
+        dict[str, Any]
+            The number of registered and open profiles, the size of the
+            open profiles, the budget, the hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                "profiles": len(self._sources),
+                "open": len(self._open),
+                "in_use": sum(profile.active > 0 for profile in self._open.values()),
+                "draining": len(self._draining),
+                "size_bytes": sum(
+                    profile.size_bytes for profile in self._open.values()
+                ),
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
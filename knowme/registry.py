@@ -0,0 +1,121 @@
+"""
+A process wide registry of loaded chains and agents.
+Streamlit reruns the app on every interaction. The modules that are
+imported are not rerun, so the registry survives the reruns and the
+chains are built only once per process.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def close_entry(entry: Any):
+    """Frees the resources of an entry that is dropped,
+    such as the workers of an agent"""
+    close = getattr(entry, "close", None)
+    if callable(close):
+        close()
+
+
+class ChainRegistry:
+    def __init__(self, max_size: int = 16):
+        """A thread safe LRU registry of chains and agents
+
+        Parameters
+        ----------
+        max_size : int, optional
+            The maximum number of entries that are kept, by default 16
+            The least recently used entry is evicted beyond this
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: dict[Hashable, threading.Lock] = {}
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """The entry for the key if it has been loaded"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Returns the entry for the key. The entry is created
+        with the factory if it is not present
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry
+        factory : Callable[[], Any]
+            Called to create the entry. Concurrent calls with the
+            same key wait for a single call of the factory
+
+        Returns
+        -------
+        Any
+            The entry
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread might have created the entry while waiting
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+                self.misses += 1
+
+            entry = factory()
+
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                evicted = []
+                while len(self._entries) > self.max_size:
+                    evicted.append(self._entries.popitem(last=False)[1])
+                self._key_locks.pop(key, None)
+
+        for evicted_entry in evicted:
+            close_entry(evicted_entry)
+        return entry
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Removes an entry so that it is created again on the next call
+
+        Parameters
+        ----------
+        key : Optional[Hashable], optional
+            The key of the entry, by default None
+            All the entries are removed if this is None
+        """
+        with self._lock:
+            if key is None:
+                evicted = list(self._entries.values())
+                self._entries.clear()
+            else:
+                evicted = [self._entries.pop(key, None)]
+        for entry in evicted:
+            close_entry(entry)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# The registry shared by the app
+chain_registry = ChainRegistry()
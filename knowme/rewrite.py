@@ -0,0 +1,137 @@
+"""
+Decides when the question of the user has to be rewritten with the
+help of the chat history before retrieving the documents.
+Every rewrite is a round trip to an llm. It is skipped when there is
+no history or when the question can be understood on its own.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+from langchain_core.messages import BaseMessage
+
+# Words that refer to something mentioned earlier in the chat.
+# The pronouns for the person are not here. Every chat is about
+# one candidate, so "they" or "she" can be understood on its own
+REFERRING_WORDS = {
+    "it",
+    "its",
+    "this",
+    "that",
+    "these",
+    "those",
+    "there",
+    "then",
+    "above",
+    "previous",
+    "earlier",
+    "former",
+    "latter",
+    "same",
+    "also",
+    "else",
+    "more",
+    "other",
+    "another",
+    "again",
+    "too",
+}
+
+# Questions starting like these continue the previous question
+FOLLOW_UP_PREFIXES = ("and ", "but ", "so ", "what about ", "how about ")
+
+
+class RewritePolicy:
+    def __init__(self, min_words: int = 4, max_cached_rewrites: int = 1024):
+        """Decides when a question needs to be rewritten
+        and caches the rewritten questions
+
+        Parameters
+        ----------
+        min_words : int, optional
+            Questions shorter than this are always rewritten
+            when there is a history, by default 4
+        max_cached_rewrites : int, optional
+            The number of rewritten questions that are cached, by default 1024
+        """
+        self.min_words = min_words
+        self.max_cached_rewrites = max_cached_rewrites
+        self.skipped = 0
+        self.cache_hits = 0
+        self.rewrites = 0
+        self._rewrites: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_self_contained(self, query: str) -> bool:
+        """A cheap check of whether the question can be
+        understood without the chat history
+
+        Parameters
+        ----------
+        query : str
+            The question typed by the user
+
+        Returns
+        -------
+        bool
+            False if the question is short, continues the previous
+            question or refers to something mentioned earlier
+        """
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+        words = normalized.split()
+        if len(words) < self.min_words:
+            return False
+        if f"{normalized} ".startswith(FOLLOW_UP_PREFIXES):
+            return False
+        return not any(word in REFERRING_WORDS for word in words)
+
+    def needs_rewrite(self, chat_history: Sequence[BaseMessage], query: str) -> bool:
+        """Whether the question has to be rewritten with the help of the history
+
+        Parameters
+        ----------
+        chat_history : Sequence[BaseMessage]
+            The messages of the previous turns
+        query : str
+            The question typed by the user
+
+        Returns
+        -------
+        bool
+            True if there is a history and the question is not self contained
+        """
+        needs_rewrite = bool(chat_history) and not self.is_self_contained(query)
+        if not needs_rewrite:
+            with self._lock:
+                self.skipped += 1
+        return needs_rewrite
+
+    @staticmethod
+    def _key(chat_history: Sequence[BaseMessage], query: str) -> tuple[str, str]:
+        history_hash = hashlib.sha256()
+        for message in chat_history:
+            history_hash.update(f"{message.type}\0{message.content}\0".encode())
+        return history_hash.hexdigest(), query
+
+    def get(self, chat_history: Sequence[BaseMessage], query: str) -> Optional[str]:
+        """The cached rewrite of the question for the same history"""
+        key = self._key(chat_history, query)
+        with self._lock:
+            if key not in self._rewrites:
+                return None
+            self._rewrites.move_to_end(key)
+            self.cache_hits += 1
+            return self._rewrites[key]
+
+    def put(self, chat_history: Sequence[BaseMessage], query: str, rewritten: str):
+        """Caches the rewrite of the question"""
+        key = self._key(chat_history, query)
+        with self._lock:
+            self.rewrites += 1
+            self._rewrites[key] = rewritten
+            self._rewrites.move_to_end(key)
+            while len(self._rewrites) > self.max_cached_rewrites:
+                self._rewrites.popitem(last=False)
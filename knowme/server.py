@@ -0,0 +1,343 @@
+"""
+A headless HTTP API for the chains, served by any ASGI server.
+The site, CV and agent chats are exposed as JSON endpoints and their
+answers can be streamed token by token as server-sent events.
+
+Every client gets its own session id. It is returned by the first
+request and the client sends it back, in the body or in the
+X-Session-Id header, to continue the conversation. The chains are
+loaded once and shared by all the requests. The profiles of a
+`ProfileRegistry` are served under /profiles/{profile_id} and are
+opened by their first request.
+"""
+
+import json
+import re
+import uuid
+from typing import Any, AsyncIterator, Callable, Optional, Union
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from knowme.agent import KnowMeAgent
+from knowme.instrumentation import Instrumentation
+from knowme.knowme_chain import KnowmeChain
+from knowme.profiles import ProfileRegistry
+
+SESSION_HEADER = "X-Session-Id"
+# The session ids that are sent by the clients end up in the keys of
+# the session store. Anything else is replaced by a new id
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _answer_text(output: Any) -> str:
+    # The chains answer with a dict and the agent with the text
+    if isinstance(output, dict):
+        return output.get("answer", "")
+    return output
+
+
+def server_sent_event(data: dict[str, Any], event: Optional[str] = None) -> str:
+    """Formats one server-sent event with a json payload"""
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    def __init__(self, *args, on_close: Optional[Callable[[], None]] = None, **kwargs):
+        """A streaming response that calls `on_close` once it is over,
+        whether it was sent in full, failed or the client went away"""
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+class ChatAPI:
+    def __init__(
+        self,
+        chains: dict[str, Union[KnowmeChain, KnowMeAgent]],
+        instrumentation: Optional[Instrumentation] = None,
+        profiles: Optional[ProfileRegistry] = None,
+    ):
+        """The handlers of the endpoints
+
+        Parameters
+        ----------
+        chains : dict[str, Union[KnowmeChain, KnowMeAgent]]
+            The chain of every source, such as "site", "cv" and "agent"
+        instrumentation : Optional[Instrumentation], optional
+            Served on /metrics if provided, by default None
+        profiles : Optional[ProfileRegistry], optional
+            If provided, the chats of its profiles are served under
+            /profiles/{profile_id}, by default None
+        """
+        self.chains = chains
+        self.instrumentation = instrumentation
+        self.profiles = profiles
+
+    def routes(self) -> list[Route]:
+        routes = [
+            Route("/health", self.health, methods=["GET"]),
+            Route("/sessions", self.create_session, methods=["POST"]),
+            Route("/chat/{source}", self.chat, methods=["POST"]),
+            Route("/chat/{source}/stream", self.chat_stream, methods=["POST"]),
+            Route("/metrics", self.metrics, methods=["GET"]),
+        ]
+        if self.profiles is not None:
+            routes += [
+                Route("/profiles", self.list_profiles, methods=["GET"]),
+                Route(
+                    "/profiles/{profile_id}/chat/{source}",
+                    self.profile_chat,
+                    methods=["POST"],
+                ),
+                Route(
+                    "/profiles/{profile_id}/chat/{source}/stream",
+                    self.profile_chat_stream,
+                    methods=["POST"],
+                ),
+            ]
+        return routes
+
+    async def health(self, request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok", "sources": sorted(self.chains)})
+
+    async def create_session(self, request: Request) -> JSONResponse:
+        session_id = new_session_id()
+        return JSONResponse(
+            {"session_id": session_id}, headers={SESSION_HEADER: session_id}
+        )
+
+    async def metrics(self, request: Request) -> PlainTextResponse:
+        if self.instrumentation is None:
+            return PlainTextResponse("The metrics are not recorded\n", status_code=404)
+        return PlainTextResponse(
+            self.instrumentation.to_prometheus(),
+            media_type="text/plain; version=0.0.4",
+        )
+
+    async def list_profiles(self, request: Request) -> JSONResponse:
+        return JSONResponse(
+            {"profiles": self.profiles.profiles(), "stats": self.profiles.stats()}
+        )
+
+    @staticmethod
+    async def _parse_chat(
+        request: Request, chains: dict[str, Union[KnowmeChain, KnowMeAgent]]
+    ) -> tuple[Optional[Any], Optional[str], Optional[str], Optional[JSONResponse]]:
+        """The chain, the question and the session id of a chat request,
+        or the response of the error"""
+        source = request.path_params["source"]
+        chain = chains.get(source)
+        if chain is None:
+            return (
+                None,
+                None,
+                None,
+                JSONResponse(
+                    {
+                        "error": f"Unknown source {source}. "
+                        f"Choose one of {', '.join(sorted(chains))}"
+                    },
+                    status_code=404,
+                ),
+            )
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, dict) or not isinstance(body.get("question"), str):
+            return (
+                None,
+                None,
+                None,
+                JSONResponse(
+                    {"error": 'Send a json body with a "question"'}, status_code=400
+                ),
+            )
+
+        session_id = body.get("session_id") or request.headers.get(SESSION_HEADER)
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+            session_id = new_session_id()
+        return chain, body["question"], session_id, None
+
+    @staticmethod
+    def _answer_response(output: Any, session_id: str) -> JSONResponse:
+        return JSONResponse(
+            {"answer": _answer_text(output), "session_id": session_id},
+            headers={SESSION_HEADER: session_id},
+        )
+
+    def _stream_response(
+        self,
+        chain: Union[KnowmeChain, KnowMeAgent],
+        question: str,
+        session_id: str,
+        chain_session_id: Optional[str] = None,
+        on_close: Optional[Callable[[], None]] = None,
+    ) -> StreamingResponse:
+        return ClosingStreamingResponse(
+            self._events(chain, question, session_id, chain_session_id),
+            on_close=on_close,
+            media_type="text/event-stream",
+            headers={
+                SESSION_HEADER: session_id,
+                "Cache-Control": "no-cache",
+                # Proxies such as nginx would otherwise hold back the tokens
+                "X-Accel-Buffering": "no",
+            },
+        )
+
+    async def chat(self, request: Request) -> JSONResponse:
+        chain, question, session_id, error = await self._parse_chat(
+            request, self.chains
+        )
+        if error is not None:
+            return error
+
+        output = await chain.achat(question, session_id=session_id)
+        return self._answer_response(output, session_id)
+
+    async def chat_stream(self, request: Request):
+        chain, question, session_id, error = await self._parse_chat(
+            request, self.chains
+        )
+        if error is not None:
+            return error
+        return self._stream_response(chain, question, session_id)
+
+    async def _acquire_profile(
+        self, request: Request
+    ) -> tuple[Optional[dict[str, Any]], Optional[JSONResponse]]:
+        profile_id = request.path_params["profile_id"]
+        if profile_id not in self.profiles:
+            return None, JSONResponse(
+                {"error": f"Unknown profile {profile_id}"}, status_code=404
+            )
+        # Opening a profile loads its stores. The event loop is not blocked
+        chains = await run_in_threadpool(self.profiles.acquire, profile_id)
+        return chains, None
+
+    @staticmethod
+    def _profile_session_id(request: Request, session_id: str) -> str:
+        # The profiles share the session store. The same session id
+        # sent to two profiles is two conversations
+        return f"{request.path_params['profile_id']}:{session_id}"
+
+    async def profile_chat(self, request: Request) -> JSONResponse:
+        chains, error = await self._acquire_profile(request)
+        if error is not None:
+            return error
+
+        profile_id = request.path_params["profile_id"]
+        try:
+            chain, question, session_id, error = await self._parse_chat(request, chains)
+            if error is not None:
+                return error
+            output = await chain.achat(
+                question, session_id=self._profile_session_id(request, session_id)
+            )
+        finally:
+            self.profiles.release(profile_id, chains)
+        return self._answer_response(output, session_id)
+
+    async def profile_chat_stream(self, request: Request):
+        chains, error = await self._acquire_profile(request)
+        if error is not None:
+            return error
+
+        profile_id = request.path_params["profile_id"]
+        try:
+            chain, question, session_id, error = await self._parse_chat(request, chains)
+        except BaseException:
+            self.profiles.release(profile_id, chains)
+            raise
+        if error is not None:
+            self.profiles.release(profile_id, chains)
+            return error
+
+        # The profile is in use until the last token is sent
+        return self._stream_response(
+            chain,
+            question,
+            session_id,
+            chain_session_id=self._profile_session_id(request, session_id),
+            on_close=lambda: self.profiles.release(profile_id, chains),
+        )
+
+    @staticmethod
+    async def _events(
+        chain: Union[KnowmeChain, KnowMeAgent],
+        question: str,
+        session_id: str,
+        chain_session_id: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        yield server_sent_event({"session_id": session_id}, event="session")
+        answer = ""
+        try:
+            async for chunk in chain.achat_stream(
+                question, session_id=chain_session_id or session_id
+            ):
+                if chunk.get("tool"):
+                    yield server_sent_event({"tool": chunk["tool"]}, event="tool")
+                if chunk.get("status"):
+                    yield server_sent_event({"status": chunk["status"]}, event="status")
+                if chunk.get("answer"):
+                    answer += chunk["answer"]
+                    yield server_sent_event({"token": chunk["answer"]})
+        except Exception as error:
+            # The status of the response has been sent already
+            yield server_sent_event({"error": str(error)}, event="error")
+            return
+        yield server_sent_event(
+            {"answer": answer, "session_id": session_id}, event="end"
+        )
+
+
+def create_app(
+    chains: Optional[dict[str, Union[KnowmeChain, KnowMeAgent]]] = None,
+    instrumentation: Optional[Instrumentation] = None,
+    profiles: Optional[ProfileRegistry] = None,
+    debug: bool = False,
+) -> Starlette:
+    """Creates the ASGI app that serves the chains
+
+    Parameters
+    ----------
+    chains : Optional[dict[str, Union[KnowmeChain, KnowMeAgent]]], optional
+        The chain of every source, usually from `load_sources`, by default None
+    instrumentation : Optional[Instrumentation], optional
+        Served on /metrics if provided, by default None
+    profiles : Optional[ProfileRegistry], optional
+        If provided, the chats of its profiles are served under
+        /profiles/{profile_id}, by default None
+    debug : bool, optional
+        Return the tracebacks of the errors, by default False
+
+    Returns
+    -------
+    Starlette
+        The app. Run it with uvicorn or any other ASGI server
+    """
+    api = ChatAPI(
+        chains=chains or {}, instrumentation=instrumentation, profiles=profiles
+    )
+    return Starlette(debug=debug, routes=api.routes())
@@ -0,0 +1,288 @@
+"""
+Stores the chat history of every session.
+The stores evict the sessions that have not been used for a while and
+keep a bounded number of messages per session. The in memory store is
+also capped by the estimated size of its messages, so that a long
+running process does not grow without bounds.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence
+
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+
+def message_size(message: BaseMessage) -> int:
+    """The estimated size of a message in memory, in bytes"""
+    return len(json.dumps(message_to_dict(message)))
+
+
+class BoundedChatMessageHistory(ChatMessageHistory):
+    """An in memory history that keeps only the latest `max_messages` messages.
+    The estimated size of the messages is kept in `size_bytes`"""
+
+    max_messages: Optional[int] = None
+    size_bytes: int = 0
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.messages.append(message)
+        self.size_bytes += message_size(message)
+        if self.max_messages is not None and len(self.messages) > self.max_messages:
+            for dropped in self.messages[: -self.max_messages]:
+                self.size_bytes -= message_size(dropped)
+            self.messages = self.messages[-self.max_messages :]
+
+    def clear(self) -> None:
+        super().clear()
+        self.size_bytes = 0
+
+
+class SessionStore(ABC):
+    """The chat histories of the sessions"""
+
+    @abstractmethod
+    def get_history(self, session_id: str) -> BaseChatMessageHistory:
+        """Returns the history of the session. A new
+        history is created if the session is not present"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """Deletes the history of the session"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """The number of sessions in the store"""
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        idle_ttl_seconds: Optional[float] = 60 * 60,
+        max_messages: Optional[int] = 50,
+        max_bytes: Optional[int] = 64 * 1024 * 1024,
+    ):
+        """Keeps the histories in memory
+
+        Parameters
+        ----------
+        max_sessions : int, optional
+            The least recently used sessions are evicted beyond this,
+            by default 1000
+        idle_ttl_seconds : Optional[float], optional
+            The sessions that are not used for these many seconds
+            are evicted, by default an hour
+        max_messages : Optional[int], optional
+            The number of messages that are kept per session, by default 50
+        max_bytes : Optional[int], optional
+            The least recently used sessions are evicted once the estimated
+            size of all the messages is beyond this, by default 64MB
+        """
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._sessions: OrderedDict[str, tuple[BoundedChatMessageHistory, float]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, now: float):
+        # The sessions are ordered by their last access.
+        # So only the oldest ones have to be checked
+        if self.idle_ttl_seconds is None:
+            return
+        while self._sessions:
+            session_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access <= self.idle_ttl_seconds:
+                break
+            del self._sessions[session_id]
+
+    def get_history(self, session_id: str) -> BaseChatMessageHistory:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            if session_id in self._sessions:
+                history, _ = self._sessions[session_id]
+            else:
+                history = BoundedChatMessageHistory(max_messages=self.max_messages)
+            self._sessions[session_id] = (history, now)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._evict_oversize()
+            return history
+
+    def _evict_oversize(self):
+        # The histories grow after they are returned, so the size is
+        # checked on the next access. The session in use is kept
+        if self.max_bytes is None:
+            return
+        size_bytes = sum(history.size_bytes for history, _ in self._sessions.values())
+        while size_bytes > self.max_bytes and len(self._sessions) > 1:
+            _, (history, _) = self._sessions.popitem(last=False)
+            size_bytes -= history.size_bytes
+
+    def size_bytes(self) -> int:
+        """The estimated size of the messages of all the sessions"""
+        with self._lock:
+            return sum(history.size_bytes for history, _ in self._sessions.values())
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, store: "SQLiteSessionStore", session_id: str):
+        """The history of a session stored in sqlite
+
+        Parameters
+        ----------
+        store : SQLiteSessionStore
+            The store that holds the connection
+        session_id : str
+            The id of the session
+        """
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        with self.store._lock:
+            rows = self.store._connection.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id",
+                (self.session_id,),
+            ).fetchall()
+        return messages_from_dict([json.loads(message) for (message,) in rows])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        rows = [
+            (self.session_id, json.dumps(message_to_dict(message)))
+            for message in messages
+        ]
+        with self.store._lock, self.store._connection:
+            self.store._connection.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)", rows
+            )
+            if self.store.max_messages is not None:
+                self.store._connection.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE session_id = ? "
+                    "ORDER BY id DESC LIMIT ?)",
+                    (self.session_id, self.session_id, self.store.max_messages),
+                )
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def clear(self) -> None:
+        with self.store._lock, self.store._connection:
+            self.store._connection.execute(
+                "DELETE FROM messages WHERE session_id = ?", (self.session_id,)
+            )
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(
+        self,
+        path: str,
+        idle_ttl_seconds: Optional[float] = 7 * 24 * 60 * 60,
+        max_messages: Optional[int] = 50,
+    ):
+        """Keeps the histories in a sqlite database. The histories
+        survive restarts and can be shared by many chains and processes.
+        Only the messages of the sessions that are used are read into memory
+
+        Parameters
+        ----------
+        path : str
+            The path of the sqlite database
+        idle_ttl_seconds : Optional[float], optional
+            The sessions that are not used for these many seconds
+            are deleted, by default a week
+        max_messages : Optional[int], optional
+            The number of messages that are kept per session, by default 50
+        """
+        self.path = path
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_messages = max_messages
+        self._last_eviction = 0.0
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "session_id TEXT NOT NULL, message TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS messages_session_id "
+                "ON messages (session_id)"
+            )
+
+    def _evict_idle(self, now: float):
+        # The idle sessions are deleted at most once a minute
+        if self.idle_ttl_seconds is None or now - self._last_eviction < 60:
+            return
+        self._last_eviction = now
+        cutoff = now - self.idle_ttl_seconds
+        self._connection.execute(
+            "DELETE FROM messages WHERE session_id IN "
+            "(SELECT session_id FROM sessions WHERE last_access < ?)",
+            (cutoff,),
+        )
+        self._connection.execute(
+            "DELETE FROM sessions WHERE last_access < ?", (cutoff,)
+        )
+
+    def get_history(self, session_id: str) -> BaseChatMessageHistory:
+        now = time.time()
+        with self._lock, self._connection:
+            self._evict_idle(now)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, last_access) "
+                "VALUES (?, ?)",
+                (session_id, now),
+            )
+        return SQLiteChatMessageHistory(self, session_id)
+
+    def delete(self, session_id: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM messages WHERE session_id = ?", (session_id,)
+            )
+            self._connection.execute(
+                "DELETE FROM sessions WHERE session_id = ?", (session_id,)
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM sessions"
+            ).fetchone()
+        return count
+
+
+# The store shared by the chains that are not given a store.
+# The histories of a session are shared when a chain is loaded again.
+# The chains of different stores keep their histories apart by a scope
+default_session_store = InMemorySessionStore()
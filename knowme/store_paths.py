@@ -0,0 +1,201 @@
+"""
+Content addressed directories of the vector stores.
+A store is named after the hash of what it was built from: the content
+of the source, the embedding model, the splitter and the kind of store.
+Two different files with the same name get different stores and the
+same file uploaded under another name reuses the store that has been
+built already. The names of the uploads are kept in an alias table.
+"""
+
+import json
+import hashlib
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl. The alias table is then
+    # only locked within the process
+    fcntl = None
+
+from langchain.text_splitter import TextSplitter
+from langchain_core.embeddings import Embeddings
+
+from knowme.manifest import embedding_name, splitter_config
+
+ALIASES_FILENAME = "aliases.json"
+ALIASES_LOCK_FILENAME = "aliases.lock"
+# Changing how the keys are computed changes every store directory
+STORE_KEY_VERSION = 1
+
+
+def store_key(
+    kind: str,
+    content_hash: str,
+    embedding: Union[str, Embeddings],
+    splitter: TextSplitter,
+    vector_store: str = "chroma",
+    **params: Any,
+) -> str:
+    """The key of the store that is built from a source
+
+    Parameters
+    ----------
+    kind : str
+        The kind of source, such as "notion" or "cv"
+    content_hash : str
+        The hash of the content of the source
+    embedding : Union[str, Embeddings]
+        The embedding function or its name from `embedding_name`
+    splitter : TextSplitter
+        The splitter that splits the source
+    vector_store : str, optional
+        The kind of vector store, by default "chroma"
+    params
+        Any other parameters that change the chunks
+
+    Returns
+    -------
+    str
+        The hex digest of the key
+    """
+    if isinstance(embedding, Embeddings):
+        embedding = embedding_name(embedding)
+
+    description = {
+        "version": STORE_KEY_VERSION,
+        "kind": kind,
+        "content": content_hash,
+        "embedding": embedding,
+        "splitter": splitter_config(splitter),
+        "store": vector_store,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class StoreResolver:
+    def __init__(self, stores_dir: str):
+        """Resolves the directories of the vector stores by their content
+
+        Parameters
+        ----------
+        stores_dir : str
+            The directory that holds the stores and the alias table
+        """
+        self.stores_dir = Path(stores_dir)
+        self.stores_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @property
+    def aliases_path(self) -> Path:
+        return self.stores_dir / ALIASES_FILENAME
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False) -> Iterator[None]:
+        # The app and the server can run in more than one process. The
+        # alias table is read and written under a lock on a separate file
+        # so that a concurrent update is not lost
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.stores_dir / ALIASES_LOCK_FILENAME, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def store_directory(self, key: str) -> str:
+        """The directory of the store with the key"""
+        return str(self.stores_dir / key[:24])
+
+    def resolve(
+        self,
+        name: str,
+        kind: str,
+        content_hash: str,
+        embedding: Union[str, Embeddings],
+        splitter: TextSplitter,
+        vector_store: str = "chroma",
+        **params: Any,
+    ) -> str:
+        """The directory of the store that is built from a source.
+        The name of the source is recorded as an alias of the store
+
+        Parameters
+        ----------
+        name : str
+            The name of the source, such as the name of the uploaded file
+        kind : str
+            The kind of source, such as "notion" or "cv"
+        content_hash : str
+            The hash of the content of the source
+        embedding : Union[str, Embeddings]
+            The embedding function or its name from `embedding_name`
+        splitter : TextSplitter
+            The splitter that splits the source
+        vector_store : str, optional
+            The kind of vector store, by default "chroma"
+        params
+            Any other parameters that change the chunks
+
+        Returns
+        -------
+        str
+            The directory of the store. The directory is the same for the
+            same content, whatever the name of the source
+        """
+        key = store_key(kind, content_hash, embedding, splitter, vector_store, **params)
+        with self._locked(exclusive=True):
+            aliases = self._read_aliases()
+            if aliases.get(name) != key:
+                aliases[name] = key
+                self._write_aliases(aliases)
+        return self.store_directory(key)
+
+    def lookup(self, name: str) -> Optional[str]:
+        """The directory of the store that the name was last resolved to
+
+        Parameters
+        ----------
+        name : str
+            The name of the source
+
+        Returns
+        -------
+        Optional[str]
+            The directory of the store. None if the name is not known
+        """
+        with self._locked():
+            key = self._read_aliases().get(name)
+        if key is None:
+            return None
+        return self.store_directory(key)
+
+    def aliases(self) -> dict[str, str]:
+        """The key of the store of every name"""
+        with self._locked():
+            return self._read_aliases()
+
+    def _read_aliases(self) -> dict[str, str]:
+        try:
+            with open(self.aliases_path) as fp:
+                return json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _write_aliases(self, aliases: dict[str, str]):
+        # The table is replaced at once so that a reader
+        # without the lock never sees a partial file
+        tmp_path = self.aliases_path.with_name(
+            f"{ALIASES_FILENAME}.{uuid.uuid4().hex}.tmp"
+        )
+        with open(tmp_path, "w") as fp:
+            json.dump(aliases, fp, indent=2, sort_keys=True)
+        tmp_path.replace(self.aliases_path)
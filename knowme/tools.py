@@ -3,7 +3,7 @@ This converts the chains to tools.
 These tools can be used by an agent that wishes to work with it
 """
 
-from typing import Optional, Type
+from typing import Any, Optional, Type
 
 from dotenv import load_dotenv
 from langchain.callbacks.manager import (
@@ -34,6 +34,9 @@ class SiteAnswerTool(BaseTool):
     name = "site-answer-tool"
     description = "Answer the questions about the candidate from the website"
     args_schema: Type[BaseModel] = SiteAnswerInput
+    # The chain is set per instance so that more than one
+    # agent can be loaded in the same process
+    chain: Any = None
 
     def _run(
         self,
@@ -41,7 +44,7 @@ class SiteAnswerTool(BaseTool):
         session_id: str,
         run_manager: Optional[CallbackManagerForToolRun],
     ):
-        return SiteAnswerTool.chain.chat(query, session_id)
+        return self.chain.chat(query, session_id)
 
     async def _arun(
         self,
@@ -49,7 +52,7 @@ class SiteAnswerTool(BaseTool):
         session_id: str,
         run_manager: Optional[AsyncCallbackManagerForToolRun],
     ):
-        raise NotImplementedError("site-answer-tool does not support async calls")
+        return await self.chain.achat(query, session_id)
 
     def set_chain(self, chain):
         self.chain = chain
@@ -61,6 +64,7 @@ class CVAnswerTool(BaseTool):
         "Answer the questions about the candidate from the CV that is stored in a pdf"
     )
     args_schema: Type[BaseModel] = CVAnswerInput
+    chain: Any = None
 
     def _run(
         self,
@@ -68,7 +72,7 @@ class CVAnswerTool(BaseTool):
         session_id: str,
         run_manager: Optional[CallbackManagerForToolRun],
     ):
-        return CVAnswerTool.chain.chat(query, session_id)
+        return self.chain.chat(query, session_id)
 
     async def _arun(
         self,
@@ -76,7 +80,7 @@ class CVAnswerTool(BaseTool):
         session_id: str,
         run_manager: Optional[AsyncCallbackManagerForToolRun],
     ):
-        raise NotImplementedError("site-answer-tool does not support async calls")
+        return await self.chain.achat(query, session_id)
 
     def set_chain(self, chain):
         self.chain = chain